@@ -0,0 +1,166 @@
+""" End-to-end crawl throughput benchmark against the local YÖK Atlas stand-in """
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from typing import List
+from argparse import ArgumentParser, Namespace
+
+from tqdm import tqdm
+
+import crawler
+from database import CrawlDatabase
+from panels import PANELS
+from retry import LatencyTracker, RetryPolicy
+from mock_server import FixtureGenerator, MockAtlasServer
+
+
+def parse_arguments() -> Namespace:
+  parser = ArgumentParser(description="Benchmark the crawler against mock_server.py")
+  parser.add_argument("-n", "--programs", default=100, type=int, help="Number of programs")
+  parser.add_argument("-y", "--year", default=2023, type=int, help="Year to crawl")
+  parser.add_argument("--latency", default=0.05, type=float, help="Mean server latency (s)")
+  parser.add_argument("--jitter", default=0.02, type=float, help="Server latency jitter (s)")
+  parser.add_argument("--error-rate", default=0.0, type=float, help="Ratio of failed responses")
+  parser.add_argument(
+    "--highschools", default=50, type=int, help="Number of high schools per program"
+  )
+  parser.add_argument(
+    "-tp", "--timeout-patience", default=5, type=int, help="Initial timeout patience (s)"
+  )
+  parser.add_argument(
+    "--lean", action="store_true", help="Crawl with the lean browser profile of crawler.py"
+  )
+  parser.add_argument(
+    "--skip-main", action="store_true", help="Only benchmark crawl_program, not crawler.py"
+  )
+  parser.add_argument("-o", "--output", default=None, help="Write the report to a JSON file")
+  return parser.parse_args()
+
+
+def percentile(values: List[float], q: float) -> float:
+  """ Nearest-rank percentile, 0 for an empty list """
+  if len(values) == 0:
+    return 0.0
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def stage_seconds(path: str, name: str) -> List[float]:
+  """ Samples of a stage in a JSON lines telemetry file written with --metrics """
+  with open(path, "r", encoding="utf-8") as f:
+    records = (json.loads(line) for line in f if line.strip())
+    return [record["seconds"] for record in records if record["stage"] == name]
+
+
+def create_database(path: str) -> CrawlDatabase:
+  with open("./schema.sql", "r", encoding="utf-8") as f:
+    schema = f.read()
+  return CrawlDatabase.create_from_schema(schema=schema, path=path)
+
+
+def bench_crawl_program(args: Namespace, program_ids: List[str], db_path: str) -> dict:
+  """ Crawl the programs with crawl_program in-process, timing fetch+parse and writes """
+  db = create_database(db_path)
+  browser = crawler.create_browser(args.lean)
+  policy = RetryPolicy(latency=LatencyTracker(initial=args.timeout_patience))
+  crawl_times, write_times, failed = [], [], 0
+  start = time.perf_counter()
+  try:
+    for idx in tqdm(program_ids, desc="crawl_program"):
+      t0 = time.perf_counter()
+      results = crawler.crawl_program(
+        browser, idx, args.year, args.timeout_patience, policy=policy, lean=args.lean
+      )
+      t1 = time.perf_counter()
+      crawl_times.append(t1 - t0)
+      if results == False:
+        failed += 1
+        continue
+      for name, data in results.items():
+        crawler.write_panel(db, PANELS[name], data, idx, args.year)
+      write_times.append(time.perf_counter() - t1)
+  finally:
+    browser.quit()
+  elapsed = time.perf_counter() - start
+  return {
+    "programs": len(program_ids),
+    "failed": failed,
+    "seconds": elapsed,
+    "programs_per_sec": len(program_ids) / elapsed,
+    "crawl_p50": percentile(crawl_times, 50),
+    "crawl_p99": percentile(crawl_times, 99),
+    "write_p50": percentile(write_times, 50),
+    "write_p99": percentile(write_times, 99),
+    "write_total": sum(write_times),
+  }
+
+
+def bench_main_loop(args: Namespace, program_ids: List[str], db_path: str, url: str) -> dict:
+  """
+  Run crawler.py end to end as a separate process
+
+  The crawler runs in a scratch directory next to the database, so its logs and
+  dead letters, written to ../logs, do not end up in the logs of the real crawls.
+  The fetch and write times are read from its telemetry.
+  """
+  create_database(db_path)
+  ids_path = db_path + ".txt"
+  with open(ids_path, "w") as f:
+    f.writelines(f"{idx}\n" for idx in program_ids)
+  metrics_path = db_path + ".metrics.jsonl"
+  workdir = os.path.join(os.path.dirname(os.path.abspath(db_path)), "main_loop")
+  os.makedirs(workdir, exist_ok=True)
+  command = [
+    sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "crawler.py"),
+    str(args.year), os.path.abspath(ids_path), "-d", os.path.abspath(db_path), "--base-url", url,
+    "-tp", str(args.timeout_patience), "--metrics", os.path.abspath(metrics_path)
+  ] + (["--lean"] if args.lean else [])
+  start = time.perf_counter()
+  subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=workdir)
+  elapsed = time.perf_counter() - start
+  crawled = len(CrawlDatabase(db_path).query("SELECT ProgramID FROM PlacementData"))
+  fetch_times = stage_seconds(metrics_path, "fetch")
+  write_times = stage_seconds(metrics_path, "write_panel")
+  return {
+    "programs": len(program_ids),
+    "crawled": crawled,
+    "seconds": elapsed,
+    "programs_per_sec": crawled / elapsed,
+    "fetch_p50": percentile(fetch_times, 50),
+    "fetch_p99": percentile(fetch_times, 99),
+    "write_p50": percentile(write_times, 50),
+    "write_p99": percentile(write_times, 99),
+  }
+
+
+if __name__ == "__main__":
+  args = parse_arguments()
+  server = MockAtlasServer(
+    latency=args.latency,
+    jitter=args.jitter,
+    error_rate=args.error_rate,
+    fixtures=FixtureGenerator(highschools=args.highschools),
+  ).start()
+  crawler.set_base_url(server.url)
+  program_ids = [str(100000000 + i) for i in range(args.programs)]
+
+  report = {"config": vars(args)}
+  with tempfile.TemporaryDirectory() as tmp:
+    report["crawl_program"] = bench_crawl_program(
+      args, program_ids, os.path.join(tmp, "crawl_program.db")
+    )
+    if not args.skip_main:
+      report["main_loop"] = bench_main_loop(
+        args, program_ids, os.path.join(tmp, "main_loop.db"), server.url
+      )
+  report["server"] = {"requests": server.requests, "errors": server.errors}
+  server.stop()
+
+  print(json.dumps(report, indent=2))
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
@@ -0,0 +1,270 @@
+""" Storage and query benchmark suite, run against a synthetic_data.py database """
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3 as sl
+import tempfile
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+from argparse import ArgumentParser, Namespace
+
+import pandas as pd
+
+from database import HS_KEYS, UNI_KEYS, CrawlDatabase, cascade_options
+
+
+def parse_arguments() -> Namespace:
+  parser = ArgumentParser(description="Benchmark the CrawlDatabase read and write paths")
+  parser.add_argument("database", help="Database generated with synthetic_data.py")
+  parser.add_argument("-r", "--repeat", default=5, type=int, help="Runs per query benchmark")
+  parser.add_argument(
+    "--writes", default=200, type=int, help="Programs written per write benchmark"
+  )
+  parser.add_argument(
+    "--full", action="store_true", help="Also benchmark the unfiltered get_chart_data query"
+  )
+  parser.add_argument("-o", "--output", default=None, help="Write the results to a JSON file")
+  parser.add_argument("--baseline", default=None, help="Previous results to compare against")
+  parser.add_argument(
+    "--tolerance",
+    default=0.25,
+    type=float,
+    help="Allowed relative p50 slowdown against the baseline (Default 0.25)"
+  )
+  return parser.parse_args()
+
+
+def summarize(timings: List[float], rows: Any = None) -> Dict[str, float]:
+  timings = sorted(timings)
+  return {
+    "runs": len(timings),
+    "rows": rows,
+    "min": timings[0],
+    "p50": timings[len(timings) // 2],
+    "p95": timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+    "mean": sum(timings) / len(timings),
+  }
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+  """ Time repeated calls of func and summarize them """
+  timings, rows = [], None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = func()
+    timings.append(time.perf_counter() - start)
+    if hasattr(result, "__len__"):
+      rows = len(result)
+  return summarize(timings, rows)
+
+
+def chart_scenarios(uni_data: pd.DataFrame, hs_data: pd.DataFrame) -> Dict[str, dict]:
+  """ Typical dashboard filter combinations, picked from the data itself """
+  rng = random.Random(0)
+  unis = sorted(pd.unique(uni_data["uni_name"]))
+  programs = uni_data["program"].value_counts().index
+  cities = hs_data["hs_city"].value_counts().index
+  return {
+    "defaults": {
+      "uni_type": ["Private", "State"],
+      "uni_name": rng.sample(unis, min(6, len(unis))),
+      "prog_type": ["SAY", "EA"],
+    },
+    "single_university": {"uni_name": unis[:1]},
+    "program_state": {"program": list(programs[:1]), "uni_type": ["State"]},
+    "hs_city": {"hs_city": list(cities[:1])},
+    "hs_names": {"hs_name": rng.sample(list(hs_data["hs_name"]), 5)},
+    "hs_city_and_universities": {
+      "hs_city": list(cities[:2]),
+      "uni_name": rng.sample(unis, min(10, len(unis)))
+    },
+  }
+
+
+def bench_reads(db: CrawlDatabase, args: Namespace) -> Dict[str, dict]:
+  results = {}
+  results["get_uni_filter_data"] = measure(db.get_uni_filter_data, args.repeat)
+  results["get_hs_filter_data"] = measure(db.get_hs_filter_data, args.repeat)
+  uni_data = db.get_uni_filter_data()
+  hs_data = db.get_hs_filter_data()
+
+  pairs = db.conn.execute("SELECT ProgramID, Year FROM PlacementData").fetchall()
+  rng = random.Random(0)
+  sample = [rng.choice(pairs) for _ in range(500)] + [(1, 1900)] * 500
+  results["check_existence_x1000"] = measure(
+    lambda: [db.check_existence(idx, year) for idx, year in sample], args.repeat
+  )
+
+  scenarios = chart_scenarios(uni_data, hs_data)
+  if args.full:
+    scenarios["unfiltered"] = {}
+  for name, filters in scenarios.items():
+    results[f"get_chart_data[{name}]"] = measure(
+      lambda: db.get_chart_data(filters), args.repeat
+    )
+
+  # Cascading filter updates as triggered by the multiselect callbacks
+  uni = uni_data["uni_name"].iloc[0]
+  city = hs_data["hs_city"].iloc[0]
+  results["filter_selections[uni_type]"] = measure(
+    lambda: cascade_options(uni_data, UNI_KEYS, "uni_type", ["State"]), args.repeat
+  )
+  results["filter_selections[uni_name]"] = measure(
+    lambda: cascade_options(uni_data, UNI_KEYS, "uni_name", [uni]), args.repeat
+  )
+  results["filter_selections[hs_city]"] = measure(
+    lambda: cascade_options(hs_data, HS_KEYS, "hs_city", [city]), args.repeat
+  )
+  return results
+
+
+def bench_writes(source: CrawlDatabase, args: Namespace) -> Dict[str, dict]:
+  """
+  Replay programs from the source database through the write_* paths of empty ones
+
+  The programs are written twice, each time into a new database. The cold run
+  clears the dimension cache before every program, so every call reaches
+  SQLite. The warm run keeps the cache like a crawl does, where the rows of
+  universities, faculties and high schools written before are skipped.
+  """
+  programs = source.query(
+    """
+    SELECT
+      u.UniversityName as uni_name,
+      u.UniversityType as uni_type,
+      u.UniversityCity as uni_city,
+      f.FacultyName as fac_name,
+      p.ProgramID as dept_id,
+      p.ProgramName as dept_name,
+      p.ProgramType as dept_type,
+      p.ScholarshipType as scholarship,
+      pd.TotalQuota as total_quota,
+      pd.TotalPlaced as total_placed,
+      pd.LowestScore as min_points,
+      pd.HighestScore as max_points,
+      pd.MinimumRanking as min_ranking,
+      pd.MaximumRanking as max_ranking,
+      pd.Year as year
+    FROM
+      University u
+      JOIN Faculty f ON f.UniversityID = u.UniversityID
+      JOIN Program p ON p.FacultyID = f.FacultyID
+      JOIN PlacementData pd ON pd.ProgramID = p.ProgramID
+    ORDER BY
+      random()
+    LIMIT ?
+    """, (args.writes, )
+  ).to_dict("records")
+  highschools = {}
+  for record in programs:
+    highschools[record["dept_id"], record["year"]] = source.query(
+      """
+      SELECT
+        hs.HighSchoolName as hs,
+        hs.City as hs_city,
+        hs.District as hs_district,
+        hsp.NumberOfNewGrads as new_grad,
+        hsp.NumberOfOldGrads as old_grad
+      FROM
+        HighSchoolPlacement hsp
+        JOIN HighSchool hs ON hs.HighSchoolID = hsp.HighSchoolID
+      WHERE
+        hsp.ProgramID = ? AND hsp.Year = ?
+      """, (record["dept_id"], record["year"])
+    )
+
+  with open("./schema.sql", "r", encoding="utf-8") as f:
+    schema = f.read()
+  results = {}
+  for run in ["cold", "warm"]:
+    with tempfile.TemporaryDirectory() as tmp:
+      db = CrawlDatabase.create_from_schema(schema=schema, path=os.path.join(tmp, "writes.db"))
+      for name, values in replay_writes(db, programs, highschools, warm=run == "warm").items():
+        results[f"{name}[{run}]"] = summarize(values)
+      del db
+  return results
+
+
+def replay_writes(
+  db: CrawlDatabase,
+  programs: List[dict],
+  highschools: Dict[tuple, pd.DataFrame],
+  warm: bool,
+) -> Dict[str, List[float]]:
+  """ Write the programs into db and return the time of every call per write_* method """
+  timings = {}
+  for record in programs:
+    if not warm:
+      db.clear_dimension_cache()
+    df = highschools[record["dept_id"], record["year"]]
+    calls = {
+      "write_university": lambda: db.write_university(**record),
+      "write_faculty": lambda: db.write_faculty(**record),
+      "write_program": lambda: db.write_program(**record),
+      "write_placement": lambda: db.write_placement(**record),
+      "write_highschools": lambda: db.write_highschools(df),
+      "write_highschool_placements": lambda: db.write_highschool_placements(
+        df, record["dept_id"], record["year"]
+      ),
+    }
+    for name, call in calls.items():
+      start = time.perf_counter()
+      call()
+      timings.setdefault(name, []).append(time.perf_counter() - start)
+  return timings
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+  """ Return the benchmarks whose p50 regressed beyond the tolerance """
+  regressions = []
+  for name, result in results.items():
+    if name in baseline and result["p50"] > baseline[name]["p50"] * (1 + tolerance):
+      regressions.append(
+        f"{name}: p50 {result['p50'] * 1000:.1f} ms "
+        f"vs baseline {baseline[name]['p50'] * 1000:.1f} ms"
+      )
+  return regressions
+
+
+if __name__ == "__main__":
+  args = parse_arguments()
+  db = CrawlDatabase(args.database)
+  counts = {
+    table: db.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    for table in [
+      "University", "Faculty", "Program", "PlacementData", "HighSchool", "HighSchoolPlacement"
+    ]
+  }
+
+  results = {}
+  results.update(bench_reads(db, args))
+  results.update(bench_writes(db, args))
+  report = {
+    "meta": {
+      "database": os.path.abspath(args.database),
+      "created": datetime.now().isoformat(timespec="seconds"),
+      "sqlite_version": sl.sqlite_version,
+      "pandas_version": pd.__version__,
+      "rows": counts,
+    },
+    "results": results,
+  }
+
+  for name, result in results.items():
+    print(f"+ {name:<45} p50 {result['p50'] * 1000:9.2f} ms   p95 {result['p95'] * 1000:9.2f} ms")
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+
+  if args.baseline is not None:
+    with open(args.baseline, "r") as f:
+      baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+      print(f"+ Regression: {line} ❌")
+    if len(regressions) != 0:
+      sys.exit(1)
+    print("+ No regressions against the baseline ✅")
@@ -0,0 +1,27 @@
+""" Shared fixtures of the tests, run with python -m pytest """
+
+import os
+
+import pytest
+
+from database import CrawlDatabase
+
+
+def create_database(path: str, partitioned: bool = False) -> str:
+  with open(os.path.join(os.path.dirname(__file__), "schema.sql"), "r", encoding="utf-8") as f:
+    CrawlDatabase.create_from_schema(schema=f.read(), path=path, partitioned=partitioned)
+  return path
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+  """ Path to a new database created from the schema """
+  return create_database(str(tmp_path / "crawl_database.db"))
+
+
+@pytest.fixture
+def partitioned_path(tmp_path) -> str:
+  """ Path to a new database in the partitioned layout with files for 2022 and 2023 """
+  path = create_database(str(tmp_path / "crawl_database.db"), partitioned=True)
+  CrawlDatabase(path).ensure_partitions([2022, 2023])
+  return path
@@ -1,17 +1,23 @@
-import re
+import os
 import time
-import logging
-from io import StringIO
+import socket
 from datetime import datetime
-from typing import Union, Tuple
+from typing import Any, Dict, Optional, Tuple, Union
 from argparse import ArgumentParser, Namespace
 
 # Library Imports
-import pandas as pd
 from tqdm import tqdm
 
 # Custom Imports
 from database import CrawlDatabase
+from log_utils import LOG_DIR, get_file_logger
+from retry import CircuitBreaker, LatencyTracker, RetryPolicy
+from telemetry import configure, stage
+from panels import PANELS, Panel, changed_panels
+from workqueue import LeasedTasks, open_queue
+from spool import SpoolWriter
+from scheduler import Scheduler, parse_years, stream_ids
+from pipeline import CrawlPipeline
 
 # Selenium Imports
 from selenium import webdriver
@@ -21,8 +27,16 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException
 
 
-URL = "https://yokatlas.yok.gov.tr/{year}/lisans-panel.php?y={program_id}&p={table_id}"
-tables = {"ranking": "1000_1", "highschools": "1060"}
+BASE_URL = "https://yokatlas.yok.gov.tr"
+URL = BASE_URL + "/{year}/lisans-panel.php?y={program_id}&p={table_id}"
+
+# Requests dropped by the lean browser. The panels only need the HTML and scripts
+# of the site, images, fonts, stylesheets and trackers are never looked at
+LEAN_BLOCKED_URLS = [
+  "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.webp", "*.ico", "*.woff", "*.woff2", "*.ttf",
+  "*.otf", "*.eot", "*.css", "*.mp4", "*google-analytics.com*", "*googletagmanager.com*",
+  "*doubleclick.net*", "*facebook.net*", "*facebook.com/tr*", "*hotjar.com*", "*yandex.ru*"
+]
 
 
 def parse_arguments() -> Namespace:
@@ -32,8 +46,22 @@ def parse_arguments() -> Namespace:
     description="Web crawler that scrapes tables from YÖK Atlas.",
     epilog="Bir kere rehber, daima rehber.",
   )
-  parser.add_argument("year", help="Year to scrape", type=int)
-  parser.add_argument("program_ids", help="Path to program ID file")
+  parser.add_argument(
+    "years",
+    metavar="year",
+    type=parse_years,
+    help="Year to scrape, or an inclusive range of years, e.g. 2019-2023"
+  )
+  parser.add_argument(
+    "program_ids",
+    nargs="*",
+    help="Program ID files or glob patterns, one ID per line. Not needed with --queue"
+  )
+  parser.add_argument(
+    "--missing",
+    action="store_true",
+    help="Also crawl the programs in the database that have no data for the years"
+  )
   parser.add_argument(
     "-d",
     "--database",
@@ -45,17 +73,140 @@ def parse_arguments() -> Namespace:
     "--timeout-patience",
     default=5,
     type=int,
-    help="Amount of seconds for the webdriver to wait for page to load"
+    help="Initial amount of seconds for the webdriver to wait for page to load"
+  )
+  parser.add_argument(
+    "--max-timeout",
+    default=30,
+    type=float,
+    help="Upper bound of the adaptive timeout patience in seconds (Default 30)"
+  )
+  parser.add_argument(
+    "--retries",
+    default=3,
+    type=int,
+    help="Number of attempts for each page load (Default 3)"
+  )
+  parser.add_argument(
+    "--breaker-cooldown",
+    default=30,
+    type=float,
+    help="Seconds to pause the crawl when the error rate spikes (Default 30)"
+  )
+  parser.add_argument(
+    "--lean",
+    action="store_true",
+    help="Block images, fonts, stylesheets and trackers and do not wait for them to load"
+  )
+  parser.add_argument(
+    "--parse-workers",
+    default=0,
+    type=int,
+    help="Parse the panels in this many processes while the browsers fetch the next "
+    "programs, -1 for one per core (Default 0, parse in between the page loads)"
+  )
+  parser.add_argument(
+    "--fetchers",
+    default=1,
+    type=int,
+    help="Number of browsers fetching in parallel with --parse-workers (Default 1)"
+  )
+  parser.add_argument(
+    "--base-url",
+    default=BASE_URL,
+    help=f"Site to crawl, e.g. a local mock_server.py instance (Default {BASE_URL})"
+  )
+  parser.add_argument(
+    "--queue",
+    default=None,
+    help="Lease the programs of the years from a workqueue.py database or coordinator URL"
+  )
+  parser.add_argument(
+    "--worker-id",
+    default=f"{socket.gethostname()}-{os.getpid()}",
+    help="Name of this crawler in the work queue (Default <hostname>-<pid>)"
+  )
+  parser.add_argument(
+    "--lease-size", default=20, type=int, help="Number of programs leased at once (Default 20)"
+  )
+  parser.add_argument(
+    "--lease-ttl",
+    default=300,
+    type=float,
+    help="Seconds before the lease of a silent crawler expires (Default 300)"
+  )
+  parser.add_argument(
+    "--spool",
+    default=None,
+    help="Append the crawled data to a JSON lines file in this directory instead of the "
+    "database. Load it later with database.py load"
+  )
+  parser.add_argument(
+    "--metrics",
+    default=None,
+    help="Write per-stage timings to this file: JSON lines, or Prometheus text for *.prom"
+  )
+  parser.add_argument(
+    "-v",
+    "--verbose",
+    action="store_true",
+    help="Print the crawled ranking data of every program"
   )
   parser.add_argument(
     "--override",
     action="store_true",
     help="If set override the values in the database. Otherwise the value is skipped"
   )
+  parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Re-crawl existing programs and only update the panels whose content changed"
+  )
   args = parser.parse_args()
+  if len(args.program_ids) == 0 and args.queue is None and not args.missing:
+    parser.error("either program_ids, --missing or --queue is required")
   return args
 
 
+def create_browser(lean: bool = False) -> webdriver.chrome.webdriver.WebDriver:
+  """
+  Create the headless Chrome instance used for crawling
+
+  Parameters
+  ----------
+  lean
+    Only load what the panels need. Images and other media are disabled for the
+    whole profile, the remaining non-essential requests are blocked per tab with
+    block_resources, and page loads return once the DOM is ready instead of
+    waiting for every resource
+  """
+  options = webdriver.chrome.options.Options()
+  options.add_argument("--headless")
+  if lean:
+    options.page_load_strategy = "eager"
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_argument("--disable-extensions")
+    options.add_experimental_option(
+      "prefs", {
+        f"profile.managed_default_content_settings.{setting}": 2
+        for setting in ["images", "media_stream", "notifications", "popups", "geolocation"]
+      }
+    )
+  browser = webdriver.Chrome(options=options)
+  if lean:
+    block_resources(browser)
+  return browser
+
+
+def block_resources(
+  browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver]
+):
+  """ Drop the LEAN_BLOCKED_URLS requests of the current tab. Only Chrome supports this """
+  if hasattr(browser, "execute_cdp_cmd"):
+    browser.execute_cdp_cmd("Network.enable", {})
+    browser.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+
+
 def find_element(
   browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver],
   element_xpath: str,
@@ -90,126 +241,252 @@ def find_element(
   return element
 
 
-def parse_rankings(dfs: list[pd.DataFrame], year: int) -> dict:
+def set_base_url(base_url: str):
+  """ Point the crawler to another site, e.g. the local stand-in in mock_server.py """
+  global URL
+  URL = base_url.rstrip("/") + "/{year}/lisans-panel.php?y={program_id}&p={table_id}"
+
+
+def panel_url(idx: str, year: int, panel_id: str) -> str:
+  """ URL of a program panel. The current year is served without the year prefix """
+  url = URL.format(year=year, program_id=idx, table_id=panel_id)
+  return url.replace(f"{datetime.now().year}/", "")
+
+
+def extract_panel(
+  browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver],
+  panel: Panel,
+  timeout_patience: int = 5,
+) -> Tuple[str, Dict[str, str]]:
   """
-  Parse general ranking table from HTML
+  Wait for the panel table on the current page and return its HTML
 
   Parameters
   ----------
-  dfs
-    Pandas parses the HTML into a standard DF. Pass it here to make it suitable for
-    the database.
+  browser
+    The webdriver instance, switched to the window that shows the panel
 
-  year
-    The for which the data was crawled
+  panel
+    The panel to extract
+
+  timeout_patience
+    Timeout patience for waiting a response from the site
 
   Returns
   -------
-  out
-    dictionary of the parsed data
+  html
+    Outer HTML of the panel container
+
+  texts
+    Text of the extra elements requested by the panel
   """
-  dept_name = dfs[0].columns[0]
-
-  # Some pages have extra promotional tables at the end.
-  if len(dfs) == 4:
-    dfs = dfs[:-1]
-
-  standardized_dfs = [
-    df.rename(columns={
-      df.columns[0]: 'Column1',
-      df.columns[1]: 'Column2'
-    }) for df in dfs
-  ]
-
-  df = pd.concat(standardized_dfs,
-                 ignore_index=True).replace("---", "").replace("Dolmadı", "").replace(
-                   '\*', '', regex=True
-                 ).map(lambda x: x.strip() if isinstance(x, str) else x)
-  data_dict = df.set_index("Column1")["Column2"].to_dict()
-  out = {
-    "uni_name": data_dict["Üniversite"],
-    "uni_type": "State" if data_dict["Üniversite Türü"] == "Devlet" else "Private",
-    "fac_name": data_dict["Fakülte / Yüksekokul"],
-    "dept_id": data_dict["ÖSYM Program Kodu"],
-    "dept_name": dept_name.replace("(" + data_dict["Burs Türü"] + ")", "").strip(),
-    "dept_type": data_dict["Puan Türü"],
-    "scholarship": data_dict["Burs Türü"].replace("%", "").split()[0].replace("İÖ-", ""),
-    "total_quota": data_dict["Toplam Kontenjan"],
-    "total_placed": data_dict["Toplam Yerleşen"],
-    "min_points": data_dict["0,12 Katsayı ile Yerleşen Son Kişinin Puanı"],
-    "max_points": data_dict[f"{year} Tavan Puan(0,12)"],
-    "min_ranking": data_dict["0,12 Katsayı ile Yerleşen Son Kişinin Başarı Sırası"],
-    "max_ranking": data_dict[f"{year} Tavan Başarı Sırası(0,12)"]
-  }
-  return {k: v if v != "" else None for k, v in out.items()}
-
-
-def parse_highschools(df: pd.DataFrame) -> pd.DataFrame:
+  with stage("element_wait", panel=panel.name):
+    # The panel table is filled in last, so a single wait for it covers the
+    # container and the page header as well
+    find_element(
+      browser, f'//*[@id="icerik_{panel.panel_id}"]/table', timeout_patience=timeout_patience
+    )
+  with stage("html_extraction", panel=panel.name):
+    table = browser.find_element(By.XPATH, f'//*[@id="icerik_{panel.panel_id}"]')
+    texts = {
+      name: browser.find_element(By.XPATH, xpath).text for name, xpath in panel.texts.items()
+    }
+    return table.get_attribute("outerHTML"), texts
+
+
+def fetch_panels(
+  browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver],
+  idx: str,
+  year: int,
+  timeout_patience: int = 5,
+  panels: Dict[str, Panel] = PANELS,
+  policy: Optional[RetryPolicy] = None,
+  lean: bool = False,
+) -> Union[Dict[str, Tuple[str, Dict[str, str]]], bool]:
   """
-  Parse high school table read from HTML
+  Fetch the raw HTML of all panels of a program concurrently
+
+  Every panel after the first is opened in its own tab so the browser loads them
+  in parallel while the first panel loads in the main window. The extra tabs are
+  closed before returning.
 
   Parameters
   ----------
-  df
-    Pandas parses the HTML into a standard DF. Pass it here to make it suitable for
-    the database.
+  browser
+    The webdriver instance to simulate the page visits and get the response
+
+  idx
+    The program id assigned by the Council of Higher Education
+
+  year
+    The year for which the placement data will be crawled
+
+  timeout_patience
+    Timeout patience for waiting a response from the site. Only used when no
+    policy is given, a policy adapts the timeout to the observed latencies instead
+
+  panels
+    The panels to fetch
+
+  policy
+    Retry policy shared across the crawl. Defaults to 3 attempts with backoff
+
+  lean
+    Block the non-essential requests in the panel tabs, for a create_browser(lean=True) browser
 
   Returns
   -------
-  parsed_df
+  pages
+    Mapping of panel names to (html, texts), or False if a panel could not be loaded
   """
-  # Replace no grad symbol to 0
-  df = df[0].replace("---", 0)
-  # Drop the merged title cells in the table
-  df.columns = df.columns.droplevel()
-  if len(df) == 0:
-    # If after the modifications no rows remain the program is empty
-    return df
-  # Remove Toplam row
-  df = df.loc[df['Lise'] != "Toplam"].reset_index(drop=True).fillna(0)
-
-  # Parser func to apply to each row
-  def parser_func(row):
-    hs_name = row["Lise"]
-    # Extract city an districts from the hs name string
-    # definetely needs refactor. very ugly
-    idxx = hs_name[::-1].find("(")
-    location = hs_name[len(hs_name) - idxx:-1]
-    pure_name = hs_name[:len(hs_name) - idxx - 1].strip()
-    location = location.split(" - ")
-    if pure_name == "AÇIK ÖĞRETİM LİSESİ":
-      city = "AÇIK ÖĞRETİM LİSESİ"
-    else:
-      city = location[0]
-    if len(location) > 1:
-      district = location[1]
-    else:
-      district = "MERKEZE BAĞLI TAŞRA"
-
-    out = pd.Series(
-      [
-        pure_name,
-        city,
-        district,
-        row["Lise'den Yeni Mezun"],
-        row["Önceki Mezun"],
-      ],
-      index=['hs', 'hs_city', 'hs_district', 'new_grad', 'old_grad']
-    )
-    return out
+  if policy is None:
+    policy = RetryPolicy(latency=LatencyTracker(initial=timeout_patience))
+  names = list(panels)
+  try:
+    main = browser.current_window_handle
+  except WebDriverException:
+    # E.g. the window was closed by a crash while fetching the previous program
+    policy.record_failure()
+    return False
+  handles = {names[0]: main}
+  started = {}
+  try:
+    # Start loading the other panels in background tabs
+    policy.breaker.wait()
+    try:
+      for name in names[1:]:
+        with stage("navigation", panel=name):
+          browser.switch_to.new_window("tab")
+          handles[name] = browser.current_window_handle
+          if lean:
+            block_resources(browser)
+          browser.execute_script(
+            "window.location.href = arguments[0];", panel_url(idx, year, panels[name].panel_id)
+          )
+        started[name] = time.perf_counter()
+      browser.switch_to.window(main)
+    except WebDriverException:
+      # A tab that cannot be opened fails the program like a panel that does not load
+      policy.record_failure()
+      return False
+
+    pages = {}
+    for i, name in enumerate(names):
+      panel = panels[name]
+      # The main window still shows the previous program, so it is always reloaded
+      reload = i == 0
+      attempts = 0
+      while True:
+        try:
+          browser.switch_to.window(handles[name])
+          if reload:
+            policy.breaker.wait()
+            started[name] = time.perf_counter()
+            with stage("navigation", panel=name):
+              browser.get(panel_url(idx, year, panel.panel_id))
+          pages[name] = extract_panel(browser, panel, policy.timeout)
+          policy.record_success(time.perf_counter() - started[name])
+          break
+        except (TimeoutException, WebDriverException) as e:
+          policy.record_failure()
+          attempts += 1
+          if attempts >= policy.max_attempts:
+            return False
+          if not isinstance(e, TimeoutException) and handles[name] != main:
+            # The tab crashed or is gone, the retry loads the panel in the main
+            # window, which is done with its own panel
+            close_window(browser, handles[name])
+            handles[name] = main
+          reload = True
+          time.sleep(policy.backoff(attempts))
+    return pages
+  finally:
+    for name, handle in handles.items():
+      if handle != main:
+        close_window(browser, handle)
+    try:
+      browser.switch_to.window(main)
+    except WebDriverException:
+      # The next program fails on the missing window instead of the whole crawl
+      pass
+
+
+def close_window(
+  browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver],
+  handle: str,
+):
+  """ Close a browser window or tab, if it still exists """
+  try:
+    browser.switch_to.window(handle)
+    browser.close()
+  except WebDriverException:
+    pass
+
+
+def write_panel(
+  db: CrawlDatabase,
+  panel: Panel,
+  data: Any,
+  idx: str,
+  year: int,
+  digest: Optional[str] = None,
+  replace: bool = False,
+) -> bool:
+  """
+  Write the parsed data of a panel together with its content hash
 
-  df = df.apply(parser_func, axis=1, result_type="expand")
-  return df
+  Parameters
+  ----------
+  db
+    The database to write to
+
+  panel
+    The panel the data belongs to
+
+  data
+    Parsed panel data
+
+  idx
+    The program id assigned by the Council of Higher Education
+
+  year
+    The year of the placement data
+
+  digest
+    Content hash of the raw panel, stored to detect changes on refresh
+
+  replace
+    If set the existing rows of the program are replaced in a single transaction
+
+  Returns
+  -------
+  success
+    Whether all the rows were written
+  """
+  try:
+    with stage("write_panel", panel=panel.name), db.transaction():
+      written = panel.write(db, data, idx, year, replace)
+      if written and digest is not None:
+        written = db.write_panel_hash(idx, year, panel.panel_id, digest)
+      if not written:
+        raise RuntimeError(f"Could not write panel {panel.name}: {idx, year}")
+  except RuntimeError as e:
+    get_file_logger("c_logger", "crawl_operations.log").error(str(e))
+    return False
+  return True
 
 
 def crawl_program(
   browser: Union[webdriver.chrome.webdriver.WebDriver, webdriver.firefox.webdriver.WebDriver],
   idx: str,
   year: int,
-  timeout_patience: int = 5
-) -> Union[Tuple[dict, pd.DataFrame], bool]:
+  timeout_patience: int = 5,
+  panels: Dict[str, Panel] = PANELS,
+  policy: Optional[RetryPolicy] = None,
+  lean: bool = False,
+) -> Union[Dict[str, Any], bool]:
   """
-  Crawl the program page for the rankings and high school placements
+  Crawl the program panels, e.g. the rankings and high school placements
 
   Parameters
   ----------
@@ -225,133 +502,220 @@ def crawl_program(
   timeout_patience
     Timeout patience for waiting a response from the site
 
+  panels
+    The panels to crawl. Defaults to every registered panel
+
+  policy
+    Retry policy shared across the crawl
+
+  lean
+    Whether the browser was created with create_browser(lean=True)
+
   Returns
   -------
-  rankings
-    A dictionary describing the ranking data like total quota, total placed,
-    minimum ranking etc.
-
-  highschool
-    A pandas data frame describing the placement table
+  results
+    Mapping of panel names to the parsed data, e.g. a dictionary describing the
+    ranking data and a pandas data frame describing the high school placements
   """
-  url = URL.format(year=year, program_id=idx,
-                   table_id=tables["ranking"]).replace(f"{datetime.now().year}/", "")
-  
-  attempts = 0
-  while attempts < 3:
-    try:
-      browser.get(url)
-      # Get the university city
-      city = find_element(
-        browser, "/html/body/div[1]/div/div/div[2]/div/h3[1]", timeout_patience=timeout_patience
-      ).text
-      # Regular expression magic
-      city = re.findall(r'\(([^)]+)\)', city)[-1]
-
-      # Get the ranking table
-      table = find_element(
-        browser, f'//*[@id="icerik_{tables["ranking"]}"]', timeout_patience=timeout_patience
-      )
-      # Wait for the table to load
-      find_element(
-        browser, f'//*[@id="icerik_{tables["ranking"]}"]/table', timeout_patience=timeout_patience
-      )
-      break
-    except (TimeoutException, WebDriverException):
-      attempts += 1
-      time.sleep(0.5)
-      continue
-  else:
+  pages = fetch_panels(browser, idx, year, timeout_patience, panels, policy, lean)
+  if pages == False:
     return False
-
-  # Parse the table using pandas so that python can read it
-  df = pd.read_html(StringIO(table.get_attribute("outerHTML")), thousands='.', decimal=',')
   # Parse the tables into useful information
-  rankings = parse_rankings(df, year)
-  rankings.update({"uni_city": city, "year": year})
-
-  # Go to the high schools site
-  url = URL.format(year=year, program_id=idx,
-                   table_id=tables["highschools"]).replace(f"{datetime.now().year}/", "")
-  attempts = 0
-  while attempts < 3:
-    try:
-      browser.get(url)
-
-      # Get the high schools table
-      table = find_element(
-        browser, f'//*[@id="icerik_{tables["highschools"]}"]', timeout_patience=timeout_patience
-      )
-      # Wait for the table to load
-      find_element(
-        browser,
-        f'//*[@id="icerik_{tables["highschools"]}"]/table',
-        timeout_patience=timeout_patience
-      )
-      break
-    except (TimeoutException, WebDriverException):
-      attempts += 1
-      time.sleep(0.5)
-      continue
-  else:
-    return False
-
-  # Parse the table using pandas so that python can read it
-  df = pd.read_html(StringIO(table.get_attribute("outerHTML")))
-  # Parse the tables into useful information
-  highschools = parse_highschools(df)
-  return rankings, highschools
+  return {name: panels[name].parse(html, texts, year) for name, (html, texts) in pages.items()}
 
 
 if __name__ == "__main__":
-  import os
   from pprint import pprint
 
   # Get the command line arguments
   args = parse_arguments()
 
   # Set up logging
-  if not os.path.exists("../logs"):
-    os.mkdir("../logs/")
-  c_logger = logging.getLogger("c_logger")
-  c_logger.setLevel(logging.INFO)
-  c_handler = logging.FileHandler("../logs/crawl_operations.log")
-  c_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-  c_handler.setFormatter(c_formatter)
-  c_logger.addHandler(c_handler)
+  c_logger = get_file_logger("c_logger", "crawl_operations.log")
+  set_base_url(args.base_url)
+  telemetry = configure(args.metrics)
 
   # Create the web driver to crawl
-  options = webdriver.chrome.options.Options()
-  options.add_argument("--headless")
-  browser = webdriver.Chrome(options=options)
+  browser = create_browser(args.lean)
 
   # Connect to the database
   db = CrawlDatabase(args.database)
+  # In spool mode the database is only read to skip the programs crawled before,
+  # the panel hash table and the year files are created when the spool is loaded
+  spool = SpoolWriter(args.spool, args.worker_id) if args.spool is not None else None
+  if spool is None:
+    db.ensure_panel_hashes()
+    # Year files of a partitioned database cannot be created inside the write transactions
+    db.ensure_partitions(args.years)
+
+  # Schedule the program ids, or lease them from the shared work queue
+  leases, total = None, None
+  if args.queue is not None:
+    leases = LeasedTasks(
+      open_queue(args.queue), args.worker_id, args.lease_size, args.lease_ttl, years=args.years
+    )
+    tasks = iter(leases)
+  else:
+    scheduler = Scheduler(db, args.years, include_existing=args.override or args.refresh)
+    scheduler.add(stream_ids(args.program_ids))
+    if args.missing:
+      scheduler.add_missing()
+    c_logger.info(f"Scheduled programs: {scheduler.plan()}")
+    total = len(scheduler)
+    tasks = iter(scheduler)
+
+  # Page load policy shared by the whole crawl
+  policy = RetryPolicy(
+    max_attempts=args.retries,
+    latency=LatencyTracker(initial=args.timeout_patience, maximum=args.max_timeout),
+    breaker=CircuitBreaker(cooldown=args.breaker_cooldown),
+  )
 
-  # Read the program ids
-  with open(args.program_ids, "r") as f:
-    programs = list(map(lambda x: x.strip(), f.readlines()))
-
-  pbar = tqdm(programs)
-  for idx in pbar:
-    if not db.check_existence(idx, args.year) or args.override:
-      results = crawl_program(browser, idx, args.year, args.timeout_patience)
+  def fetch(browser, idx: str, year: int):
+    with stage("fetch"):
+      return fetch_panels(browser, idx, year, args.timeout_patience, policy=policy, lean=args.lean)
+
+  def prepare(idx: str, year: int, pages: dict) -> dict:
+    """ The panels to parse with their content hash """
+    # On refresh only the panels whose content changed are parsed and replaced
+    return changed_panels(pages, db.get_panel_hashes(idx, year) if args.refresh else {})
+
+  def store(idx: str, year: int, parsed: dict) -> bool:
+    """ Write the parsed panels. Returns whether all of them were written """
+    success = True
+    for name, (data, digest) in parsed.items():
+      panel = PANELS[name]
+      if name == "ranking" and args.verbose:
+        pprint(data)
+      replace = args.refresh or args.override
+      if spool is not None:
+        spool.append(panel, data, idx, year, digest, replace=replace)
+      elif not write_panel(db, panel, data, idx, year, digest, replace=replace):
+        success = False
+    if len(parsed) != 0:
+      crawled.append((idx, year))
+    # Also stamps the unchanged panels, so the scheduler refreshes others first
+    if spool is not None:
+      spool.checked(idx, year)
+    elif success:
+      success = db.mark_checked([(idx, year, None)])
+    return success
+
+  def crawl(idx: str, year: int) -> bool:
+    pages = fetch(browser, idx, year)
+    if pages == False:
+      return False
+    jobs = prepare(idx, year, pages)
+    parsed = {
+      name: (PANELS[name].parse(html, texts, year), digest)
+      for name, (html, texts, digest) in jobs.items()
+    }
+    return store(idx, year, parsed)
+
+  def finish(idx: str, year: int, success: bool):
+    if leases is not None:
+      # Failed tasks go back to the queue, so any crawler can retry them
+      if success:
+        leases.done((idx, year))
+      else:
+        c_logger.error(f"Could not crawl, returned to the queue: {idx, year}")
+        leases.failed((idx, year))
+        returned.add((idx, year))
     else:
-      c_logger.error(f"Skipping duplicate: {idx, args.year}")
-      continue
-
-    if results == False:
-      c_logger.error(f"Could not crawl: {idx, args.year}")
-      continue
-    ranking_data, highschool_data = results
-    pprint(ranking_data)
-
-    db.write_university(**ranking_data)
-    db.write_faculty(**ranking_data)
-    db.write_program(**ranking_data)
-    db.write_placement(**ranking_data)
-    if len(highschool_data) != 0:
-      db.write_highschools(highschool_data)
-      db.write_highschool_placements(highschool_data, idx, args.year)
-
+      attempted.add((str(idx), int(year)))
+      if not success:
+        c_logger.error(f"Could not crawl: {idx, year}")
+        dead_letters.append((idx, year))
+    pbar.set_postfix(timeout=f"{policy.timeout:.1f}s", failed=len(dead_letters))
+    if pbar.n % 50 == 0:
+      telemetry.flush()
+
+  def unseen(tasks):
+    """ Skip the programs crawled before, unless they are crawled again """
+    for idx, year in tasks:
+      # A program returned to the queue may have been written in part
+      retry = (idx, year) in returned
+      if not (args.override or args.refresh or retry) and db.check_existence(idx, year):
+        c_logger.error(f"Skipping duplicate: {idx, year}")
+        if leases is not None:
+          leases.done((idx, year))
+        continue
+      yield idx, year
+
+  crawled = []
+  dead_letters = []
+  attempted = set()
+  returned = set()
+  pipeline = None
+  if args.parse_workers != 0:
+    # The browsers fetch, a process pool parses, and this thread picks the tasks and writes
+    browsers = [browser] + [create_browser(args.lean) for _ in range(args.fetchers - 1)]
+    workers = args.parse_workers if args.parse_workers > 0 else None
+    pipeline = CrawlPipeline(browsers, fetch, prepare, workers)
+    pbar = tqdm(total=total)
+    for idx, year, parsed in pipeline.run(unseen(tasks)):
+      success = parsed != False and store(idx, year, parsed)
+      pbar.update()
+      finish(idx, year, success)
+  else:
+    pbar = tqdm(unseen(tasks), total=total)
+    for idx, year in pbar:
+      with stage("program"):
+        success = crawl(idx, year)
+      finish(idx, year, success)
+  pbar.close()
+
+  # Retry the failed programs once the rest of the run is done
+  if len(dead_letters) != 0:
+    c_logger.info(f"Retrying {len(dead_letters)} failed programs")
+    if pipeline is not None:
+      retried, dead_letters = dead_letters, []
+      for idx, year, parsed in tqdm(pipeline.run(retried), total=len(retried)):
+        if parsed == False or not store(idx, year, parsed):
+          dead_letters.append((idx, year))
+    else:
+      dead_letters = [(idx, year) for idx, year in tqdm(dead_letters) if not crawl(idx, year)]
+    for idx, year in dead_letters:
+      c_logger.error(f"Could not crawl after retry: {idx, year}")
+
+  # Keep the remaining failures for a later run, together with the earlier
+  # failures this run did not try again. The programs that succeeded now are
+  # dropped, so the scheduler does not put them last
+  if leases is None:
+    for year in args.years:
+      dead_letter_path = os.path.join(LOG_DIR, f"dead_letters_{year}.txt")
+      failed = []
+      if os.path.exists(dead_letter_path):
+        failed = [
+          idx for idx in stream_ids([dead_letter_path]) if (idx, int(year)) not in attempted
+        ]
+      failed += [str(idx) for idx, failed_year in dead_letters if failed_year == year]
+      failed = list(dict.fromkeys(failed))
+      if len(failed) != 0:
+        with open(dead_letter_path, "w") as f:
+          f.writelines(f"{idx}\n" for idx in failed)
+      elif os.path.exists(dead_letter_path):
+        os.remove(dead_letter_path)
+
+  if pipeline is not None:
+    pipeline.close()
+    for extra in browsers[1:]:
+      extra.close()
   browser.close()
+  if leases is not None:
+    c_logger.info(f"Work queue progress: {leases.progress()}")
+
+  # Rescore only the high schools touched by this run. Spooled programs are
+  # scored when the spool is loaded
+  if spool is not None:
+    spool.close()
+    c_logger.info(f"Spooled {len(crawled)} programs to {spool.path}")
+  elif len(crawled) != 0:
+    with stage("score_highschools"):
+      db.score_highschools(crawled)
+
+  # End of run summary of where the crawl time went
+  summary = telemetry.format_summary()
+  print(summary)
+  c_logger.info("Stage timings:\n" + summary)
+  telemetry.close()
@@ -1,15 +1,67 @@
 import os
+import time
+import tempfile
 import pandas as pd
 import streamlit as st
-from typing import Union
+from typing import Optional, Union
 from yaml import full_load
-from database import CrawlDatabase
+from database import (
+  HS_KEYS, UNI_KEYS, QueryProfiler, cascade_options, serving_options
+)
+from dashboard_database import DashboardDatabase, cache_stats
+from service import DatabasePool
+from result_store import ResultStore, filter_key
+from export import EXPORT_FORMATS, export_chart_data
 
 
 @st.cache_resource
-def get_database_session(path: Union[str, os.PathLike]):
-  """ Create a database session object that points to the URL. """
-  return CrawlDatabase(path)
+def get_database_session(
+  path: Union[str, os.PathLike],
+  slow_query_seconds: float = 0.5,
+  read_only: bool = False,
+  mmap_mb: float = 0,
+  page_cache_mb: Optional[float] = None,
+):
+  """ Create a database session object that points to the URL. Pre-warms a read-only snapshot """
+  db = DashboardDatabase(
+    path,
+    QueryProfiler(slow_threshold=slow_query_seconds),
+    read_only=read_only,
+    mmap_mb=mmap_mb,
+    page_cache_mb=page_cache_mb,
+  )
+  if read_only:
+    db.prewarm()
+  return db
+
+
+@st.cache_resource
+def get_result_store(max_mb: float = 512) -> ResultStore:
+  """ Result frames shared by every session of the server """
+  return ResultStore(max_bytes=int(max_mb * 2**20))
+
+
+@st.cache_resource
+def get_initial_options(_db: DashboardDatabase) -> dict:
+  """ Unfiltered options of every filter, shared by the sessions until they narrow them down """
+  uni_data = _db.get_uni_filter_data()
+  hs_data = _db.get_hs_filter_data()
+  options = {f"{k}_options": sorted(pd.unique(uni_data[k])) for k in UNI_KEYS}
+  options.update({f"{k}_options": sorted(pd.unique(hs_data[k])) for k in HS_KEYS})
+  return options
+
+
+@st.cache_resource
+def get_export_pool(
+  path: Union[str, os.PathLike],
+  read_only: bool = False,
+  mmap_mb: float = 0,
+  page_cache_mb: Optional[float] = None,
+) -> DatabasePool:
+  """ Handles of the exports, the session handle must not hold an open cursor """
+  return DatabasePool(
+    path, size=2, read_only=read_only, mmap_mb=mmap_mb, page_cache_mb=page_cache_mb
+  )
 
 
 @st.cache_data
@@ -27,10 +79,7 @@ def filter_selections(key: str):
     data = hs_data
     keys = "hs_keys"
 
-  idx = ss[keys].index(key) + 1
-  for k in ss[keys][idx:]:
-    if len(ss[key]) != 0:
-      ss["options"][f"{k}_options"] = pd.unique(data.loc[data[key].isin(ss[key]), k])
+  ss["options"].update(cascade_options(data, ss[keys], key, ss[key]))
 
 
 def proper_string(text: str) -> str:
@@ -60,23 +109,81 @@ def proper_string(text: str) -> str:
   return ' '.join(capitalized_words)
 
 
+def export_panel(pool: DatabasePool, filters: dict):
+  """
+  Export of the filtered data. The rows are streamed from the database into a
+  temporary file instead of serializing the frame of the table, but the
+  download button reads the whole file into memory to serve it. The button is
+  only shown in the run that prepared the file and the file is not kept in the
+  session state, so idle sessions hold no export
+  """
+  c1, c2 = st.columns([1, 3])
+  fmt = c1.selectbox("Format", EXPORT_FORMATS, label_visibility="collapsed")
+  if c2.button("Prepare export"):
+    with st.spinner("Exporting..."):
+      with tempfile.NamedTemporaryFile(suffix=f".{fmt}", delete=False) as f:
+        export_path = f.name
+      try:
+        with pool.connection() as export_db:
+          export_chart_data(export_db, export_path, filters, fmt)
+        with open(export_path, "rb") as f:
+          st.download_button(
+            f"Download {fmt.upper()}",
+            data=f,
+            file_name=f"atlas_crawl.{fmt}",
+            mime="text/csv" if fmt == "csv" else "application/octet-stream"
+          )
+      finally:
+        os.remove(export_path)
+
+
+def debug_panel(db: DashboardDatabase, store: ResultStore, run_start: float):
+  """ Hidden profiling panel, shown by opening the dashboard with ?debug=1 """
+  stats = store.stats()
+  with st.expander("Query profiling", expanded=True):
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Script run so far", f"{time.perf_counter() - run_start:.2f} s")
+    if "last_filter" in ss:
+      c2.metric("Last filter: query", f"{ss['last_filter']['query']:.2f} s")
+      c3.metric("Shared results", f"{stats['frames']} frames")
+    st.write("Cached queries")
+    st.dataframe(cache_stats())
+    st.write(
+      f"Shared results: {stats['bytes'] / 2**20:.1f} of {store.max_bytes / 2**20:.0f} MB, "
+      + ", ".join(f"{k} {stats[k]}" for k in ["hits", "misses", "evictions"])
+    )
+    st.dataframe(store.frame(), use_container_width=True)
+    st.write("Recent queries")
+    queries = db.profiler.frame()
+    if len(queries) != 0:
+      st.dataframe(
+        queries[[
+          "time", "kind", "seconds", "sql_seconds", "materialize_seconds", "rows", "slow",
+          "query", "plan"
+        ]],
+        use_container_width=True
+      )
+
+
 if __name__ == "__main__":
+  run_start = time.perf_counter()
   st.set_page_config(layout="wide", page_title="Atlas Crawl 🧭")
   st.title("Atlas Crawl 🧭")
   ss = st.session_state
   config = get_config("configs.yaml")
-  db = get_database_session(config["db_path"])
+  db = get_database_session(
+    config["db_path"], config.get("slow_query_seconds", 0.5), **serving_options(config)
+  )
+  store = get_result_store(config.get("result_store_mb", 512))
 
   uni_data = db.get_uni_filter_data()
   hs_data = db.get_hs_filter_data()
 
   if "options" not in ss:
-    ss["hs_keys"] = ["hs_city", "hs_district", "hs_name"]
-    ss["uni_keys"] = [
-      "uni_type", "uni_city", "uni_name", "fac_name", "prog_type", "program", "scholarship"
-    ]
-    ss["options"] = {f"{k}_options": sorted(pd.unique(uni_data[k])) for k in ss["uni_keys"]}
-    ss["options"].update({f"{k}_options": sorted(pd.unique(hs_data[k])) for k in ss["hs_keys"]})
+    ss["hs_keys"] = HS_KEYS
+    ss["uni_keys"] = UNI_KEYS
+    # A shallow copy: the option lists are shared, filter_selections replaces them
+    ss["options"] = dict(get_initial_options(db))
 
   s = 0.3
   filter_col, data_col = st.columns([s, 1 - s])
@@ -202,24 +309,37 @@ if __name__ == "__main__":
   if submitted:
     with data_col:
       with st.spinner("Loading data..."):
-        df = db.get_chart_data()
-        df = df[df["year"].isin(list(range(start_year, end_year + 1)))]
-        ss["df"] = df
+        start = time.perf_counter()
+        filters = {k: ss[k] for k in ss["hs_keys"] + ss["uni_keys"]}
+        filters["year"] = list(range(start_year, end_year + 1))
+        result = store.get(filter_key(filters), lambda: db.get_chart_data(filters))
+        # Release the previous result only after acquiring the new one, the same
+        # query must not be evicted in between
+        if "result" in ss:
+          ss["result"].release()
+        ss["result"] = result
+        ss["filters"] = filters
+        ss["last_filter"] = {"query": time.perf_counter() - start}
       st.success("Done.")
 
   with data_col:
     table, charts = st.tabs(["Table", "Charts"])
     with table:
-      if "df" in ss:
+      if "result" in ss:
+        # Shared with other sessions, read only
+        df = ss["result"].frame
         c1, c2, c3, c4 = st.columns(4)
-        c1.metric("Universities", value=f"🏛️ {len(pd.unique(ss['df']['uni_name']))}")
-        c2.metric(
-          "Programs", value=f"📓 {len(ss['df'].drop_duplicates(subset=['program', 'scholarship']))}"
-        )
-        c3.metric("High Schools", value=f"🎒 {len(pd.unique(ss['df']['hs_name']))}")
-        c4.metric("Graduates", value=f"🎓 {(ss['df']['old_grad'] + ss['df']['new_grad']).sum()}")
+        c1.metric("Universities", value=f"🏛️ {len(pd.unique(df['uni_name']))}")
+        programs = df.drop_duplicates(subset=["program", "scholarship"])
+        c2.metric("Programs", value=f"📓 {len(programs)}")
+        c3.metric("High Schools", value=f"🎒 {len(pd.unique(df['hs_name']))}")
+        c4.metric("Graduates", value=f"🎓 {(df['old_grad'] + df['new_grad']).sum()}")
         st.dataframe(
-          ss["df"],
+          df,
           height=1000,
           column_config={"year": st.column_config.NumberColumn("Year", format="%d")}
         )
+        export_panel(get_export_pool(config["db_path"], **serving_options(config)), ss["filters"])
+
+  if st.experimental_get_query_params().get("debug") == ["1"]:
+    debug_panel(db, store, run_start)
@@ -0,0 +1,55 @@
+import threading
+import pandas as pd
+import streamlit as st
+from database import CrawlDatabase
+
+# Calls and cache misses of the cached queries, shown in the debug panel. The
+# st.cache_data caches are shared by every session, and so are these counters.
+CACHE_STATS = {
+  "get_hs_filter_data": {"calls": 0, "misses": 0},
+  "get_uni_filter_data": {"calls": 0, "misses": 0},
+}
+# The sessions run in threads of their own, += on the counters is not atomic
+CACHE_STATS_LOCK = threading.Lock()
+
+
+def _count(query: str, counter: str):
+  with CACHE_STATS_LOCK:
+    CACHE_STATS[query][counter] += 1
+
+
+@st.cache_data
+def _get_hs_filter_data(_db: CrawlDatabase) -> pd.DataFrame:
+  _count("get_hs_filter_data", "misses")
+  return CrawlDatabase.get_hs_filter_data(_db)
+
+
+@st.cache_data
+def _get_uni_filter_data(_db: CrawlDatabase) -> pd.DataFrame:
+  _count("get_uni_filter_data", "misses")
+  return CrawlDatabase.get_uni_filter_data(_db)
+
+
+def cache_stats() -> pd.DataFrame:
+  """ Hit rates of the cached queries """
+  with CACHE_STATS_LOCK:
+    df = pd.DataFrame.from_dict(CACHE_STATS, orient="index")
+  df["hit_rate"] = 1 - df["misses"] / df["calls"].clip(lower=1)
+  return df
+
+
+class DashboardDatabase(CrawlDatabase):
+  """
+  Thin streamlit adapter over CrawlDatabase.
+
+  The filter metadata rarely changes, so it is cached with st.cache_data to avoid
+  re-querying the database on every script rerun. Only the dashboard imports this
+  module; the crawler and the test scripts use CrawlDatabase directly.
+  """
+  def get_hs_filter_data(self) -> pd.DataFrame:
+    _count("get_hs_filter_data", "calls")
+    return _get_hs_filter_data(self)
+
+  def get_uni_filter_data(self) -> pd.DataFrame:
+    _count("get_uni_filter_data", "calls")
+    return _get_uni_filter_data(self)
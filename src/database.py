@@ -1,24 +1,162 @@
 import os
 import time
-import logging
+import random
 import pandas as pd
 import sqlite3 as sl
-import streamlit as st
-from typing import Union, Dict, Any
+from datetime import datetime
+from collections import deque
+from urllib.parse import quote
+from contextlib import contextmanager
+from typing import Union, Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+from log_utils import get_file_logger
+from telemetry import timed
 
-# Set up logging
-if not os.path.exists("../logs"):
-  os.mkdir("../logs")
-db_logger = logging.getLogger("db_logger")
-db_logger.setLevel(logging.INFO)
-db_handler = logging.FileHandler("../logs/db_operations.log")
-db_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-db_handler.setFormatter(db_formatter)
-db_logger.addHandler(db_handler)
 
+def db_logger():
+  """ Logger for database operations. The log file is only created on first use """
+  return get_file_logger("db_logger", "db_operations.log")
 
-def wrap_quotes(x):
-  return "'" + str(x) + "'"
+
+def serving_options(config: dict) -> dict:
+  """ CrawlDatabase options of the dashboard and the query service, from configs.yaml """
+  return {
+    "read_only": config.get("read_only", False),
+    "mmap_mb": config.get("mmap_mb", 0),
+    "page_cache_mb": config.get("page_cache_mb"),
+  }
+
+
+def cascade_options(data: pd.DataFrame, keys: List[str], key: str, selection: list) -> dict:
+  """
+  Narrow down the options of the filters that come after `key` to the rows of
+  `data` matching its selection. Returns nothing for an empty selection.
+  """
+  if len(selection) == 0:
+    return {}
+  rows = data.loc[data[key].isin(selection)]
+  idx = keys.index(key) + 1
+  return {f"{k}_options": pd.unique(rows[k]) for k in keys[idx:]}
+
+
+class QueryProfiler:
+  """
+  Latency log of the queries run through a CrawlDatabase
+
+  Keeps the most recent queries with their SQL execution time, the time spent
+  building the pandas DataFrame and the number of rows. Queries slower than the
+  threshold are written to ../logs/slow_queries.log, together with their
+  EXPLAIN QUERY PLAN if explain is set.
+
+  Parameters
+  ----------
+  slow_threshold
+    Seconds after which a query counts as slow
+
+  explain
+    Capture the query plan of slow read queries
+
+  history
+    Number of recent queries to keep
+  """
+  def __init__(self, slow_threshold: float = 0.5, explain: bool = True, history: int = 500):
+    self.slow_threshold = slow_threshold
+    self.explain = explain
+    self.records = deque(maxlen=history)
+
+  def record(
+    self,
+    conn: sl.Connection,
+    kind: str,
+    query: str,
+    args: Any,
+    sql_seconds: float,
+    materialize_seconds: float = 0.0,
+    rows: Optional[int] = None,
+  ):
+    seconds = sql_seconds + materialize_seconds
+    record = {
+      "time": datetime.now(),
+      "kind": kind,
+      "query": " ".join(query.split()),
+      "seconds": seconds,
+      "sql_seconds": sql_seconds,
+      "materialize_seconds": materialize_seconds,
+      "rows": rows,
+      "slow": seconds >= self.slow_threshold,
+      "plan": None,
+    }
+    if record["slow"]:
+      if self.explain and kind == "read":
+        try:
+          plan = conn.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+          record["plan"] = "\n".join(row[-1] for row in plan)
+        except sl.Error:
+          pass
+      get_file_logger("slow_query", "slow_queries.log").warning(
+        f"{kind} query took {seconds:.3f}s (sql {sql_seconds:.3f}s, "
+        f"dataframe {materialize_seconds:.3f}s, rows {rows}): {record['query']}"
+        + (f"\nPlan:\n{record['plan']}" if record["plan"] else "")
+      )
+    self.records.append(record)
+
+  def frame(self) -> pd.DataFrame:
+    """ Recent queries, newest first """
+    return pd.DataFrame(list(reversed(self.records)))
+
+
+# Columns of get_chart_data, keyed by their alias in the returned frame
+CHART_COLUMNS = {
+  "uni_name": "u.UniversityName",
+  "uni_type": "u.UniversityType",
+  "uni_city": "u.UniversityCity",
+  "fac_name": "f.FacultyName",
+  "program": "p.ProgramName",
+  "scholarship": "p.ScholarshipType",
+  "prog_type": "p.ProgramType",
+  "year": "pd.Year",
+  "total_quota": "pd.TotalQuota",
+  "total_placed": "pd.TotalPlaced",
+  "min_ranking": "pd.MinimumRanking",
+  "max_ranking": "pd.MaximumRanking",
+  "hs_name": "hs.HighSchoolName",
+  "hs_city": "hs.City",
+  "hs_district": "hs.District",
+  "score": "hs.Score",
+  "new_grad": "hsp.NumberOfNewGrads",
+  "old_grad": "hsp.NumberOfOldGrads",
+}
+
+# Filter columns of get_hs_filter_data and get_uni_filter_data, in the order the
+# dashboard filters narrow each other down
+HS_KEYS = ["hs_city", "hs_district", "hs_name"]
+UNI_KEYS = ["uni_type", "uni_city", "uni_name", "fac_name", "prog_type", "program", "scholarship"]
+
+# The {facts} placeholder is the schema of the placement tables, see CrawlDatabase.facts
+CHART_JOINS = """
+      University u
+      JOIN Faculty f ON f.UniversityID = u.UniversityID
+      JOIN Program p ON p.FacultyID = f.FacultyID
+      JOIN {facts}PlacementData pd ON pd.ProgramID = p.ProgramID
+      JOIN {facts}HighSchoolPlacement hsp ON hsp.ProgramID = p.ProgramID AND hsp.Year = pd.Year
+      JOIN HighSchool hs ON hs.HighSchoolID = hsp.HighSchoolID
+"""
+
+# Tables holding the rows of a single year, split into one file per year in the
+# partitioned layout
+FACT_TABLES = ("PlacementData", "HighSchoolPlacement", "PanelHash")
+
+# Tables read by the dashboard queries, whose pages are loaded by prewarm()
+HOT_TABLES = (
+  "University", "Faculty", "Program", "PlacementData", "HighSchool", "HighSchoolPlacement"
+)
+
+# Year files of a partitioned database, see CrawlDatabase
+PARTITION_TABLE = """
+CREATE TABLE YearPartition (
+  Year INTEGER PRIMARY KEY,
+  Frozen INTEGER NOT NULL DEFAULT 0
+)
+"""
 
 
 class CrawlDatabase:
@@ -28,27 +166,109 @@ class CrawlDatabase:
   Can run queries to populate the database with crawl data or can request data with
   pre-determined queries. Exposes the dataset cursor for custom queries.
 
-  _get_ functions are cached for performance in streamlit engine
+  This module has no UI dependencies so that the crawler and the test scripts stay
+  lightweight. The dashboard uses the cached adapter in dashboard_database.py
 
   Parameters
   ----------
   db_path
     Path to the database file.
 
+  profiler
+    Query profiler recording the latency of every query. A default one is created
+    if not given
+
+  read_only
+    Open the database files read-only and immutable, for serving a snapshot made
+    with snapshot(). SQLite then skips file locking and change detection, so the
+    files must not be written while they are open
+
+  mmap_mb
+    Memory-mapped I/O limit per database file. 0 keeps the SQLite default
+
+  page_cache_mb
+    Page cache size per database file. None keeps the SQLite default
+
+  Attributes
+  ----------
+  dimension_cache
+    Rows of the University, Faculty, Program and HighSchool tables written through
+    this handle, keyed by their unique key. Writing the same row again, e.g. for
+    another year of a program, is skipped without a query
+
+  partitions
+    Attached year files of a partitioned database, mapped to whether the year is
+    frozen. Empty for a single file database
+
+  Notes
+  -----
+  In the partitioned layout the database file only holds the university, faculty,
+  program and high school tables, while the FACT_TABLES rows of every year live in
+  a file of their own next to it, e.g. crawl_database.2023.db. The year files are
+  attached on open and the FACT_TABLES names refer to temporary views over all of
+  them, so reading queries work on both layouts. Writes go to the file of their
+  year, see facts(). Frozen years are attached read-only.
+
   Raises
   ------
   FileNotFoundError
     If the pointed database path does not exists, raises this error
   """
-  def __init__(self, db_path: Union[str, os.PathLike]):
+  def __init__(
+    self,
+    db_path: Union[str, os.PathLike],
+    profiler: Optional[QueryProfiler] = None,
+    read_only: bool = False,
+    mmap_mb: float = 0,
+    page_cache_mb: Optional[float] = None,
+  ):
     self.path = db_path
-    if self.path == ":memory:" or os.path.exists(self.path):
-      self.conn = sl.connect(self.path, check_same_thread=False)
-    else:
+    self.profiler = profiler if profiler is not None else QueryProfiler()
+    self.read_only = read_only
+    self.mmap_mb = mmap_mb
+    self.page_cache_mb = page_cache_mb
+    if self.path != ":memory:" and not os.path.exists(self.path):
       raise FileNotFoundError(f"Pointed database file {self.path} does not exists!")
+    self.in_transaction = False
+    self.dimension_cache = {
+      table: {} for table in ["University", "Faculty", "Program", "HighSchool"]
+    }
+    # A snapshot opened while snapshot() replaces its files may combine files of
+    # two snapshots, it is opened again once the main file is in place
+    for attempt in range(6):
+      self.connect()
+      if self.snapshot_matches():
+        break
+      self.conn.close()
+      time.sleep(0.1 * 2**attempt)
+    else:
+      raise sl.DatabaseError(f"The files of {self.path} belong to different snapshots")
+
+  def connect(self):
+    """ Open the database file and attach its year files """
+    self.conn = sl.connect(
+      self.file_uri(self.path) if self.read_only else self.path, check_same_thread=False, uri=True
+    )
+    self.tune("main")
+    self.partitioned = self.conn.execute(
+      "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'YearPartition'"
+    ).fetchone()[0] == 1
+    self.partitions: Dict[int, bool] = {}
+    if self.partitioned:
+      self.attach_partitions()
+
+  def snapshot_matches(self) -> bool:
+    """ Whether the attached year files were published by the same snapshot() as the main file """
+    snapshot_id = self.conn.execute("PRAGMA main.user_version").fetchone()[0]
+    return snapshot_id == 0 or all(
+      self.conn.execute(f"PRAGMA y{year}.user_version").fetchone()[0] == snapshot_id
+      for year in self.partitions
+    )
 
   @classmethod
-  def create_from_schema(cls, *, schema: str, path: Union[str, os.PathLike]):
+  def create_from_schema(
+    cls, *, schema: str, path: Union[str, os.PathLike], partitioned: bool = False
+  ):
     """
     Create database that supports foreign keys from a schema.
 
@@ -58,6 +278,9 @@ class CrawlDatabase:
       SQL schema to define the database structure.
     path
       Path to save the database.
+    partitioned
+      Use the partitioned layout, the rows of each year are written to a file
+      of their own
 
     Returns
     -------
@@ -80,51 +303,362 @@ class CrawlDatabase:
     # original table
     curr.execute("""PRAGMA foreign_keys = ON;""")
     curr.executescript(schema)
+    if partitioned:
+      curr.execute(PARTITION_TABLE)
     conn.commit()
     conn.close()
 
     print("Database is successfully created!")
     return cls(path)
 
+  def partition_path(self, year: int, path: Optional[Union[str, os.PathLike]] = None) -> str:
+    """ Path of the year file of the partitioned layout, next to this database by default """
+    root, ext = os.path.splitext(self.path if path is None else path)
+    return f"{root}.{int(year)}{ext or '.db'}"
+
+  def file_uri(self, path: Union[str, os.PathLike], frozen: bool = False) -> str:
+    """ URI to open a database file with, read-only for frozen years and in read_only mode """
+    uri = f"file:{quote(os.path.abspath(path))}"
+    if self.read_only:
+      return uri + "?mode=ro&immutable=1"
+    return uri + "?mode=ro" if frozen else uri
+
+  def tune(self, schema: str):
+    """ Apply the mmap and page cache sizes to an opened or attached database file """
+    if self.mmap_mb:
+      self.conn.execute(f"PRAGMA {schema}.mmap_size = {int(self.mmap_mb * 2**20)}")
+    if self.page_cache_mb is not None:
+      # Negative sizes are in KiB instead of pages
+      self.conn.execute(f"PRAGMA {schema}.cache_size = {-int(self.page_cache_mb * 2**10)}")
+
+  def attach_partitions(self):
+    """ Attach the year files listed in the YearPartition table and create the views over them """
+    partitions = self.conn.execute("SELECT Year, Frozen FROM YearPartition ORDER BY Year")
+    for year, frozen in partitions.fetchall():
+      if year in self.partitions:
+        continue
+      path = os.path.abspath(self.partition_path(year))
+      if not os.path.exists(path):
+        raise FileNotFoundError(f"Year file {path} of {self.path} does not exists!")
+      # A frozen year is opened read-only, nothing can change it by accident
+      self.conn.execute("ATTACH DATABASE ? AS ?", (self.file_uri(path, frozen), f"y{year}"))
+      self.tune(f"y{year}")
+      self.partitions[year] = bool(frozen)
+    self.create_fact_views()
+
+  def create_fact_views(self):
+    """
+    Temporary views named like FACT_TABLES over the attached year files
+
+    The views have the columns of the tables in the main file. Columns added
+    after a year was frozen are NULL for that year.
+    """
+    for table in FACT_TABLES:
+      self.conn.execute(f"DROP VIEW IF EXISTS temp.{table}")
+      if len(self.partitions) == 0:
+        continue
+      columns = [row[1] for row in self.conn.execute(f"PRAGMA main.table_info({table})")]
+      selects = []
+      for year in sorted(self.partitions):
+        present = {row[1] for row in self.conn.execute(f"PRAGMA y{year}.table_info({table})")}
+        selects.append(
+          "SELECT "
+          + ", ".join(column if column in present else f"NULL AS {column}" for column in columns)
+          + f" FROM y{year}.{table}"
+        )
+      self.conn.execute(f"CREATE TEMP VIEW {table} AS " + " UNION ALL ".join(selects))
+
+  def ensure_partitions(self, years: Iterable[int]):
+    """
+    Create and attach the files of the years that do not have one yet.
+
+    Files cannot be attached inside a transaction, call this before writing the
+    rows of new years. Does nothing for a single file database.
+    """
+    years = sorted(set(int(year) for year in years) - set(self.partitions))
+    if not self.partitioned or len(years) == 0:
+      return
+    # The empty tables of the main file are the schema of the year files
+    schema = [
+      row[0] for row in self.conn.execute(
+        f"""
+        SELECT sql FROM main.sqlite_master
+        WHERE type = 'table' AND name IN ({", ".join(["?"] * len(FACT_TABLES))})
+        """, FACT_TABLES
+      )
+    ]
+    for year in years:
+      path = self.partition_path(year)
+      if not os.path.exists(path):
+        conn = sl.connect(path)
+        for statement in schema:
+          conn.execute(statement)
+        conn.commit()
+        conn.close()
+      self.conn.execute("INSERT OR IGNORE INTO YearPartition (Year) VALUES (?)", (year, ))
+    self.conn.commit()
+    self.attach_partitions()
+
+  def facts(self, year: int) -> str:
+    """
+    Schema prefix of the FACT_TABLES to write the rows of a year into, e.g. y2023.
+
+    Empty for a single file database. The views over the year files cannot be
+    written to.
+    """
+    if not self.partitioned:
+      return ""
+    year = int(year)
+    if year not in self.partitions:
+      if self.conn.in_transaction:
+        raise RuntimeError(
+          f"No file for year {year}, call ensure_partitions before the transaction"
+        )
+      self.ensure_partitions([year])
+    if self.partitions[year]:
+      raise RuntimeError(f"Year {year} is frozen")
+    return f"y{year}."
+
+  def freeze_partition(self, year: int):
+    """ Compact the file of a finished year and attach it read-only from now on """
+    year = int(year)
+    if year not in self.partitions:
+      raise KeyError(f"No file for year {year}")
+    if not self.partitions[year]:
+      self.conn.execute(f"VACUUM y{year}")
+      self.conn.execute("UPDATE YearPartition SET Frozen = 1 WHERE Year = ?", (year, ))
+      self.conn.commit()
+      self.conn.execute(f"DETACH DATABASE y{year}")
+      del self.partitions[year]
+      self.attach_partitions()
+
+  def split_years(self) -> Dict[int, int]:
+    """
+    Convert a single file database to the partitioned layout
+
+    The FACT_TABLES rows are moved into a file per year and the main file is
+    vacuumed. Returns the number of placement rows per year.
+    """
+    if self.partitioned:
+      raise RuntimeError(f"{self.path} is already partitioned")
+    self.ensure_panel_hashes()
+    years = [
+      row[0] for row in self.conn.execute(
+        " UNION ".join(f"SELECT DISTINCT Year FROM {table}" for table in FACT_TABLES)
+        + " ORDER BY 1"
+      )
+    ]
+    self.conn.execute(PARTITION_TABLE)
+    self.conn.commit()
+    self.partitioned = True
+    self.ensure_partitions(years)
+    counts = {}
+    for year in years:
+      for table in FACT_TABLES:
+        self.conn.execute(
+          f"INSERT INTO y{year}.{table} SELECT * FROM main.{table} WHERE Year = ?", (year, )
+        )
+      counts[year] = self.conn.execute(
+        f"SELECT COUNT(*) FROM y{year}.HighSchoolPlacement"
+      ).fetchone()[0]
+    for table in FACT_TABLES:
+      self.conn.execute(f"DELETE FROM main.{table}")
+    self.conn.commit()
+    self.conn.execute("VACUUM main")
+    return counts
+
+  def data_version(self) -> Tuple[int, ...]:
+    """
+    PRAGMA data_version of every database file. Changes when another connection
+    commits to one of them, the commits of this connection do not change it
+    """
+    schemas = ["main"] + [f"y{year}" for year in sorted(self.partitions)]
+    return tuple(
+      self.conn.execute(f"PRAGMA {schema}.data_version").fetchone()[0] for schema in schemas
+    )
+
+  def prewarm(self) -> int:
+    """
+    Read every page of the HOT_TABLES and their indexes in all database files
+
+    Meant for a read-only server at startup, so that the first queries are
+    answered from memory instead of waiting for the disk. Returns the number of
+    tables and indexes read.
+    """
+    count = 0
+    for schema in ["main"] + [f"y{year}" for year in sorted(self.partitions)]:
+      btrees = self.conn.execute(
+        f"""
+        SELECT type, name, tbl_name FROM {schema}.sqlite_master
+        WHERE type IN ('table', 'index') AND tbl_name IN ({", ".join(["?"] * len(HOT_TABLES))})
+        """, HOT_TABLES
+      ).fetchall()
+      for kind, name, table in btrees:
+        # COUNT(*) walks all pages of the table or index it is pinned to
+        pin = "NOT INDEXED" if kind == "table" else f"INDEXED BY {name}"
+        self.conn.execute(f"SELECT COUNT(*) FROM {schema}.{table} {pin}").fetchone()
+        count += 1
+    return count
+
+  def snapshot(self, path: Union[str, os.PathLike]) -> List[str]:
+    """
+    Publish a compacted and checked copy of the database for read-only serving
+
+    Every file, including the year files of a partitioned database, is copied
+    with VACUUM INTO, stamped with the same random snapshot id in its
+    user_version and verified with PRAGMA quick_check. The copies are written
+    next to the target and moved in place when all are done, the main file
+    last. A CrawlDatabase opened in the meantime finds year files whose id does
+    not match the main file and opens them again, so it never combines the
+    files of two snapshots. Servers that have the previous snapshot open keep
+    reading it until they are restarted. Returns the written files.
+
+    The copies are not analyzed. With sqlite_stat1 statistics the planner drives
+    the chart join from HighSchool instead of scanning HighSchoolPlacement, which
+    made the chart queries 15 to 30 times slower.
+    """
+    files = [(f"y{year}", self.partition_path(year, path)) for year in sorted(self.partitions)]
+    files.append(("main", str(path)))
+    # 0 is the user_version of a database that is not a snapshot
+    snapshot_id = random.randint(1, 2**31 - 1)
+    for schema, target in files:
+      if os.path.exists(target + ".tmp"):
+        os.remove(target + ".tmp")
+      self.conn.execute(f"VACUUM {schema} INTO ?", (target + ".tmp", ))
+      conn = sl.connect(target + ".tmp")
+      conn.execute(f"PRAGMA user_version = {snapshot_id}")
+      conn.commit()
+      check = conn.execute("PRAGMA quick_check").fetchall()
+      conn.close()
+      if check != [("ok", )]:
+        raise sl.DatabaseError(
+          f"Snapshot file {target}.tmp failed the integrity check: {check[:5]}"
+        )
+    for _, target in files:
+      os.replace(target + ".tmp", target)
+    return [target for _, target in files]
+
   def query(self, query_str: str, query_args: tuple = ()):
     """ Exposed API for running custom queries. Mostly used for testing """
+    start = time.perf_counter()
     if "select" in query_str.lower():
-      results = pd.read_sql(query_str, self.conn, params=query_args)
+      cursor = self.conn.execute(query_str, query_args)
+      rows = cursor.fetchall()
+      fetched = time.perf_counter()
+      results = pd.DataFrame.from_records(
+        rows, columns=[column[0] for column in cursor.description], coerce_float=True
+      )
+      self.profiler.record(
+        self.conn, "read", query_str, query_args, fetched - start,
+        time.perf_counter() - fetched, len(results)
+      )
       return results
     else:
       cursor = self.conn.cursor()
       cursor.execute(query_str, query_args)
       self.conn.commit()
+      self.profiler.record(
+        self.conn, "write", query_str, query_args, time.perf_counter() - start,
+        rows=cursor.rowcount
+      )
+
+  @contextmanager
+  def transaction(self):
+    """
+    Group writes into a single transaction.
+
+    thread_safe_write does not commit inside the block. The writes are committed
+    together when the block exits, or rolled back if it raises.
+    """
+    self.in_transaction = True
+    try:
+      yield self
+      self.conn.commit()
+    except Exception:
+      self.conn.rollback()
+      # The cache may hold rows of the rolled back transaction
+      self.clear_dimension_cache()
+      raise
+    finally:
+      self.in_transaction = False
+
+  def clear_dimension_cache(self):
+    for rows in self.dimension_cache.values():
+      rows.clear()
+
+  def cached_write(
+    self, table: str, key: Any, values: Any, replace: bool, query: str, *args
+  ) -> bool:
+    """
+    thread_safe_write that skips rows already written through this handle.
+
+    Without replace an existing key is enough to skip the insert, with replace the
+    row is only skipped if it was written with the same values.
+    """
+    cache = self.dimension_cache[table]
+    if key in cache and (not replace or cache[key] == values):
+      return True
+    written = self.thread_safe_write(query, *args, replace=replace)
+    if written:
+      cache[key] = values
+    return written
+
+  def thread_safe_write(self, query: str, *args, replace: bool = False) -> bool:
+    """
+    Run a write query, retrying on errors such as a locked database.
 
-  def thread_safe_write(self, query: str, *args) -> bool:
+    A plain insert that hits a UNIQUE constraint counts as written, the row is
+    already there. With replace the query is meant to overwrite or update rows,
+    so a UNIQUE error is a failed write.
+    """
     cursor = self.conn.cursor()
     attempts = 0
     while attempts < 5:
       try:
+        start = time.perf_counter()
         cursor.execute(query, *args)
-        self.conn.commit()
+        if not self.in_transaction:
+          self.conn.commit()
+        self.profiler.record(
+          self.conn, "write", query, args, time.perf_counter() - start, rows=cursor.rowcount
+        )
         return True
       except sl.Error as e:
         if "UNIQUE" in str(e):
-          return True
+          if not replace:
+            return True
+          db_logger().error(f"Replace error: {e} for query {query} with arguments {args}")
+          return False
         else:
-          db_logger.error(
+          db_logger().error(
             f"Write error: {e} for query {query} with arguments {args}, retrying in 0.05 seconds"
           )
           time.sleep(0.05)
           attempts += 1
-    db_logger.error(f"Failed to write data {args} after 5 attempts")
+    db_logger().error(f"Failed to write data {args} after 5 attempts")
     return False
 
-  def write_university(self, uni_name: str, uni_type: str, uni_city: str, **kwargs) -> bool:
+  @timed("db.write_university")
+  def write_university(
+    self, uni_name: str, uni_type: str, uni_city: str, replace: bool = False, **kwargs
+  ) -> bool:
     query = """
     INSERT INTO
       University (UniversityName, UniversityType, UniversityCity)
     VALUES
       (?, ?, ?)
     """
-    return self.thread_safe_write(query, (uni_name, uni_type, uni_city))
+    if replace:
+      query += """
+    ON CONFLICT (UniversityName) DO UPDATE SET
+      UniversityType = excluded.UniversityType,
+      UniversityCity = excluded.UniversityCity
+    """
+    return self.cached_write(
+      "University", uni_name, (uni_type, uni_city), replace, query, (uni_name, uni_type, uni_city)
+    )
 
+  @timed("db.write_faculty")
   def write_faculty(self, uni_name: str, fac_name: str, **kwargs) -> bool:
     query = """
     INSERT INTO
@@ -137,11 +671,15 @@ class CrawlDatabase:
     WHERE
       u.UniversityName = :uni_name;
     """
-    return self.thread_safe_write(query, {"uni_name": uni_name, "fac_name": fac_name})
+    return self.cached_write(
+      "Faculty", (uni_name, fac_name), None, False, query,
+      {"uni_name": uni_name, "fac_name": fac_name}
+    )
 
+  @timed("db.write_program")
   def write_program(
     self, dept_id: int, dept_name: str, dept_type: str, scholarship: str, uni_name: str,
-    fac_name: str, **kwargs
+    fac_name: str, replace: bool = False, **kwargs
   ) -> bool:
     query = """
     INSERT INTO
@@ -159,7 +697,16 @@ class CrawlDatabase:
       u.UniversityName = :uni_name
       AND f.FacultyName = :fac_name
     """
-    return self.thread_safe_write(
+    if replace:
+      query += """
+    ON CONFLICT (ProgramID) DO UPDATE SET
+      ProgramName = excluded.ProgramName,
+      ProgramType = excluded.ProgramType,
+      ScholarshipType = excluded.ScholarshipType,
+      FacultyID = excluded.FacultyID
+    """
+    return self.cached_write(
+      "Program", int(dept_id), (dept_name, dept_type, scholarship, uni_name, fac_name), replace,
       query, {
         "prog_id": dept_id,
         "prog_name": dept_name,
@@ -170,14 +717,18 @@ class CrawlDatabase:
       }
     )
 
+  @timed("db.write_placement")
   def write_placement(
     self, dept_id: int, total_quota: int, total_placed: Union[int, None],
     min_points: Union[float, None], max_points: Union[float, None], min_ranking: Union[int, None],
-    max_ranking: Union[int, None], year: int, **kwargs
+    max_ranking: Union[int, None], year: int, replace: bool = False, **kwargs
   ) -> bool:
-    query = """
+    query = f"""
     INSERT INTO
-      PlacementData (ProgramID, TotalQuota, TotalPlaced, LowestScore, HighestScore, MinimumRanking, MaximumRanking, Year)
+      {self.facts(year)}PlacementData (
+        ProgramID, TotalQuota, TotalPlaced, LowestScore, HighestScore, MinimumRanking,
+        MaximumRanking, Year
+      )
     VALUES (
       :prog_id,
       :total_quota,
@@ -187,7 +738,17 @@ class CrawlDatabase:
       :min_ranking,
       :max_ranking,
       :year
-    );
+    )
+    """
+    if replace:
+      query += """
+    ON CONFLICT (ProgramID, Year) DO UPDATE SET
+      TotalQuota = excluded.TotalQuota,
+      TotalPlaced = excluded.TotalPlaced,
+      LowestScore = excluded.LowestScore,
+      HighestScore = excluded.HighestScore,
+      MinimumRanking = excluded.MinimumRanking,
+      MaximumRanking = excluded.MaximumRanking
     """
     return self.thread_safe_write(
       query, {
@@ -199,9 +760,10 @@ class CrawlDatabase:
         "min_ranking": min_ranking,
         "max_ranking": max_ranking,
         "year": year,
-      }
+      }, replace=replace
     )
 
+  @timed("db.write_highschools")
   def write_highschools(self, df: pd.DataFrame) -> bool:
     query = """
     INSERT INTO
@@ -211,14 +773,26 @@ class CrawlDatabase:
     results = []
     for x in df[["hs", "hs_city", "hs_district"]].itertuples():
       results.append(
-        self.thread_safe_write(query, (x.hs, x.hs_city, x.hs_district, None, None, None))
+        self.cached_write(
+          "HighSchool", (x.hs, x.hs_city, x.hs_district), None, False, query,
+          (x.hs, x.hs_city, x.hs_district, None, None, None)
+        )
       )
     return all(results)
 
-  def write_highschool_placements(self, df: pd.DataFrame, program_id: int, year: int) -> bool:
-    query = """
+  @timed("db.write_highschool_placements")
+  def write_highschool_placements(
+    self, df: pd.DataFrame, program_id: int, year: int, replace: bool = False
+  ) -> bool:
+    # Drop the previous placements so that high schools missing from the new
+    # table do not linger. Use inside a transaction to replace them atomically
+    if replace and not self.delete_highschool_placements(program_id, year):
+      return False
+    query = f"""
     INSERT INTO
-      HighSchoolPlacement (HighSchoolID, ProgramID, Year, NumberOfNewGrads, NumberOfOldGrads)
+      {self.facts(year)}HighSchoolPlacement (
+        HighSchoolID, ProgramID, Year, NumberOfNewGrads, NumberOfOldGrads
+      )
     SELECT
       h.rowid,
       :prog_id,
@@ -244,6 +818,116 @@ class CrawlDatabase:
       results.append(self.thread_safe_write(query, arg))
     return all(results)
 
+  @timed("db.delete_highschool_placements")
+  def delete_highschool_placements(self, program_id: int, year: int) -> bool:
+    query = f"DELETE FROM {self.facts(year)}HighSchoolPlacement WHERE ProgramID = ? AND Year = ?"
+    return self.thread_safe_write(query, (program_id, year), replace=True)
+
+  def ensure_panel_hashes(self):
+    """
+    Create the PanelHash table, or its CheckedAt column, in databases created
+    before they were in the schema. Frozen years are left as they are
+    """
+    self.query(
+      """
+      CREATE TABLE IF NOT EXISTS PanelHash (
+        ProgramID INTEGER NOT NULL,
+        Year INTEGER NOT NULL,
+        PanelID TEXT NOT NULL,
+        Hash TEXT NOT NULL,
+        UpdatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        CheckedAt TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (ProgramID, Year, PanelID)
+      )
+      """
+    )
+    altered = False
+    writable = [f"y{year}" for year, frozen in sorted(self.partitions.items()) if not frozen]
+    for schema in ["main"] + writable:
+      columns = [row[1] for row in self.conn.execute(f"PRAGMA {schema}.table_info(PanelHash)")]
+      if "CheckedAt" not in columns:
+        # Columns cannot be added with a CURRENT_TIMESTAMP default
+        self.conn.execute(f"ALTER TABLE {schema}.PanelHash ADD COLUMN CheckedAt TEXT")
+        self.conn.execute(f"UPDATE {schema}.PanelHash SET CheckedAt = UpdatedAt")
+        altered = True
+    if altered:
+      self.conn.commit()
+      self.create_fact_views()
+
+  def get_panel_hashes(self, idx: str, year: int) -> Dict[str, str]:
+    """ Content hashes of the stored panels of a program, keyed by panel id """
+    cursor = self.conn.execute(
+      "SELECT PanelID, Hash FROM PanelHash WHERE ProgramID = ? AND Year = ?", (idx, year)
+    )
+    return dict(cursor.fetchall())
+
+  def get_panel_updates(
+    self, programs: Iterable[Tuple[Any, int]]
+  ) -> Dict[Tuple[int, int, str], str]:
+    """ UpdatedAt of the stored panels of programs, keyed by (program id, year, panel id) """
+    updates = {}
+    for idx, year in programs:
+      cursor = self.conn.execute(
+        "SELECT PanelID, UpdatedAt FROM PanelHash WHERE ProgramID = ? AND Year = ?",
+        (int(idx), int(year))
+      )
+      for panel_id, updated_at in cursor.fetchall():
+        updates[int(idx), int(year), panel_id] = updated_at
+    return updates
+
+  @timed("db.write_panel_hash")
+  def write_panel_hash(self, idx: str, year: int, panel_id: str, digest: str) -> bool:
+    query = f"""
+    INSERT INTO
+      {self.facts(year)}PanelHash (ProgramID, Year, PanelID, Hash, UpdatedAt, CheckedAt)
+    VALUES
+      (?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT (ProgramID, Year, PanelID) DO UPDATE SET
+      Hash = excluded.Hash,
+      UpdatedAt = excluded.UpdatedAt,
+      CheckedAt = excluded.CheckedAt
+    """
+    return self.thread_safe_write(query, (idx, year, panel_id, digest), replace=True)
+
+  @timed("db.mark_checked")
+  def mark_checked(self, checks: Iterable[Tuple[Any, int, Optional[str]]]) -> bool:
+    """
+    Stamp the stored panels of programs as checked, also if a refetch found no changes
+
+    The scheduler refreshes the programs checked the longest time ago first. A
+    stamp older than the stored one is ignored.
+
+    Parameters
+    ----------
+    checks
+      (program id, year, time) of the successful fetches. The time is in the
+      CURRENT_TIMESTAMP format (UTC), or None for now
+
+    Returns
+    -------
+    success
+      Whether all the stamps were written
+    """
+    rows = []
+    for idx, year, checked_at in checks:
+      year = int(year)
+      # A year without a file has no panels to stamp, and frozen years do not change
+      if self.partitioned and self.partitions.get(year, True):
+        continue
+      rows.append((self.facts(year), checked_at, int(idx), year))
+    written = True
+    with self.transaction():
+      for facts, checked_at, idx, year in rows:
+        written &= self.thread_safe_write(
+          f"""
+          UPDATE {facts}PanelHash
+          SET CheckedAt = MAX(COALESCE(CheckedAt, ''), COALESCE(?, CURRENT_TIMESTAMP))
+          WHERE ProgramID = ? AND Year = ?
+          """, (checked_at, idx, year), replace=True
+        )
+    return written
+
+  @timed("db.check_existence")
   def check_existence(self, idx: str, year: int) -> bool:
     """ Check if the program data already exists in the database """
     query = f"SELECT * FROM PlacementData WHERE ProgramID = {idx} AND Year = {year}"
@@ -253,8 +937,319 @@ class CrawlDatabase:
     else:
       return False
 
-  @st.cache_data
-  def get_hs_filter_data(_self) -> pd.DataFrame:
+  @timed("db.bulk_load")
+  def bulk_load(
+    self,
+    rankings: Iterable[Tuple[dict, bool]],
+    highschools: Iterable[Tuple[int, int, List[dict], bool]],
+    hashes: Iterable[Tuple[int, int, str, str, Optional[str]]] = (),
+  ) -> Dict[str, int]:
+    """
+    Ingest a batch of crawled programs with one executemany per table.
+
+    The whole batch is written in a single transaction. Rows that collide with
+    the unique keys of the schema are ignored, unless their record asks for a
+    replace, in which case they are updated like the replace mode of write_*.
+
+    Parameters
+    ----------
+    rankings
+      (ranking data, replace) pairs, the data as parsed from the ranking panel
+
+    highschools
+      (program_id, year, high school rows, replace) tuples. The rows are the
+      records of the parsed high school panel
+
+    hashes
+      (program_id, year, panel_id, digest, time) content hashes of the panels.
+      The time the panel was crawled is in the CURRENT_TIMESTAMP format (UTC),
+      or None for now
+
+    Returns
+    -------
+    counts
+      Number of inserted or updated rows per table
+    """
+    rankings = list(rankings)
+    highschools = list(highschools)
+    hashes = list(hashes)
+    self.ensure_partitions(
+      {data["year"] for data, _ in rankings} | {year for _, year, _, _ in highschools}
+      | {year for _, year, _, _, _ in hashes}
+    )
+
+    def by_facts(rows: list, year: Callable[[Any], int]) -> Dict[str, list]:
+      """ Rows grouped by the schema of their placement tables """
+      groups = {}
+      for row in rows:
+        groups.setdefault(self.facts(year(row)), []).append(row)
+      return groups
+
+    def conflict(replace: bool, keys: str, columns: Iterable[str]) -> str:
+      if not replace:
+        return f"ON CONFLICT ({keys}) DO NOTHING"
+      return f"ON CONFLICT ({keys}) DO UPDATE SET " + ", ".join(
+        f"{column} = excluded.{column}" for column in columns
+      )
+
+    statements = []
+    for replace in (False, True):
+      batch = [data for data, flag in rankings if flag == replace]
+      if len(batch) == 0:
+        continue
+      statements += [
+        (
+          "University", f"""
+          INSERT INTO
+            University (UniversityName, UniversityType, UniversityCity)
+          VALUES
+            (:uni_name, :uni_type, :uni_city)
+          {conflict(replace, "UniversityName", ["UniversityType", "UniversityCity"])}
+          """, batch
+        ),
+        (
+          "Faculty", """
+          INSERT OR IGNORE INTO
+            Faculty (UniversityID, FacultyName)
+          SELECT
+            u.UniversityID,
+            :fac_name
+          FROM
+            University u
+          WHERE
+            u.UniversityName = :uni_name
+          """, batch
+        ),
+        (
+          "Program", f"""
+          INSERT INTO
+            Program (ProgramID, ProgramName, ProgramType, ScholarshipType, FacultyID)
+          SELECT
+            :dept_id,
+            :dept_name,
+            :dept_type,
+            :scholarship,
+            f.FacultyID
+          FROM
+            University u
+            JOIN Faculty f ON u.UniversityID = f.UniversityID
+          WHERE
+            u.UniversityName = :uni_name
+            AND f.FacultyName = :fac_name
+          {conflict(replace, "ProgramID", [
+            "ProgramName", "ProgramType", "ScholarshipType", "FacultyID"
+          ])}
+          """, batch
+        ),
+      ]
+      statements += [
+        (
+          "PlacementData", f"""
+          INSERT INTO
+            {facts}PlacementData (
+              ProgramID, TotalQuota, TotalPlaced, LowestScore, HighestScore, MinimumRanking,
+              MaximumRanking, Year
+            )
+          VALUES (
+            :dept_id, :total_quota, :total_placed, :min_points, :max_points, :min_ranking,
+            :max_ranking, :year
+          )
+          {conflict(replace, "ProgramID, Year", [
+            "TotalQuota", "TotalPlaced", "LowestScore", "HighestScore", "MinimumRanking",
+            "MaximumRanking"
+          ])}
+          """, group
+        ) for facts, group in by_facts(batch, lambda data: data["year"]).items()
+      ]
+
+    rows = [row for _, _, batch, _ in highschools for row in batch]
+    statements += [
+      (
+        "HighSchoolPlacement",
+        f"DELETE FROM {facts}HighSchoolPlacement WHERE ProgramID = ? AND Year = ?",
+        group,
+      ) for facts, group in by_facts(
+        [(int(idx), int(year)) for idx, year, _, replace in highschools if replace],
+        lambda row: row[1]
+      ).items()
+    ]
+    statements += [
+      (
+        "HighSchool", """
+        INSERT OR IGNORE INTO
+          HighSchool (HighSchoolName, City, District)
+        VALUES
+          (:hs, :hs_city, :hs_district)
+        """, rows
+      ),
+    ]
+    statements += [
+      (
+        "HighSchoolPlacement", f"""
+        INSERT OR IGNORE INTO
+          {facts}HighSchoolPlacement (
+            HighSchoolID, ProgramID, Year, NumberOfNewGrads, NumberOfOldGrads
+          )
+        SELECT
+          h.rowid,
+          :prog_id,
+          :year,
+          :new_grad,
+          :old_grad
+        FROM
+          HighSchool h
+        WHERE
+          h.HighSchoolName = :hs AND h.City = :hs_city AND h.District = :hs_district
+        """, group
+      ) for facts, group in by_facts(
+        [
+          {**row, "prog_id": int(idx), "year": int(year), "new_grad": int(row["new_grad"]),
+           "old_grad": int(row["old_grad"])}
+          for idx, year, batch, _ in highschools for row in batch
+        ], lambda row: row["year"]
+      ).items()
+    ]
+    statements += [
+      (
+        "PanelHash", f"""
+        INSERT INTO
+          {facts}PanelHash (ProgramID, Year, PanelID, Hash, UpdatedAt, CheckedAt)
+        VALUES
+          (?1, ?2, ?3, ?4, COALESCE(?5, CURRENT_TIMESTAMP), COALESCE(?5, CURRENT_TIMESTAMP))
+        ON CONFLICT (ProgramID, Year, PanelID) DO UPDATE SET
+          Hash = excluded.Hash,
+          UpdatedAt = excluded.UpdatedAt,
+          CheckedAt = MAX(COALESCE(CheckedAt, ''), excluded.CheckedAt)
+        """, group
+      ) for facts, group in by_facts(hashes, lambda row: row[1]).items()
+    ]
+
+    counts = {}
+    cursor = self.conn.cursor()
+    try:
+      for table, query, args in statements:
+        if len(args) == 0:
+          continue
+        start = time.perf_counter()
+        changes = self.conn.total_changes
+        cursor.executemany(query, args)
+        counts[table] = counts.get(table, 0) + self.conn.total_changes - changes
+        self.profiler.record(
+          self.conn, "write", query, (), time.perf_counter() - start, rows=len(args)
+        )
+      self.conn.commit()
+    except sl.Error as e:
+      self.conn.rollback()
+      db_logger().error(f"Bulk load error: {e}")
+      raise
+    return counts
+
+  def score_highschools(self, touched: Optional[Iterable[Tuple[int, int]]] = None) -> int:
+    """
+    Compute the HighSchool.Score column from the placements of the graduates.
+
+    Every (program, year) gets a quality in [0, 1] from its percentile of minimum
+    ranking among the programs of the same year and program type. Unfilled programs
+    rank last. The score of a high school is the graduate weighted average of the
+    quality of the programs its graduates were placed in, scaled to [0, 100].
+
+    The whole job runs as a single set-based statement, so a full rescore does not
+    loop over the high schools in Python.
+
+    Parameters
+    ----------
+    touched
+      (program_id, year) pairs written by the latest crawl. If given, only the
+      high schools that placed graduates into a program of the same year and
+      program type as a touched program are rescored, since a new or changed
+      program shifts the quality of every program it is ranked against.
+      Otherwise every high school is rescored.
+
+    Returns
+    -------
+    count
+      Number of high schools whose score was updated
+    """
+    where = ""
+    cursor = self.conn.cursor()
+    if touched is not None:
+      cursor.execute("CREATE TEMP TABLE IF NOT EXISTS Touched (ProgramID INTEGER, Year INTEGER)")
+      cursor.execute("DELETE FROM Touched")
+      cursor.executemany(
+        "INSERT INTO Touched (ProgramID, Year) VALUES (?, ?)",
+        [(int(idx), int(year)) for idx, year in touched]
+      )
+      where = """
+      WHERE
+        hsp.HighSchoolID IN (
+          SELECT
+            t_hsp.HighSchoolID
+          FROM
+            HighSchoolPlacement t_hsp
+            JOIN Program t_p ON t_p.ProgramID = t_hsp.ProgramID
+          WHERE
+            (t_hsp.Year, t_p.ProgramType) IN (
+              SELECT
+                t.Year,
+                p.ProgramType
+              FROM
+                Touched t
+                JOIN Program p ON p.ProgramID = t.ProgramID
+            )
+        )
+      """
+
+    query = f"""
+    WITH ProgramQuality AS (
+      SELECT
+        pd.ProgramID,
+        pd.Year,
+        1.0 - PERCENT_RANK() OVER (
+          PARTITION BY pd.Year, p.ProgramType
+          ORDER BY pd.MinimumRanking IS NULL, pd.MinimumRanking
+        ) AS Quality
+      FROM
+        PlacementData pd
+        JOIN Program p ON p.ProgramID = pd.ProgramID
+    ),
+    Scores AS (
+      SELECT
+        hsp.HighSchoolID,
+        100.0 * SUM(q.Quality * (hsp.NumberOfNewGrads + hsp.NumberOfOldGrads))
+          / SUM(hsp.NumberOfNewGrads + hsp.NumberOfOldGrads) AS Score
+      FROM
+        HighSchoolPlacement hsp
+        JOIN ProgramQuality q ON q.ProgramID = hsp.ProgramID AND q.Year = hsp.Year
+      {where}
+      GROUP BY
+        hsp.HighSchoolID
+      HAVING
+        SUM(hsp.NumberOfNewGrads + hsp.NumberOfOldGrads) > 0
+    )
+    UPDATE
+      HighSchool
+    SET
+      Score = Scores.Score
+    FROM
+      Scores
+    WHERE
+      HighSchool.HighSchoolID = Scores.HighSchoolID;
+    """
+    try:
+      changes = self.conn.total_changes
+      cursor.execute(query)
+      count = self.conn.total_changes - changes
+      self.conn.commit()
+    except sl.Error as e:
+      self.conn.rollback()
+      db_logger().error(f"Scoring error: {e}")
+      raise
+    finally:
+      if touched is not None:
+        cursor.execute("DROP TABLE IF EXISTS Touched")
+    return count
+
+  def get_hs_filter_data(self) -> pd.DataFrame:
     """ Query the HighSchool table """
     query = """
     SELECT 
@@ -265,11 +1260,10 @@ class CrawlDatabase:
     FROM 
       HighSchool 
     """
-    df = _self.query(query)
+    df = self.query(query)
     return df
 
-  @st.cache_data
-  def get_uni_filter_data(_self) -> pd.DataFrame:
+  def get_uni_filter_data(self) -> pd.DataFrame:
     """ 
     Query the tables University, Faculty and Program tables for the filters in the analysis page
     """
@@ -287,52 +1281,152 @@ class CrawlDatabase:
       JOIN Faculty f ON f.UniversityID = u.UniversityID
       JOIN Program p ON p.FacultyID = f.FacultyID;
     """
-    df = _self.query(query)
+    df = self.query(query)
     return df
 
-  def get_chart_data(_self) -> pd.DataFrame:
-    query = """
+  def _chart_filters(self, filters: Optional[Dict[str, Iterable[str]]]) -> Tuple[str, tuple]:
+    """ WHERE clause and parameters of the get_chart_data filters """
+    clauses, params = [], []
+    for key, values in (filters or {}).items():
+      values = list(values)
+      if len(values) != 0:
+        # Filter on the columns, aliases like year would be ambiguous in WHERE
+        clauses.append(f"{CHART_COLUMNS[key]} IN ({', '.join(['?'] * len(values))})")
+        params.extend(values)
+    if len(clauses) == 0:
+      return "", ()
+    return "WHERE\n      " + " AND ".join(clauses), tuple(params)
+
+  def get_chart_data(self, filters: Optional[Dict[str, Iterable[str]]] = None) -> pd.DataFrame:
+    """
+    Query the placement data joined with the university and high school details
+
+    Parameters
+    ----------
+    filters
+      Mapping of column aliases (e.g. uni_name, hs_city) to the accepted values.
+      Empty selections are ignored.
+
+    Returns
+    -------
+    df
+      Filtered placement data
+    """
+    return self.query(*self._chart_query(filters))
+
+  def _chart_query(
+    self, filters: Optional[Dict[str, Iterable[str]]], columns: Dict[str, str] = CHART_COLUMNS
+  ) -> Tuple[str, tuple]:
+    """
+    Query of the filtered chart rows with the given alias to column mapping
+
+    In the partitioned layout the joins are repeated for every year file the year
+    filter selects and combined with UNION ALL, so the other years are not read.
+    """
+    where, params = self._chart_filters(filters)
+    if not self.partitioned:
+      schemas = [""]
+    else:
+      years = sorted(self.partitions)
+      if filters is not None and len(filters.get("year", [])) != 0:
+        selected = {int(year) for year in filters["year"]}
+        years = [year for year in years if year in selected]
+      # The empty tables of the main file if no year file is selected
+      schemas = [f"y{year}." for year in years] or ["main."]
+    query = "\n    UNION ALL\n".join(
+      f"""
     SELECT
-      u.UniversityName as uni_name,
-      u.UniversityType as uni_type,
-      u.UniversityCity as uni_city,
-      f.FacultyName as fac_name,
-      p.ProgramName as program,
-      p.ScholarshipType as scholarship,
-      p.ProgramType as prog_type,
-      pd.Year as year,
-      pd.TotalQuota as total_quota,
-      pd.TotalPlaced as total_placed,
-      pd.MinimumRanking as min_ranking,
-      pd.MaximumRanking as max_ranking,
-      hs.HighSchoolName as hs_name,
-      hs.City as hs_city,
-      hs.District as hs_district,
-      hs.Score as score,
-      hsp.NumberOfNewGrads as new_grad,
-      hsp.NumberOfOldGrads as old_grad
+      {", ".join(f"{column} as {alias}" for alias, column in columns.items())}
     FROM
-      University u
-      JOIN Faculty f ON f.UniversityID = u.UniversityID
-      JOIN Program p ON p.FacultyID = f.FacultyID
-      JOIN PlacementData pd ON pd.ProgramID = p.ProgramID
-      JOIN HighSchoolPlacement hsp ON hsp.ProgramID = p.ProgramID AND hsp.Year = pd.Year
-      JOIN HighSchool hs ON hs.HighSchoolID = hsp.HighSchoolID
-    WHERE
+      {CHART_JOINS.format(facts=schema)}
+    {where}
+    """ for schema in schemas
+    )
+    return query, params * len(schemas)
+
+  def iter_chart_data(
+    self, filters: Optional[Dict[str, Iterable[str]]] = None, chunk_size: int = 50000
+  ) -> Iterator[pd.DataFrame]:
     """
-    ss = st.session_state
-    filters = []
-    for k in ss["hs_keys"]:
-      if len(ss[k]) != 0:
-        filters.append(k)
-
-    for k in ss["uni_keys"]:
-      if len(ss[k]) != 0:
-        filters.append(k)
-    query = query + "AND ".join(
-      [f"{key} IN ({', '.join(map(wrap_quotes, ss[key]))}) " for key in filters]
+    get_chart_data in chunks of rows, fetched from the cursor as they are consumed
+
+    Only one chunk is held in memory at a time, so results of any size can be
+    written out. The cursor stays open until the iterator is exhausted or closed,
+    use a handle that does not write in the meantime.
+
+    Parameters
+    ----------
+    filters
+      Same as the filters of get_chart_data
+
+    chunk_size
+      Number of rows per chunk
+    """
+    query, params = self._chart_query(filters)
+    start = time.perf_counter()
+    cursor = self.conn.execute(query, params)
+    sql_seconds, materialize_seconds, rows = time.perf_counter() - start, 0.0, 0
+    try:
+      columns = [column[0] for column in cursor.description]
+      while True:
+        fetch_start = time.perf_counter()
+        chunk = cursor.fetchmany(chunk_size)
+        fetched = time.perf_counter()
+        sql_seconds += fetched - fetch_start
+        if len(chunk) == 0:
+          break
+        df = pd.DataFrame.from_records(chunk, columns=columns, coerce_float=True)
+        materialize_seconds += time.perf_counter() - fetched
+        rows += len(df)
+        yield df
+    finally:
+      cursor.close()
+      # Time spent by the consumer between the chunks is not counted
+      self.profiler.record(self.conn, "read", query, params, sql_seconds, materialize_seconds, rows)
+
+  def get_aggregate_data(
+    self, group_by: List[str], filters: Optional[Dict[str, Iterable[str]]] = None
+  ) -> pd.DataFrame:
+    """
+    Graduate counts of the chart data grouped by some of its columns
+
+    Parameters
+    ----------
+    group_by
+      Column aliases of get_chart_data to group by, e.g. ["uni_name", "year"]
+
+    filters
+      Same as the filters of get_chart_data
+
+    Returns
+    -------
+    df
+      One row per group with the number of new and old graduates, their total,
+      and the number of distinct high schools and programs
+    """
+    columns = {alias: CHART_COLUMNS[alias] for alias in group_by}
+    columns.update(
+      {
+        "_new_grad": "hsp.NumberOfNewGrads",
+        "_old_grad": "hsp.NumberOfOldGrads",
+        "_high_school": "hsp.HighSchoolID",
+        "_program": "hsp.ProgramID",
+      }
     )
-    return _self.query(query)
+    rows, params = self._chart_query(filters, columns)
+    query = f"""
+    SELECT
+      {"".join(alias + ", " for alias in group_by)}
+      SUM(_new_grad) as new_grad,
+      SUM(_old_grad) as old_grad,
+      SUM(_new_grad + _old_grad) as graduates,
+      COUNT(DISTINCT _high_school) as high_schools,
+      COUNT(DISTINCT _program) as programs
+    FROM ({rows})
+    """
+    if len(group_by) != 0:
+      query += f"GROUP BY {', '.join(group_by)}"
+    return self.query(query, params)
 
   def __del__(self):
     """ Close the connection to database gracefully """
@@ -340,11 +1434,119 @@ class CrawlDatabase:
 
 
 if __name__ == "__main__":
-  import sys
-
-  with open("./schema.sql", "r", encoding="utf-8") as f:
-    schema = f.read()
-  try:
-    db = CrawlDatabase.create_from_schema(schema=schema, path="../data/crawl_database.db")
-  except FileExistsError as e:
-    print(e)
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Database utilities for Atlas-Crawl")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  create_parser = subparsers.add_parser("create", help="Create the database from schema.sql")
+  create_parser.add_argument(
+    "path",
+    nargs="?",
+    default="../data/crawl_database.db",
+    help="Path to the database file (Default ../data/crawl_database.db)"
+  )
+  create_parser.add_argument(
+    "--partitioned",
+    action="store_true",
+    help="Write the placements of each year to a file of their own, e.g. crawl_database.2023.db"
+  )
+
+  partition_parser = subparsers.add_parser(
+    "partition", help="Move the placements of each year of a database to a file of their own"
+  )
+  partition_parser.add_argument("path", help="Path to the database file")
+
+  freeze_parser = subparsers.add_parser(
+    "freeze", help="Compact the file of a finished year and open it read-only from now on"
+  )
+  freeze_parser.add_argument("path", help="Path to the partitioned database file")
+  freeze_parser.add_argument("years", nargs="+", type=int, help="Years to freeze")
+
+  snapshot_parser = subparsers.add_parser(
+    "snapshot", help="Publish a compacted, checked copy of the database for read-only serving"
+  )
+  snapshot_parser.add_argument("path", help="Path to the database file")
+  snapshot_parser.add_argument("output", help="Path of the copy, e.g. ../data/serving.db")
+
+  score_parser = subparsers.add_parser("score", help="Recompute the high school scores")
+  score_parser.add_argument("path", help="Path to the database file")
+  score_parser.add_argument(
+    "-y",
+    "--year",
+    type=int,
+    default=None,
+    help="Only rescore the high schools with placements in this year"
+  )
+
+  load_parser = subparsers.add_parser("load", help="Bulk-ingest crawler spool files")
+  load_parser.add_argument("path", help="Path to the database file")
+  load_parser.add_argument("spools", nargs="+", help="Spool files or directories")
+  load_parser.add_argument(
+    "-b",
+    "--batch-size",
+    default=2000,
+    type=int,
+    help="Number of panel records per transaction (Default 2000)"
+  )
+  args = parser.parse_args()
+
+  if args.command == "create":
+    with open("./schema.sql", "r", encoding="utf-8") as f:
+      schema = f.read()
+    try:
+      db = CrawlDatabase.create_from_schema(
+        schema=schema, path=args.path, partitioned=args.partitioned
+      )
+    except FileExistsError as e:
+      print(e)
+  elif args.command == "partition":
+    db = CrawlDatabase(args.path)
+    start = time.perf_counter()
+    try:
+      counts = db.split_years()
+    except RuntimeError as e:
+      print(e)
+    else:
+      for year, count in counts.items():
+        print(f"{db.partition_path(year)}: {count} high school placements")
+      print(f"Partitioned in {time.perf_counter() - start:.2f} seconds")
+  elif args.command == "freeze":
+    db = CrawlDatabase(args.path)
+    for year in args.years:
+      db.freeze_partition(year)
+      print(f"Froze {db.partition_path(year)}")
+  elif args.command == "snapshot":
+    if os.path.abspath(args.output) == os.path.abspath(args.path):
+      parser.error("the snapshot cannot replace the database itself")
+    db = CrawlDatabase(args.path)
+    start = time.perf_counter()
+    for path in db.snapshot(args.output):
+      print(f"{path}: {os.path.getsize(path) / 2**20:.1f} MB")
+    print(f"Published the snapshot in {time.perf_counter() - start:.2f} seconds")
+  elif args.command == "score":
+    db = CrawlDatabase(args.path)
+    touched = None
+    if args.year is not None:
+      touched = db.conn.execute(
+        "SELECT ProgramID, Year FROM PlacementData WHERE Year = ?", (args.year, )
+      ).fetchall()
+    start = time.perf_counter()
+    count = db.score_highschools(touched)
+    print(f"Scored {count} high schools in {time.perf_counter() - start:.2f} seconds")
+  elif args.command == "load":
+    from spool import load_spools
+
+    db = CrawlDatabase(args.path)
+    start = time.perf_counter()
+    stats = load_spools(db, args.spools, args.batch_size)
+    for table, count in stats["rows"].items():
+      print(f"+ {table}: {count} rows")
+    print(
+      f"Loaded {stats['records']} records in {time.perf_counter() - start:.2f} seconds, "
+      f"skipped {stats['skipped']} older than the stored panels"
+    )
+    print(f"Archived {len(stats['archived'])} spool files as *.jsonl.loaded")
+    if len(stats["touched"]) != 0:
+      count = db.score_highschools(stats["touched"])
+      print(f"Scored {count} high schools")
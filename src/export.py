@@ -0,0 +1,158 @@
+""" Streaming CSV and Parquet export of the filtered chart data """
+
+import os
+from typing import Dict, Iterable, Optional, Union
+
+import pandas as pd
+
+from database import CHART_COLUMNS, CrawlDatabase
+
+EXPORT_FORMATS = ["csv", "parquet"]
+
+# Types of the non-text columns. A chunk with missing values in an integer column
+# would otherwise get a float column, e.g. 106.0 in the CSV and a different
+# Parquet schema than the other chunks
+INTEGER_COLUMNS = [
+  "year", "total_quota", "total_placed", "min_ranking", "max_ranking", "new_grad", "old_grad"
+]
+FLOAT_COLUMNS = ["score"]
+
+
+def export_format(path: Union[str, os.PathLike], fmt: Optional[str] = None) -> str:
+  """ The given format, or the one of the file extension """
+  fmt = fmt or os.path.splitext(str(path))[1].lstrip(".").lower()
+  if fmt not in EXPORT_FORMATS:
+    raise ValueError(f"Unknown export format {fmt!r}, expected one of {', '.join(EXPORT_FORMATS)}")
+  return fmt
+
+
+def typed_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+  """ The chunk with the same column types whatever values it happens to have """
+  return chunk.astype({
+    alias: "Int64" if alias in INTEGER_COLUMNS
+    else "float64" if alias in FLOAT_COLUMNS
+    else "string"
+    for alias in CHART_COLUMNS
+  })
+
+
+def export_chart_data(
+  db: CrawlDatabase,
+  path: Union[str, os.PathLike],
+  filters: Optional[Dict[str, Iterable]] = None,
+  fmt: Optional[str] = None,
+  chunk_size: int = 50000,
+) -> int:
+  """
+  Write the filtered chart data to a file, chunk by chunk
+
+  The rows are fetched from the database cursor and written as they arrive, so
+  memory use depends on the chunk size and not on the size of the result.
+  Parquet export requires pyarrow.
+
+  Parameters
+  ----------
+  db
+    The crawl database. The cursor stays open during the export, so use a handle
+    that is not written to in the meantime
+
+  path
+    Output file
+
+  filters
+    Same as the filters of get_chart_data
+
+  fmt
+    csv or parquet. Inferred from the file extension if not given
+
+  chunk_size
+    Number of rows fetched and written at once
+
+  Returns
+  -------
+  rows
+    Number of exported rows
+  """
+  fmt = export_format(path, fmt)
+  chunks = (typed_chunk(chunk) for chunk in db.iter_chart_data(filters, chunk_size))
+  rows = 0
+  if fmt == "csv":
+    with open(path, "w", encoding="utf-8", newline="") as f:
+      f.write(",".join(CHART_COLUMNS) + "\n")
+      for chunk in chunks:
+        chunk.to_csv(f, header=False, index=False)
+        rows += len(chunk)
+  else:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+      for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+          # The schema of the first chunk is pinned, the later chunks are cast to it
+          writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        rows += len(chunk)
+      if writer is None:
+        # No rows, the file still gets the columns
+        empty = typed_chunk(pd.DataFrame(columns=list(CHART_COLUMNS)))
+        writer = pq.ParquetWriter(path, pa.Table.from_pandas(empty, preserve_index=False).schema)
+    finally:
+      if writer is not None:
+        writer.close()
+  return rows
+
+
+if __name__ == "__main__":
+  import time
+  from argparse import ArgumentParser
+  from yaml import full_load
+  from scheduler import parse_years
+
+  parser = ArgumentParser(description="Export the filtered placement data to CSV or Parquet")
+  parser.add_argument("output", help="Output file, .csv or .parquet")
+  parser.add_argument(
+    "-y",
+    "--years",
+    type=parse_years,
+    default=None,
+    help="Year or inclusive year range, e.g. 2019-2023"
+  )
+  parser.add_argument(
+    "-f",
+    "--filter",
+    nargs=2,
+    action="append",
+    default=[],
+    metavar=("COLUMN", "VALUE"),
+    help="Only export rows with this value, e.g. -f uni_type State. Repeat to accept several values"
+  )
+  parser.add_argument(
+    "--format", choices=EXPORT_FORMATS, default=None, help="Default by the file extension"
+  )
+  parser.add_argument(
+    "--database", default=None, help="Database file (Default db_path of configs.yaml)"
+  )
+  parser.add_argument(
+    "-c", "--chunk-size", default=50000, type=int, help="Rows written at once (Default 50000)"
+  )
+  args = parser.parse_args()
+
+  filters = {}
+  for column, value in args.filter:
+    if column not in CHART_COLUMNS:
+      parser.error(f"unknown column {column!r}, expected one of {', '.join(CHART_COLUMNS)}")
+    filters.setdefault(column, []).append(value)
+  if args.years is not None:
+    filters["year"] = args.years
+
+  if args.database is None:
+    with open("configs.yaml", "r") as f:
+      args.database = full_load(f)["db_path"]
+  start = time.perf_counter()
+  rows = export_chart_data(
+    CrawlDatabase(args.database), args.output, filters, args.format, args.chunk_size
+  )
+  print(f"Exported {rows} rows to {args.output} in {time.perf_counter() - start:.2f} seconds")
@@ -0,0 +1,36 @@
+import os
+import logging
+
+LOG_DIR = "../logs"
+
+
+def get_file_logger(name: str, filename: str) -> logging.Logger:
+  """
+  Return the named logger, attaching a file handler under ../logs on first use.
+
+  Nothing is created on import so that modules can share loggers without paying
+  for the log directory and handlers until something is actually logged.
+
+  Parameters
+  ----------
+  name
+    Name of the logger
+
+  filename
+    Name of the log file inside the log directory
+
+  Returns
+  -------
+  logger
+    Logger that writes to the log file
+  """
+  logger = logging.getLogger(name)
+  if not logger.handlers:
+    if not os.path.exists(LOG_DIR):
+      os.makedirs(LOG_DIR, exist_ok=True)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(LOG_DIR, filename))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+  return logger
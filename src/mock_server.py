@@ -0,0 +1,278 @@
+""" Local stand-in for the YÖK Atlas panel pages, used for offline testing and benchmarks """
+
+import time
+import random
+import threading
+from html import escape
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+CITIES = ["ANKARA", "İSTANBUL", "İZMİR", "BURSA", "ANTALYA", "KONYA", "ADANA", "TRABZON"]
+DISTRICTS = [
+  "MERKEZ", "ÇANKAYA", "KADIKÖY", "BORNOVA", "NİLÜFER", "SELÇUKLU", "SEYHAN", "ORTAHİSAR"
+]
+FACULTIES = ["Mühendislik Fakültesi", "Fen Fakültesi", "İktisadi ve İdari Bilimler Fakültesi"]
+PROGRAMS = [("Bilgisayar Mühendisliği", "SAY"), ("Elektrik-Elektronik Mühendisliği", "SAY"),
+            ("Matematik", "SAY"), ("İktisat", "EA"), ("İşletme", "EA"), ("Psikoloji", "EA")]
+SCHOLARSHIPS = ["Burslu", "%50 İndirimli", "Ücretli"]
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>YÖK Atlas</title></head>
+<body>
+<div><div><div>
+<div></div>
+<div><div>
+<h3>{title}</h3>
+<div id="icerik_{panel_id}">{tables}</div>
+</div></div>
+</div></div></div>
+</body>
+</html>
+"""
+
+
+def format_number(value: float, decimals: int = 0) -> str:
+  """ Format a number the way the site does: '.' for thousands, ',' for decimals """
+  text = f"{value:,.{decimals}f}"
+  return text.replace(",", "_").replace(".", ",").replace("_", ".")
+
+
+def key_value_table(title: str, rows: List[Tuple[str, str]]) -> str:
+  body = "".join(f"<tr><td>{escape(k)}</td><td>{escape(v)}</td></tr>" for k, v in rows)
+  return (
+    f'<table><thead><tr><th colspan="2">{escape(title)}</th></tr></thead>'
+    f"<tbody>{body}</tbody></table>"
+  )
+
+
+class FixtureGenerator:
+  """
+  Deterministic fixtures for the program panels
+
+  The same program id always produces the same tables, so crawls against the mock
+  server are reproducible.
+
+  Parameters
+  ----------
+  highschools
+    Number of high school rows in the 1060 panel of each program
+
+  universities
+    Number of distinct universities the programs are spread over
+
+  seed
+    Seed mixed into the per-program random generator
+  """
+  def __init__(self, highschools: int = 50, universities: int = 200, seed: int = 0):
+    self.highschools = highschools
+    self.universities = universities
+    self.seed = seed
+
+  def program(self, program_id: str, year: int) -> dict:
+    rng = random.Random(f"{self.seed}-{program_id}")
+    uni = rng.randrange(self.universities)
+    name, prog_type = rng.choice(PROGRAMS)
+    quota = rng.randint(20, 150)
+    min_ranking = rng.randint(1000, 400000)
+    return {
+      "uni_name": f"ATLAS {uni} ÜNİVERSİTESİ",
+      "uni_type": "Devlet" if uni % 3 else "Vakıf",
+      "uni_city": CITIES[uni % len(CITIES)],
+      "fac_name": FACULTIES[uni % len(FACULTIES)],
+      "dept_name": name,
+      "dept_type": prog_type,
+      "scholarship": rng.choice(SCHOLARSHIPS),
+      "total_quota": quota,
+      "total_placed": quota - rng.randint(0, 3),
+      "min_points": rng.uniform(250, 500),
+      "min_ranking": min_ranking,
+      "max_ranking": rng.randint(1, min_ranking),
+    }
+
+  def ranking_panel(self, program_id: str, year: int) -> Tuple[str, str]:
+    p = self.program(program_id, year)
+    title = f"{p['dept_name']} ({p['scholarship']})"
+    tables = [
+      key_value_table(
+        title, [
+          ("ÖSYM Program Kodu", str(program_id)),
+          ("Üniversite Türü", p["uni_type"]),
+          ("Üniversite", p["uni_name"]),
+          ("Fakülte / Yüksekokul", p["fac_name"]),
+          ("Puan Türü", p["dept_type"]),
+          ("Burs Türü", p["scholarship"]),
+        ]
+      ),
+      key_value_table(
+        "Kontenjan", [
+          ("Toplam Kontenjan", str(p["total_quota"])),
+          ("Toplam Yerleşen", str(p["total_placed"])),
+        ]
+      ),
+      key_value_table(
+        "Puan ve Başarı Sırası", [
+          ("0,12 Katsayı ile Yerleşen Son Kişinin Puanı", format_number(p["min_points"], 5)),
+          (f"{year} Tavan Puan(0,12)", format_number(p["min_points"] + 20, 5)),
+          ("0,12 Katsayı ile Yerleşen Son Kişinin Başarı Sırası", format_number(p["min_ranking"])),
+          (f"{year} Tavan Başarı Sırası(0,12)", format_number(p["max_ranking"])),
+        ]
+      ),
+    ]
+    header = f"{p['uni_name']} ({p['uni_city']})"
+    return header, "".join(tables)
+
+  def highschool_panel(self, program_id: str, year: int) -> Tuple[str, str]:
+    p = self.program(program_id, year)
+    rng = random.Random(f"{self.seed}-{program_id}-{year}-hs")
+    rows, total_new, total_old = [], 0, 0
+    for i in rng.sample(range(max(self.highschools * 20, 1)), self.highschools):
+      city = CITIES[i % len(CITIES)]
+      district = DISTRICTS[(i // len(CITIES)) % len(DISTRICTS)]
+      new, old = rng.randint(1, 3), rng.randint(0, 1)
+      total_new += new
+      total_old += old
+      name = f"ATLAS {i} ANADOLU LİSESİ ({city} - {district})"
+      rows.append(
+        f"<tr><td>{escape(name)}</td><td>{new + old}</td><td>{new}</td><td>{old or '---'}</td></tr>"
+      )
+    rows.append(
+      f"<tr><td>Toplam</td><td>{total_new + total_old}</td>"
+      f"<td>{total_new}</td><td>{total_old}</td></tr>"
+    )
+    table = (
+      "<table><thead>"
+      '<tr><th colspan="4">Liselere Göre Yerleşenler</th></tr>'
+      "<tr><th>Lise</th><th>Toplam</th><th>Lise'den Yeni Mezun</th><th>Önceki Mezun</th></tr>"
+      f"</thead><tbody>{''.join(rows)}</tbody></table>"
+    )
+    return f"{p['uni_name']} ({p['uni_city']})", table
+
+
+class MockAtlasServer(ThreadingHTTPServer):
+  """
+  HTTP server that serves lisans-panel.php?y=<program_id>&p=<panel_id> pages
+
+  Parameters
+  ----------
+  address
+    (host, port) to listen on. Port 0 picks a free port
+
+  latency
+    Mean response latency in seconds
+
+  jitter
+    Maximum random deviation added to the latency in seconds
+
+  error_rate
+    Probability of answering with a 503 error page without the table
+
+  fixtures
+    Fixture generator for the panel contents
+  """
+  daemon_threads = True
+
+  def __init__(
+    self,
+    address: Tuple[str, int] = ("127.0.0.1", 0),
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    fixtures: Optional[FixtureGenerator] = None,
+  ):
+    super().__init__(address, PanelHandler)
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.fixtures = fixtures if fixtures is not None else FixtureGenerator()
+    self.requests = 0
+    self.errors = 0
+    self.lock = threading.Lock()
+    self.thread = None
+
+  @property
+  def url(self) -> str:
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self) -> "MockAtlasServer":
+    """ Serve in a background thread """
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class PanelHandler(BaseHTTPRequestHandler):
+  panels = {"1000_1": "ranking_panel", "1060": "highschool_panel"}
+
+  def do_GET(self):
+    server = self.server
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    # The current year is served without the year prefix
+    year = url.path.strip("/").split("/")[0]
+    year = int(year) if year.isdigit() else datetime.now().year
+    program_id = query.get("y", [""])[0]
+    panel_id = query.get("p", [""])[0]
+
+    delay = server.latency + random.uniform(-server.jitter, server.jitter)
+    if delay > 0:
+      time.sleep(delay)
+
+    with server.lock:
+      server.requests += 1
+      failed = random.random() < server.error_rate
+      server.errors += failed
+
+    if not url.path.endswith("lisans-panel.php") or panel_id not in self.panels or not program_id:
+      return self.respond(404, "<html><body>Not found</body></html>")
+    if failed:
+      return self.respond(503, "<html><body>Service unavailable</body></html>")
+
+    title, tables = getattr(server.fixtures, self.panels[panel_id])(program_id, year)
+    self.respond(200, PAGE.format(title=escape(title), panel_id=panel_id, tables=tables))
+
+  def respond(self, status: int, body: str):
+    data = body.encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "text/html; charset=utf-8")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    # Keep the benchmark output clean
+    pass
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Local stand-in server for YÖK Atlas panel pages")
+  parser.add_argument("-p", "--port", default=8765, type=int, help="Port to listen on")
+  parser.add_argument("--latency", default=0.0, type=float, help="Mean latency in seconds")
+  parser.add_argument("--jitter", default=0.0, type=float, help="Latency jitter in seconds")
+  parser.add_argument("--error-rate", default=0.0, type=float, help="Ratio of failed responses")
+  parser.add_argument(
+    "--highschools", default=50, type=int, help="Number of high schools per program"
+  )
+  args = parser.parse_args()
+
+  server = MockAtlasServer(
+    ("127.0.0.1", args.port),
+    latency=args.latency,
+    jitter=args.jitter,
+    error_rate=args.error_rate,
+    fixtures=FixtureGenerator(highschools=args.highschools),
+  )
+  print(f"Serving YÖK Atlas stand-in on {server.url}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
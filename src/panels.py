@@ -0,0 +1,274 @@
+import re
+import hashlib
+from io import StringIO
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Tuple
+
+# Library Imports
+import pandas as pd
+
+# Custom Imports
+from database import CrawlDatabase
+from telemetry import stage
+
+
+@dataclass(frozen=True)
+class Panel:
+  """
+  Declarative description of a YÖK Atlas panel (lisans-panel.php?p=<panel_id>)
+
+  Parameters
+  ----------
+  name
+    Name used to refer to the panel in the crawler
+
+  panel_id
+    Panel id used by the site. The table is rendered inside #icerik_<panel_id>
+
+  parse
+    Function that turns the panel HTML into data: parse(html, texts, year)
+
+  write
+    Function that writes the parsed data: write(db, data, program_id, year, replace).
+    If replace is set, the existing rows of the program are updated
+
+  tables
+    Database tables the panel writes into
+
+  texts
+    Extra page elements to capture as text, as a mapping of name to xpath
+  """
+  name: str
+  panel_id: str
+  parse: Callable[[str, Dict[str, str], int], Any]
+  write: Callable[[CrawlDatabase, Any, str, int, bool], bool]
+  tables: Tuple[str, ...]
+  texts: Dict[str, str] = field(default_factory=dict)
+
+
+# Registry of the crawled panels. Panels are fetched concurrently but written in
+# registration order, so panels that create the program rows must come first.
+PANELS: Dict[str, Panel] = {}
+
+
+def register_panel(panel: Panel) -> Panel:
+  """ Add a panel to the crawl registry """
+  PANELS[panel.name] = panel
+  return panel
+
+
+def content_hash(html: str, texts: Dict[str, str]) -> str:
+  """ Hash of the raw panel content, used to detect changed panels on refresh """
+  digest = hashlib.sha1(html.encode("utf-8"))
+  for name in sorted(texts):
+    digest.update(f"\0{name}\0{texts[name]}".encode("utf-8"))
+  return digest.hexdigest()
+
+
+def changed_panels(
+  pages: Dict[str, Tuple[str, Dict[str, str]]], known: Dict[str, str]
+) -> Dict[str, Tuple[str, Dict[str, str], str]]:
+  """
+  The fetched panels whose content hash differs from the stored one
+
+  Parameters
+  ----------
+  pages
+    Raw panels of a program: panel name to (html, texts)
+
+  known
+    Stored content hashes of the program, keyed by panel id. Empty to keep every panel
+
+  Returns
+  -------
+  jobs
+    Panel name to (html, texts, digest) of the panels to parse and write
+  """
+  jobs = {}
+  for name, (html, texts) in pages.items():
+    digest = content_hash(html, texts)
+    if known.get(PANELS[name].panel_id) != digest:
+      jobs[name] = (html, texts, digest)
+  return jobs
+
+
+def parse_rankings(dfs: list[pd.DataFrame], year: int) -> dict:
+  """
+  Parse general ranking table from HTML
+
+  Parameters
+  ----------
+  dfs
+    Pandas parses the HTML into a standard DF. Pass it here to make it suitable for
+    the database.
+
+  year
+    The for which the data was crawled
+
+  Returns
+  -------
+  out
+    dictionary of the parsed data
+  """
+  dept_name = dfs[0].columns[0]
+
+  # Some pages have extra promotional tables at the end.
+  if len(dfs) == 4:
+    dfs = dfs[:-1]
+
+  standardized_dfs = [
+    df.rename(columns={
+      df.columns[0]: 'Column1',
+      df.columns[1]: 'Column2'
+    }) for df in dfs
+  ]
+
+  df = pd.concat(standardized_dfs,
+                 ignore_index=True).replace("---", "").replace("Dolmadı", "").replace(
+                   r'\*', '', regex=True
+                 ).map(lambda x: x.strip() if isinstance(x, str) else x)
+  data_dict = df.set_index("Column1")["Column2"].to_dict()
+  out = {
+    "uni_name": data_dict["Üniversite"],
+    "uni_type": "State" if data_dict["Üniversite Türü"] == "Devlet" else "Private",
+    "fac_name": data_dict["Fakülte / Yüksekokul"],
+    "dept_id": data_dict["ÖSYM Program Kodu"],
+    "dept_name": dept_name.replace("(" + data_dict["Burs Türü"] + ")", "").strip(),
+    "dept_type": data_dict["Puan Türü"],
+    "scholarship": data_dict["Burs Türü"].replace("%", "").split()[0].replace("İÖ-", ""),
+    "total_quota": data_dict["Toplam Kontenjan"],
+    "total_placed": data_dict["Toplam Yerleşen"],
+    "min_points": data_dict["0,12 Katsayı ile Yerleşen Son Kişinin Puanı"],
+    "max_points": data_dict[f"{year} Tavan Puan(0,12)"],
+    "min_ranking": data_dict["0,12 Katsayı ile Yerleşen Son Kişinin Başarı Sırası"],
+    "max_ranking": data_dict[f"{year} Tavan Başarı Sırası(0,12)"]
+  }
+  return {k: v if v != "" else None for k, v in out.items()}
+
+
+def parse_highschools(df: pd.DataFrame) -> pd.DataFrame:
+  """
+  Parse high school table read from HTML
+
+  Parameters
+  ----------
+  df
+    Pandas parses the HTML into a standard DF. Pass it here to make it suitable for
+    the database.
+
+  Returns
+  -------
+  parsed_df
+  """
+  # Replace no grad symbol to 0
+  df = df[0].replace("---", 0)
+  # Drop the merged title cells in the table
+  df.columns = df.columns.droplevel()
+  if len(df) == 0:
+    # If after the modifications no rows remain the program is empty
+    return df
+  # Remove Toplam row
+  df = df.loc[df['Lise'] != "Toplam"].reset_index(drop=True).fillna(0)
+
+  # Parser func to apply to each row
+  def parser_func(row):
+    hs_name = row["Lise"]
+    # Extract city an districts from the hs name string
+    # definetely needs refactor. very ugly
+    idxx = hs_name[::-1].find("(")
+    location = hs_name[len(hs_name) - idxx:-1]
+    pure_name = hs_name[:len(hs_name) - idxx - 1].strip()
+    location = location.split(" - ")
+    if pure_name == "AÇIK ÖĞRETİM LİSESİ":
+      city = "AÇIK ÖĞRETİM LİSESİ"
+    else:
+      city = location[0]
+    if len(location) > 1:
+      district = location[1]
+    else:
+      district = "MERKEZE BAĞLI TAŞRA"
+
+    out = pd.Series(
+      [
+        pure_name,
+        city,
+        district,
+        row["Lise'den Yeni Mezun"],
+        row["Önceki Mezun"],
+      ],
+      index=['hs', 'hs_city', 'hs_district', 'new_grad', 'old_grad']
+    )
+    return out
+
+  df = df.apply(parser_func, axis=1, result_type="expand")
+  return df
+
+
+def parse_ranking_panel(html: str, texts: Dict[str, str], year: int) -> dict:
+  """ Parse the general ranking panel (1000_1) """
+  with stage("read_html", panel="ranking"):
+    dfs = pd.read_html(StringIO(html), thousands='.', decimal=',')
+  with stage("parse", panel="ranking"):
+    rankings = parse_rankings(dfs, year)
+    # Regular expression magic to get the university city from the page header
+    city = re.findall(r'\(([^)]+)\)', texts["city"])[-1]
+  rankings.update({"uni_city": city, "year": year})
+  return rankings
+
+
+def write_ranking_panel(
+  db: CrawlDatabase, data: dict, idx: str, year: int, replace: bool = False
+) -> bool:
+  """ Write the university, faculty, program and placement rows of a program """
+  return all(
+    [
+      db.write_university(**data, replace=replace),
+      db.write_faculty(**data),
+      db.write_program(**data, replace=replace),
+      db.write_placement(**data, replace=replace),
+    ]
+  )
+
+
+def parse_highschool_panel(html: str, texts: Dict[str, str], year: int) -> pd.DataFrame:
+  """ Parse the high school placement panel (1060) """
+  with stage("read_html", panel="highschools"):
+    dfs = pd.read_html(StringIO(html))
+  with stage("parse", panel="highschools"):
+    return parse_highschools(dfs)
+
+
+def write_highschool_panel(
+  db: CrawlDatabase, data: pd.DataFrame, idx: str, year: int, replace: bool = False
+) -> bool:
+  """ Write the high schools and the placements of a program """
+  if len(data) == 0:
+    # An emptied table still has to clear the previous placements on replace
+    return not replace or db.delete_highschool_placements(idx, year)
+  return all(
+    [
+      db.write_highschools(data),
+      db.write_highschool_placements(data, idx, year, replace=replace),
+    ]
+  )
+
+
+register_panel(
+  Panel(
+    name="ranking",
+    panel_id="1000_1",
+    parse=parse_ranking_panel,
+    write=write_ranking_panel,
+    tables=("University", "Faculty", "Program", "PlacementData"),
+    texts={"city": "/html/body/div[1]/div/div/div[2]/div/h3[1]"},
+  )
+)
+register_panel(
+  Panel(
+    name="highschools",
+    panel_id="1060",
+    parse=parse_highschool_panel,
+    write=write_highschool_panel,
+    tables=("HighSchool", "HighSchoolPlacement"),
+  )
+)
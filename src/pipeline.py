@@ -0,0 +1,220 @@
+""" Pipelined crawl: browsers fetch, a process pool parses, the caller writes """
+
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from log_utils import get_file_logger
+from panels import PANELS
+from telemetry import get_telemetry
+
+# Raw panels of a program: panel name to (html, texts)
+Pages = Dict[str, Tuple[str, Dict[str, str]]]
+# Panels to parse: panel name to (html, texts, digest)
+Jobs = Dict[str, Tuple[str, Dict[str, str], str]]
+# Parsed panels: panel name to (data, digest)
+Parsed = Dict[str, Tuple[Any, str]]
+
+_DONE = object()
+
+
+def parse_pages(jobs: Jobs, year: int) -> Tuple[Parsed, Dict[str, float]]:
+  """ Parse the panels of a program in a worker process. Also returns the seconds per panel """
+  parsed, seconds = {}, {}
+  for name, (html, texts, digest) in jobs.items():
+    start = time.perf_counter()
+    parsed[name] = (PANELS[name].parse(html, texts, year), digest)
+    seconds[name] = time.perf_counter() - start
+  return parsed, seconds
+
+
+class CrawlPipeline:
+  """
+  Overlap page fetching with parsing
+
+  Every browser is driven by a fetcher thread that takes the next task and puts
+  the raw panel HTML into a bounded queue. The thread that iterates over run()
+  draws the tasks and hands them to the fetchers, takes the fetched programs off
+  the queue, picks the panels to parse and hands them to a process pool, so
+  parsing uses all cores while the browsers load the next programs. The parsed
+  programs are yielded in the order they were fetched, and the caller writes
+  them. The task iterator, prepare and the caller all run in that one thread, so
+  they can share a database connection.
+
+  Both hand-offs are bounded: fetchers block once queue_size programs wait for
+  parsing, and at most two programs per worker are parsed or waiting for the
+  writer at a time. A slow writer therefore throttles parsing, and slow parsing
+  throttles fetching, instead of buffering the crawl in memory.
+
+  Parameters
+  ----------
+  browsers
+    One webdriver per fetcher thread
+
+  fetch
+    fetch(browser, idx, year) returning the raw panels of a program, or False
+    if they could not be loaded, e.g. fetch_panels
+
+  prepare
+    prepare(idx, year, pages) returning the panels to parse with their content
+    hash, e.g. only the changed ones on refresh. Called from the iterating thread
+
+  workers
+    Number of parser processes. Defaults to the number of cores
+
+  queue_size
+    Number of fetched programs waiting for a parser before the fetchers block
+  """
+  def __init__(
+    self,
+    browsers: List[Any],
+    fetch: Callable[[Any, str, int], Union[Pages, bool]],
+    prepare: Callable[[str, int, Pages], Jobs],
+    workers: Optional[int] = None,
+    queue_size: int = 8,
+  ):
+    self.browsers = browsers
+    self.fetch = fetch
+    self.prepare = prepare
+    self.workers = workers or os.cpu_count()
+    self.queue_size = queue_size
+    # Spawned workers, forking a process that runs browser and heartbeat threads is unsafe
+    self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+  def run(self, tasks: Iterable[Tuple[str, int]]) -> Iterator[Tuple[str, int, Union[Parsed, bool]]]:
+    """
+    Crawl the (program id, year) tasks
+
+    Yields (idx, year, parsed) per task, where parsed maps the panel names to
+    (data, digest), or is False if the program could not be fetched or parsed.
+    The tasks iterator is advanced by the iterating thread, one task ahead of
+    every fetcher.
+    """
+    tasks = iter(tasks)
+    stop = threading.Event()
+    todo = queue.Queue()
+    fetched = queue.Queue(maxsize=self.queue_size)
+    exhausted = False
+
+    def feed():
+      # Keep one task waiting per fetcher, then one _DONE per fetcher
+      nonlocal exhausted
+      while not exhausted and todo.qsize() < len(self.browsers):
+        try:
+          task = next(tasks, None)
+        except Exception as e:
+          get_file_logger("c_logger", "crawl_operations.log").error(
+            f"Could not get a task: {e!r}"
+          )
+          task = None
+        if task is None:
+          exhausted = True
+          for _ in self.browsers:
+            todo.put(_DONE)
+        else:
+          todo.put(task)
+
+    def put(item):
+      # Give up waiting for room once the consumer stopped
+      while not stop.is_set():
+        try:
+          fetched.put(item, timeout=0.5)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    def fetcher(browser):
+      try:
+        while not stop.is_set():
+          try:
+            task = todo.get(timeout=0.5)
+          except queue.Empty:
+            continue
+          if task is _DONE:
+            break
+          idx, year = task
+          try:
+            pages = self.fetch(browser, idx, year)
+          except Exception as e:
+            get_file_logger("c_logger", "crawl_operations.log").error(
+              f"Fetch error {idx, year}: {e!r}"
+            )
+            pages = False
+          if not put((idx, year, pages)):
+            break
+      finally:
+        put(_DONE)
+
+    threads = [
+      threading.Thread(target=fetcher, args=(browser, ), daemon=True) for browser in self.browsers
+    ]
+    for thread in threads:
+      thread.start()
+
+    running = len(threads)
+    pending: "deque[Tuple[str, int, Optional[Future]]]" = deque()
+    telemetry = get_telemetry()
+    try:
+      while running != 0 or len(pending) != 0:
+        # Hand every fetched program to the parsers, waiting for one only if
+        # nothing is being parsed
+        while running != 0 and len(pending) < 2 * self.workers:
+          feed()
+          try:
+            start = time.perf_counter()
+            item = fetched.get(block=len(pending) == 0)
+            if len(pending) == 0:
+              telemetry.record("pipeline_wait", time.perf_counter() - start, on="fetch")
+          except queue.Empty:
+            break
+          if item is _DONE:
+            running -= 1
+            continue
+          idx, year, pages = item
+          if pages == False:
+            pending.append((idx, year, None))
+          else:
+            future = self.pool.submit(parse_pages, self.prepare(idx, year, pages), year)
+            pending.append((idx, year, future))
+        if len(pending) == 0:
+          continue
+
+        idx, year, future = pending.popleft()
+        if future is None:
+          yield idx, year, False
+          continue
+        start = time.perf_counter()
+        try:
+          parsed, seconds = future.result()
+        except Exception as e:
+          get_file_logger("c_logger", "crawl_operations.log").error(
+            f"Parse error {idx, year}: {e!r}"
+          )
+          yield idx, year, False
+          continue
+        telemetry.record("pipeline_wait", time.perf_counter() - start, on="parse")
+        for name, value in seconds.items():
+          telemetry.record("parse_worker", value, panel=name)
+        yield idx, year, parsed
+    finally:
+      stop.set()
+      for future in pending:
+        if future[2] is not None:
+          future[2].cancel()
+      for thread in threads:
+        thread.join()
+
+  def close(self):
+    self.pool.shutdown(cancel_futures=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
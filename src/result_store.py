@@ -0,0 +1,171 @@
+""" Shared, reference counted store of query results for the dashboard sessions """
+
+import weakref
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List
+
+import pandas as pd
+
+
+def filter_key(filters: Dict[str, List]) -> tuple:
+  """ Order-independent key of a get_chart_data filter mapping. Empty selections are dropped """
+  return tuple(
+    sorted((key, tuple(sorted(values))) for key, values in filters.items() if len(values) != 0)
+  )
+
+
+class ResultHandle:
+  """
+  A session's reference to a frame in a ResultStore
+
+  The reference is released with release(), or when the handle is garbage
+  collected, e.g. when Streamlit drops the state of a closed session.
+  """
+  def __init__(self, store: "ResultStore", key: Hashable, frame: pd.DataFrame):
+    self.key = key
+    self.frame = frame
+    self._store = store
+    # The garbage collector can run the finalizer in a thread that holds the
+    # store's lock, so it only queues the key instead of taking the lock
+    self._finalizer = weakref.finalize(self, store.collected.append, key)
+
+  def release(self):
+    if self._finalizer.detach() is not None:
+      self._store.release(self.key)
+
+
+class ResultStore:
+  """
+  Query result frames shared by all dashboard sessions
+
+  Sessions that run the same query get handles to the same frame instead of
+  copies, so memory grows with the number of distinct queries rather than with
+  the number of users. Frames must therefore be treated as read-only. When the
+  frames outgrow the memory ceiling, the least recently used ones that no
+  session holds anymore are evicted. Sessions that miss the same key at the
+  same time wait for the first one to load it, so the query runs only once.
+
+  Parameters
+  ----------
+  max_bytes
+    Memory ceiling of the stored frames. Frames held by a session are never
+    evicted, so the ceiling can be exceeded while they are in use
+  """
+  def __init__(self, max_bytes: int = 512 * 2**20):
+    self.max_bytes = max_bytes
+    self.entries: "OrderedDict[Hashable, dict]" = OrderedDict()
+    self.lock = threading.Lock()
+    self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+    # Keys of the handles released by the garbage collector, applied under the lock
+    self.collected: "deque[Hashable]" = deque()
+    # Frames being loaded, keyed like the entries
+    self.loading: Dict[Hashable, Future] = {}
+
+  def get(self, key: Hashable, load: Callable[[], pd.DataFrame]) -> ResultHandle:
+    """ Handle to the frame of the key, calling load to create it if it is not stored """
+    with self.lock:
+      self._release_collected()
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.counters["hits"] += 1
+        return self._acquire(key, entry)
+      pending = self.loading.get(key)
+      loader = pending is None
+      if loader:
+        pending = self.loading[key] = Future()
+        self.counters["misses"] += 1
+      else:
+        self.counters["hits"] += 1
+
+    if loader:
+      # Load outside the lock so other sessions are not blocked by a slow query
+      try:
+        frame = load()
+      except BaseException as e:
+        with self.lock:
+          del self.loading[key]
+        pending.set_exception(e)
+        raise
+    else:
+      # Raises the error of the loading session as well
+      frame = pending.result()
+    with self.lock:
+      self._release_collected()
+      # The frame may have been evicted again before a waiting session got here
+      entry = self.entries.get(key)
+      if entry is None:
+        entry = {"frame": frame, "refs": 0, "bytes": int(frame.memory_usage(deep=True).sum())}
+        self.entries[key] = entry
+      handle = self._acquire(key, entry)
+      if loader:
+        del self.loading[key]
+        pending.set_result(frame)
+      self._evict()
+      return handle
+
+  def _acquire(self, key: Hashable, entry: dict) -> ResultHandle:
+    entry["refs"] += 1
+    self.entries.move_to_end(key)
+    return ResultHandle(self, key, entry["frame"])
+
+  def release(self, key: Hashable):
+    with self.lock:
+      self._release_collected()
+      self._release(key)
+      self._evict()
+
+  def _release(self, key: Hashable):
+    entry = self.entries.get(key)
+    if entry is not None:
+      entry["refs"] -= 1
+
+  def _release_collected(self):
+    while True:
+      try:
+        key = self.collected.popleft()
+      except IndexError:
+        return
+      self._release(key)
+
+  def _evict(self):
+    total = self.nbytes()
+    for key in list(self.entries):
+      if total <= self.max_bytes:
+        break
+      entry = self.entries[key]
+      if entry["refs"] <= 0:
+        total -= entry["bytes"]
+        del self.entries[key]
+        self.counters["evictions"] += 1
+
+  def clear(self):
+    """ Drop every stored frame, e.g. when the database changed. Held handles keep their frame """
+    with self.lock:
+      self.collected.clear()
+      self.entries.clear()
+
+  def nbytes(self) -> int:
+    return sum(entry["bytes"] for entry in self.entries.values())
+
+  def stats(self) -> Dict[str, int]:
+    """ Hit, miss and eviction counts with the number and size of the stored frames """
+    with self.lock:
+      self._release_collected()
+      return {**self.counters, "frames": len(self.entries), "bytes": self.nbytes()}
+
+  def frame(self) -> pd.DataFrame:
+    """ Stored frames, most recently used first, for the debug panel """
+    with self.lock:
+      self._release_collected()
+      rows = [
+        {
+          "key": str(key),
+          "rows": len(entry["frame"]),
+          "MB": entry["bytes"] / 2**20,
+          "refs": entry["refs"],
+        }
+        for key, entry in reversed(self.entries.items())
+      ]
+    return pd.DataFrame(rows, columns=["key", "rows", "MB", "refs"])
@@ -0,0 +1,228 @@
+import time
+import random
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+
+class LatencyTracker:
+  """
+  Rolling window of page load latencies used to adapt the timeout patience
+
+  The timeout follows a high percentile of the observed latencies so that slow
+  server periods get longer waits and fast periods fail fast.
+
+  Parameters
+  ----------
+  initial
+    Timeout in seconds used until enough samples are collected
+
+  minimum
+    Lower bound of the adaptive timeout in seconds
+
+  maximum
+    Upper bound of the adaptive timeout in seconds
+
+  percentile
+    Latency percentile the timeout is based on
+
+  factor
+    Multiplier applied to the percentile latency
+
+  window
+    Number of recent samples to keep
+
+  min_samples
+    Number of samples needed before the timeout starts adapting
+  """
+  def __init__(
+    self,
+    initial: float = 5,
+    minimum: float = 1,
+    maximum: float = 30,
+    percentile: float = 95,
+    factor: float = 2.0,
+    window: int = 200,
+    min_samples: int = 20,
+  ):
+    self.initial = initial
+    self.minimum = minimum
+    self.maximum = maximum
+    self.percentile = percentile
+    self.factor = factor
+    self.min_samples = min_samples
+    self.samples = deque(maxlen=window)
+
+  def record(self, seconds: float):
+    self.samples.append(seconds)
+
+  def quantile(self, q: float) -> Optional[float]:
+    """ Return the q-th percentile of the recorded latencies """
+    if len(self.samples) == 0:
+      return None
+    ordered = sorted(self.samples)
+    idx = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+  @property
+  def timeout(self) -> float:
+    if len(self.samples) < self.min_samples:
+      return self.initial
+    value = self.factor * self.quantile(self.percentile)
+    return max(self.minimum, min(self.maximum, value))
+
+
+class CircuitBreaker:
+  """
+  Pause the whole crawl when the recent error rate spikes
+
+  The breaker opens when the failure ratio of the last `window` page loads reaches
+  `threshold`. While open, wait() blocks for `cooldown` seconds, doubled each time
+  the breaker re-opens right after a trial period, up to `max_cooldown`. Every
+  `window` successful page loads in a row halve the cooldown again, down to the
+  initial one, so a single lucky request during a ban does not undo the backoff.
+
+  The breaker is shared by the fetcher threads. The first thread that waits on
+  an open breaker trips it and sleeps, the others block until it resumes, so a
+  burst of failures from several threads counts as one trip.
+
+  Parameters
+  ----------
+  window
+    Number of recent page loads to consider
+
+  threshold
+    Failure ratio that opens the breaker
+
+  cooldown
+    Seconds to pause once the breaker opens
+
+  max_cooldown
+    Upper bound of the pause in seconds
+
+  sleep
+    Sleep function, replaceable for testing
+  """
+  def __init__(
+    self,
+    window: int = 20,
+    threshold: float = 0.5,
+    cooldown: float = 30,
+    max_cooldown: float = 600,
+    sleep: Callable[[float], None] = time.sleep,
+  ):
+    self.window = window
+    self.threshold = threshold
+    self.base_cooldown = cooldown
+    self.cooldown = cooldown
+    self.max_cooldown = max_cooldown
+    self.sleep = sleep
+    self.outcomes = deque(maxlen=window)
+    self.is_open = False
+    self.trips = 0
+    self.streak = 0
+    self.lock = threading.Lock()
+    # Cleared while a thread sleeps out the cooldown
+    self.resumed = threading.Event()
+    self.resumed.set()
+
+  def record(self, success: bool):
+    with self.lock:
+      self.outcomes.append(success)
+      self.streak = self.streak + 1 if success else 0
+      if self.streak >= self.window:
+        self.cooldown = max(self.base_cooldown, self.cooldown / 2)
+        self.streak = 0
+      if not success and len(self.outcomes) == self.window and self.error_rate >= self.threshold:
+        self.is_open = True
+
+  @property
+  def error_rate(self) -> float:
+    if len(self.outcomes) == 0:
+      return 0.0
+    return self.outcomes.count(False) / len(self.outcomes)
+
+  def wait(self) -> float:
+    """ Block while the breaker is open. Returns the seconds slept """
+    with self.lock:
+      if not self.is_open:
+        return 0.0
+      tripping = self.resumed.is_set()
+      if tripping:
+        self.resumed.clear()
+        self.trips += 1
+        slept = self.cooldown
+    if not tripping:
+      # Another thread is sleeping out the cooldown of this trip
+      start = time.perf_counter()
+      self.resumed.wait()
+      return time.perf_counter() - start
+    try:
+      self.sleep(slept)
+    finally:
+      with self.lock:
+        # Half open: let requests through again, but a new burst of failures
+        # re-opens the breaker with a longer cooldown
+        self.is_open = False
+        self.outcomes.clear()
+        self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        self.resumed.set()
+    return slept
+
+
+class RetryPolicy:
+  """
+  Retry policy for page loads: exponential backoff with jitter, an adaptive
+  timeout and a circuit breaker shared by the whole crawl.
+
+  Parameters
+  ----------
+  max_attempts
+    Number of attempts for a single page load
+
+  base_delay
+    Backoff delay in seconds after the first failure
+
+  max_delay
+    Upper bound of the backoff delay in seconds
+
+  jitter
+    Fraction of the backoff delay that is randomized
+
+  latency
+    Latency tracker for the adaptive timeout patience
+
+  breaker
+    Circuit breaker that pauses the crawl during outages
+  """
+  def __init__(
+    self,
+    max_attempts: int = 3,
+    base_delay: float = 0.5,
+    max_delay: float = 10,
+    jitter: float = 0.5,
+    latency: Optional[LatencyTracker] = None,
+    breaker: Optional[CircuitBreaker] = None,
+  ):
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.jitter = jitter
+    self.latency = latency if latency is not None else LatencyTracker()
+    self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+  @property
+  def timeout(self) -> float:
+    return self.latency.timeout
+
+  def backoff(self, attempt: int) -> float:
+    """ Delay in seconds before the given retry attempt (starting at 1) """
+    delay = min(self.max_delay, self.base_delay * 2**(attempt - 1))
+    return delay * (1 - self.jitter * random.random())
+
+  def record_success(self, seconds: float):
+    self.latency.record(seconds)
+    self.breaker.record(True)
+
+  def record_failure(self):
+    self.breaker.record(False)
@@ -0,0 +1,230 @@
+""" Streaming, deduplicated and prioritized program scheduling for the crawler """
+
+import os
+import glob
+from argparse import ArgumentTypeError
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from database import CrawlDatabase
+from log_utils import LOG_DIR, get_file_logger
+
+# Crawl order of the scheduled programs, lowest first
+NEVER_CRAWLED, STALE, FAILED = 0, 1, 2
+PRIORITY_NAMES = {NEVER_CRAWLED: "never_crawled", STALE: "stale", FAILED: "failed"}
+
+
+def parse_years(value: str) -> List[int]:
+  """ Parse a year or an inclusive year range like 2019-2023 """
+  start, _, end = value.partition("-")
+  try:
+    years = list(range(int(start), int(end or start) + 1))
+  except ValueError:
+    raise ArgumentTypeError(f"invalid year or year range: {value!r}")
+  if len(years) == 0:
+    raise ArgumentTypeError(f"empty year range: {value!r}")
+  return years
+
+
+def stream_ids(sources: Iterable[str]) -> Iterator[str]:
+  """
+  Yield the program ids of ID files line by line
+
+  Parameters
+  ----------
+  sources
+    Paths or glob patterns of files with one program id per line. Blank lines
+    and lines starting with # are ignored, non-numeric ids are logged and skipped
+  """
+  for source in sources:
+    for path in sorted(glob.glob(source)) or [source]:
+      with open(path, "r") as f:
+        for number, line in enumerate(f, 1):
+          idx = line.strip()
+          if idx == "" or idx.startswith("#"):
+            continue
+          if not idx.isdigit():
+            get_file_logger("c_logger", "crawl_operations.log").error(
+              f"Skipping invalid program id {idx!r} at {path}:{number}"
+            )
+            continue
+          yield idx
+
+
+class Scheduler:
+  """
+  Crawl order of the (program, year) pairs of one or more years
+
+  The ids are staged in a temporary table of the database connection, which
+  SQLite keeps on disk, so sources of any size are deduplicated without holding
+  them in memory. plan() then pairs every program with every year and ranks the
+  pairs against the crawled data: pairs that were never crawled come first, then
+  the crawled ones whose panels were checked the longest time ago, and pairs
+  that failed in the previous run come last. Within a priority the years of a
+  program are scheduled back to back, so its university, faculty and program
+  rows are only looked up once. Iteration pages through the ranked table, so
+  even a multi-year backfill starts as soon as the ids are staged.
+
+  Parameters
+  ----------
+  db
+    The crawl database
+
+  years
+    The years to schedule
+
+  include_existing
+    Keep the pairs that already have data, e.g. for --refresh. Otherwise they are
+    dropped from the schedule
+
+  dead_letters
+    Path of the files with the programs that failed in the previous run, with a
+    {year} placeholder. Defaults to the dead letter files the crawler writes
+
+  page_size
+    Number of pairs fetched from the table at once while iterating
+  """
+  def __init__(
+    self,
+    db: CrawlDatabase,
+    years: Iterable[int],
+    include_existing: bool = False,
+    dead_letters: Optional[str] = None,
+    page_size: int = 1000,
+  ):
+    self.db = db
+    self.years = sorted(set(int(year) for year in years))
+    self.include_existing = include_existing
+    self.dead_letters = dead_letters or os.path.join(LOG_DIR, "dead_letters_{year}.txt")
+    self.page_size = page_size
+    for table in ["ScheduleIds", "Schedule"]:
+      self.db.conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+    self.db.conn.execute(
+      """
+      CREATE TEMP TABLE ScheduleIds (
+        Seq INTEGER PRIMARY KEY,
+        ProgramID INTEGER NOT NULL UNIQUE
+      )
+      """
+    )
+
+  def add(self, ids: Iterable[str], chunk_size: int = 10000) -> int:
+    """ Stage program ids, ignoring the ones already staged. Returns the number of new ids """
+    conn = self.db.conn
+    before = conn.total_changes
+    ids = iter(ids)
+    while True:
+      chunk = list(islice(ids, chunk_size))
+      if len(chunk) == 0:
+        break
+      conn.executemany(
+        "INSERT OR IGNORE INTO temp.ScheduleIds (ProgramID) VALUES (?)",
+        [(int(idx), ) for idx in chunk]
+      )
+    conn.commit()
+    return conn.total_changes - before
+
+  def add_missing(self) -> int:
+    """ Stage the programs known to the database that have no data for one of the years """
+    conn = self.db.conn
+    before = conn.total_changes
+    conn.execute(
+      f"""
+      INSERT OR IGNORE INTO temp.ScheduleIds (ProgramID)
+      SELECT
+        p.ProgramID
+      FROM
+        Program p
+      WHERE
+        (
+          SELECT COUNT(*) FROM PlacementData pd
+          WHERE pd.ProgramID = p.ProgramID AND pd.Year IN ({", ".join(["?"] * len(self.years))})
+        ) < ?
+      ORDER BY
+        p.ProgramID
+      """, self.years + [len(self.years)]
+    )
+    conn.commit()
+    return conn.total_changes - before
+
+  def plan(self) -> Dict[str, int]:
+    """ Rank the staged pairs. Returns the number of scheduled pairs per priority """
+    conn = self.db.conn
+    conn.execute(
+      """
+      CREATE TEMP TABLE Schedule (
+        ProgramID INTEGER NOT NULL,
+        Year INTEGER NOT NULL,
+        Seq INTEGER NOT NULL,
+        Priority INTEGER NOT NULL,
+        Stamp TEXT NOT NULL,
+        PRIMARY KEY (ProgramID, Year)
+      )
+      """
+    )
+    # Spool mode crawlers do not add the PanelHash table, or its CheckedAt
+    # column, to older databases. Their programs all get the same stamp
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(PanelHash)")]
+    if len(columns) == 0:
+      stamp = "''"
+    else:
+      checked = "COALESCE(ph.CheckedAt, ph.UpdatedAt)" if "CheckedAt" in columns else "ph.UpdatedAt"
+      stamp = f"""COALESCE((
+          SELECT MIN({checked}) FROM PanelHash ph
+          WHERE ph.ProgramID = s.ProgramID AND ph.Year = y.Year
+        ), '')"""
+    conn.execute(
+      f"""
+      WITH Years (Year) AS (VALUES {", ".join(["(?)"] * len(self.years))})
+      INSERT INTO temp.Schedule (ProgramID, Year, Seq, Priority, Stamp)
+      SELECT
+        s.ProgramID,
+        y.Year,
+        s.Seq,
+        CASE WHEN pd.ProgramID IS NULL THEN {NEVER_CRAWLED} ELSE {STALE} END,
+        CASE WHEN pd.ProgramID IS NULL THEN '' ELSE {stamp} END
+      FROM
+        temp.ScheduleIds s
+        CROSS JOIN Years y
+        LEFT JOIN PlacementData pd ON pd.ProgramID = s.ProgramID AND pd.Year = y.Year
+      """, self.years
+    )
+    if not self.include_existing:
+      conn.execute(f"DELETE FROM temp.Schedule WHERE Priority = {STALE}")
+    for year in self.years:
+      path = self.dead_letters.format(year=year)
+      if os.path.exists(path):
+        conn.executemany(
+          f"UPDATE temp.Schedule SET Priority = {FAILED} WHERE ProgramID = ? AND Year = ?",
+          ((int(idx), year) for idx in stream_ids([path]))
+        )
+    conn.execute("CREATE INDEX temp.ScheduleOrder ON Schedule (Priority, Stamp, Seq, Year)")
+    conn.commit()
+    counts = dict(conn.execute("SELECT Priority, COUNT(*) FROM temp.Schedule GROUP BY Priority"))
+    return {name: counts.get(priority, 0) for priority, name in PRIORITY_NAMES.items()}
+
+  def __len__(self) -> int:
+    return self.db.conn.execute("SELECT COUNT(*) FROM temp.Schedule").fetchone()[0]
+
+  def __iter__(self) -> Iterator[Tuple[str, int]]:
+    # Keyset pagination, so no cursor stays open while the crawler writes
+    last = (-1, "", -1, -1)
+    while True:
+      rows = self.db.conn.execute(
+        """
+        SELECT
+          Priority, Stamp, Seq, Year, ProgramID
+        FROM
+          temp.Schedule
+        WHERE
+          (Priority, Stamp, Seq, Year) > (?, ?, ?, ?)
+        ORDER BY
+          Priority, Stamp, Seq, Year
+        LIMIT ?
+        """, last + (self.page_size, )
+      ).fetchall()
+      if len(rows) == 0:
+        return
+      for row in rows:
+        yield str(row[4]), row[3]
+      last = rows[-1][:4]
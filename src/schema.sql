@@ -64,3 +64,14 @@ CREATE TABLE HighSchoolPlacement (
     FOREIGN KEY (ProgramID) REFERENCES Program(ProgramID),
     PRIMARY KEY (HighSchoolID, ProgramID, Year)
 );
+
+-- PanelHash Table
+CREATE TABLE PanelHash (
+    ProgramID INTEGER NOT NULL,
+    Year INTEGER NOT NULL,
+    PanelID TEXT NOT NULL,
+    Hash TEXT NOT NULL,
+    UpdatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CheckedAt TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (ProgramID, Year, PanelID)
+);
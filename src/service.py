@@ -0,0 +1,360 @@
+""" Headless JSON query service over the crawl database, sharing one result cache """
+
+import itertools
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from database import CHART_COLUMNS, CrawlDatabase, serving_options
+from log_utils import get_file_logger
+from result_store import ResultStore, filter_key
+
+
+class DatabasePool:
+  """
+  Fixed set of CrawlDatabase handles shared by the request threads
+
+  SQLite connections must not be used by two threads at once, so every request
+  borrows a handle of its own and gives it back when done.
+
+  Parameters
+  ----------
+  path
+    Path to the database file
+
+  size
+    Number of connections, i.e. queries that can run at the same time
+
+  options
+    CrawlDatabase options of every connection, e.g. read_only
+  """
+  def __init__(self, path: str, size: int = 4, **options):
+    self.handles = queue.Queue()
+    for _ in range(size):
+      self.handles.put(CrawlDatabase(path, **options))
+
+  @contextmanager
+  def connection(self):
+    db = self.handles.get()
+    try:
+      yield db
+    finally:
+      self.handles.put(db)
+
+
+class QueryService(ThreadingHTTPServer):
+  """
+  Threaded HTTP server answering the dashboard queries as JSON
+
+  Endpoints
+  ---------
+  GET /options/uni, /options/hs
+    Filter options, i.e. get_uni_filter_data and get_hs_filter_data
+
+  GET /chart?uni_name=...&year=2023
+    get_chart_data, filtered by any number of repeated column aliases. Without
+    filters the rows are streamed from the database and not cached
+
+  GET /aggregate?group_by=uni_name&group_by=year&uni_type=State
+    get_aggregate_data with the same filters
+
+  GET /stats
+    Cache statistics
+
+  Results are kept in a ResultStore shared by all requests, so repeated queries
+  from different consumers are only run once. The store is cleared when another
+  process, e.g. a crawler, commits to the database. Rows are streamed with chunked
+  transfer encoding as a JSON array, or as JSON lines with format=ndjson. POST
+  requests take the same parameters as a JSON object.
+
+  Parameters
+  ----------
+  address
+    (host, port) to listen on
+
+  database
+    Path to the database file
+
+  connections
+    Number of database connections
+
+  cache_mb
+    Memory ceiling of the shared result cache
+
+  options
+    CrawlDatabase options of the connections, see serving_options. A read-only
+    database is pre-warmed before the server accepts requests
+  """
+  daemon_threads = True
+
+  def __init__(
+    self,
+    address: Tuple[str, int],
+    database: str,
+    connections: int = 4,
+    cache_mb: float = 512,
+    **options,
+  ):
+    super().__init__(address, ServiceHandler)
+    self.pool = DatabasePool(database, connections, **options)
+    self.store = ResultStore(max_bytes=int(cache_mb * 2**20))
+    # data_version counts the commits of other connections, so the pooled
+    # connections, which only read, cannot be compared with each other
+    self.watch = CrawlDatabase(database, **options)
+    self.watch_lock = threading.Lock()
+    self.version = self.watch.data_version()
+    if options.get("read_only"):
+      # The connections share the pages through the OS page cache and the mmap
+      with self.pool.connection() as db:
+        db.prewarm()
+
+  def check_version(self):
+    """ Clear the result store if the database changed since the last check """
+    with self.watch_lock:
+      version = self.watch.data_version()
+      if version != self.version:
+        self.version = version
+        self.store.clear()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  chunk_rows = 5000
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    self.respond(lambda: self.handle_query(url.path, parse_qs(url.query)))
+
+  def do_POST(self):
+    url = urlparse(self.path)
+
+    def post():
+      try:
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_body(json.loads(self.rfile.read(length) or b"{}"))
+      except ValueError as e:
+        # json.JSONDecodeError is a ValueError as well
+        return self.send_json(400, {"error": f"Invalid JSON body: {e}"})
+      self.handle_query(url.path, params)
+
+    self.respond(post)
+
+  def respond(self, handle: Callable[[], None]):
+    """ Run a request, answering a JSON 500 instead of dropping the connection on any error """
+    self.responded = False
+    try:
+      handle()
+    except Exception as e:
+      get_file_logger("service", "service.log").exception(
+        f"Request {self.command} {self.path} failed"
+      )
+      if self.responded:
+        # Part of the answer is sent already, the client sees the cut stream
+        self.close_connection = True
+      else:
+        self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+  def send_response(self, code: int, message: Optional[str] = None):
+    self.responded = True
+    super().send_response(code, message)
+
+  def handle_query(self, path: str, params: Dict[str, List]):
+    service = self.server
+    start = time.perf_counter()
+    try:
+      output = params.pop("format", ["json"])
+      if len(output) != 1 or output[0] not in ("json", "ndjson"):
+        raise ValueError("format must be json or ndjson")
+      output = output[0]
+      if path == "/stats":
+        return self.send_json(200, service.store.stats())
+      elif path == "/options/uni":
+        key, load = ("options", "uni"), lambda db: db.get_uni_filter_data()
+      elif path == "/options/hs":
+        key, load = ("options", "hs"), lambda db: db.get_hs_filter_data()
+      elif path == "/chart":
+        filters = parse_filters(params)
+        key, load = ("chart", filter_key(filters)), lambda db: db.get_chart_data(filters)
+      elif path == "/aggregate":
+        group_by = params.pop("group_by", [])
+        unknown = [alias for alias in group_by if alias not in CHART_COLUMNS]
+        if len(unknown) != 0:
+          raise ValueError(f"Unknown group_by columns: {', '.join(unknown)}")
+        filters = parse_filters(params)
+        key = ("aggregate", tuple(group_by), filter_key(filters))
+        load = lambda db: db.get_aggregate_data(group_by, filters)
+      else:
+        return self.send_json(404, {"error": f"Unknown endpoint {path}"})
+    except (TypeError, ValueError) as e:
+      return self.send_json(400, {"error": str(e)})
+    if path == "/chart" and len(filters) == 0:
+      # The whole join is not kept in memory, its rows go from the cursor to the client
+      return self.stream_rows(output, start)
+
+    def run() -> pd.DataFrame:
+      with service.pool.connection() as db:
+        return load(db)
+
+    try:
+      service.check_version()
+      handle = service.store.get(key, run)
+    except Exception as e:
+      # E.g. a locked database or a missing year file, the client still gets an answer
+      get_file_logger("service", "service.log").exception(f"Query {path} {params} failed")
+      return self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+    df = handle.frame
+    chunks = (df.iloc[i:i + self.chunk_rows] for i in range(0, len(df), self.chunk_rows))
+    try:
+      self.stream(chunks, output, time.perf_counter() - start, len(df))
+    except (BrokenPipeError, ConnectionResetError):
+      # The consumer stopped reading, e.g. after the first rows
+      self.close_connection = True
+    finally:
+      handle.release()
+
+  def stream_rows(self, output: str, start: float):
+    """
+    Stream the unfiltered chart data from the database cursor, batch by batch
+
+    The result is neither cached nor built in memory. A connection of the pool is
+    held until the last batch is sent.
+    """
+    with self.server.pool.connection() as db:
+      batches = db.iter_chart_data(None, self.chunk_rows)
+      try:
+        # Query errors surface before the response starts, as a JSON 500
+        first = next(batches, None)
+        chunks = itertools.chain([] if first is None else [first], batches)
+        self.stream(chunks, output, time.perf_counter() - start)
+      except (BrokenPipeError, ConnectionResetError):
+        self.close_connection = True
+      finally:
+        batches.close()
+
+  def stream(
+    self, chunks: Iterable[pd.DataFrame], output: str, seconds: float, rows: Optional[int] = None
+  ):
+    """ Write the chunks of rows as they come, so large results are not serialized at once """
+    ndjson = output == "ndjson"
+    self.send_response(200)
+    self.send_header("Content-Type", "application/x-ndjson" if ndjson else "application/json")
+    self.send_header("Transfer-Encoding", "chunked")
+    if rows is not None:
+      self.send_header("X-Rows", str(rows))
+    self.send_header("X-Query-Seconds", f"{seconds:.4f}")
+    self.end_headers()
+    if not ndjson:
+      self.write_chunk("[")
+    first = True
+    for chunk in chunks:
+      if len(chunk) == 0:
+        continue
+      if ndjson:
+        # Newer pandas end the lines with a newline, older ones do not
+        lines = chunk.to_json(orient="records", lines=True, force_ascii=False)
+        self.write_chunk(lines.rstrip("\n") + "\n")
+      else:
+        records = chunk.to_json(orient="records", force_ascii=False)[1:-1]
+        self.write_chunk(("" if first else ",") + records)
+      first = False
+    if not ndjson:
+      self.write_chunk("]")
+    self.wfile.write(b"0\r\n\r\n")
+
+  def write_chunk(self, text: str):
+    data = text.encode("utf-8")
+    self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+  def send_json(self, status: int, payload: dict):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def parse_body(body: Any) -> Dict[str, List]:
+  """
+  Parameters of a POST request from its JSON object
+
+  Every value must be a string or a number, or a list of them. A single value
+  is the same as a list with one element. Numbers are turned into strings, like
+  the parameters of a GET request.
+  """
+  if not isinstance(body, dict):
+    raise ValueError(f"expected an object, got {type(body).__name__}")
+  params = {}
+  for key, value in body.items():
+    values = value if isinstance(value, list) else [value]
+    if not all(isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in values):
+      raise ValueError(f"{key} must be a string, a number or a list of them")
+    params[key] = [str(v) for v in values]
+  return params
+
+
+def parse_filters(params: Dict[str, List]) -> Dict[str, List]:
+  """ Validate the filter parameters of a request against the chart columns """
+  unknown = [key for key in params if key not in CHART_COLUMNS]
+  if len(unknown) != 0:
+    raise ValueError(f"Unknown filters: {', '.join(unknown)}")
+  filters = {key: list(values) for key, values in params.items()}
+  if "year" in filters:
+    try:
+      filters["year"] = [int(year) for year in filters["year"]]
+    except (TypeError, ValueError):
+      raise ValueError("year must be an integer")
+  return filters
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  from yaml import full_load
+
+  parser = ArgumentParser(description="JSON query service for the Atlas-Crawl database")
+  parser.add_argument(
+    "--database", default=None, help="Database file (Default db_path of configs.yaml)"
+  )
+  parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+  parser.add_argument(
+    "-p", "--port", default=8600, type=int, help="Port to listen on (Default 8600)"
+  )
+  parser.add_argument(
+    "-c", "--connections", default=4, type=int, help="Number of database connections (Default 4)"
+  )
+  parser.add_argument(
+    "--read-only",
+    action="store_true",
+    help="Serve a snapshot read-only and immutable (Default read_only of configs.yaml)"
+  )
+  args = parser.parse_args()
+
+  with open("configs.yaml", "r") as f:
+    config = full_load(f)
+  options = serving_options(config)
+  options["read_only"] = options["read_only"] or args.read_only
+  service = QueryService(
+    (args.host, args.port),
+    args.database or config["db_path"],
+    args.connections,
+    config.get("result_store_mb", 512),
+    **options,
+  )
+  print(
+    f"Serving {args.database or config['db_path']}{' read-only' if options['read_only'] else ''} "
+    f"on http://{args.host}:{args.port}"
+  )
+  try:
+    service.serve_forever()
+  except KeyboardInterrupt:
+    service.server_close()
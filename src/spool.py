@@ -0,0 +1,220 @@
+""" Append-only spool files that decouple crawling from the database writes """
+
+import os
+import glob
+import heapq
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from panels import Panel
+from log_utils import get_file_logger
+from telemetry import timed
+
+
+def _to_json(value: Any):
+  """ json.dumps fallback for the numpy scalars produced by the parsers """
+  if isinstance(value, np.generic):
+    return value.item()
+  raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _now() -> str:
+  """ Current UTC time in SQLite's time format with milliseconds, which sorts as text """
+  return datetime.now(timezone.utc).isoformat(sep=" ", timespec="milliseconds")[:-len("+00:00")]
+
+
+class SpoolWriter:
+  """
+  Append the parsed panels of a crawl to a local JSON lines file
+
+  Every record is a single line holding the panel name, the program, the year,
+  the content hash, the time it was written and the parsed data, so concurrent
+  crawlers never touch the database. The spools are ingested later with `python database.py load`.
+  Programs fetched without errors also get a "checked" record with the time of
+  the fetch, so the programs whose panels did not change count as refreshed.
+
+  Parameters
+  ----------
+  directory
+    Directory of the spool files. Created if it does not exist
+
+  name
+    Name of the spool file, unique per crawler, e.g. <hostname>-<pid>
+  """
+  def __init__(self, directory: str, name: str):
+    os.makedirs(directory, exist_ok=True)
+    self.path = os.path.join(directory, f"{name}.jsonl")
+    self.file = open(self.path, "a", encoding="utf-8")
+
+  @timed("spool.append")
+  def append(
+    self,
+    panel: Panel,
+    data: Any,
+    idx: str,
+    year: int,
+    digest: Optional[str] = None,
+    replace: bool = False,
+  ):
+    if isinstance(data, pd.DataFrame):
+      data = data.to_dict("records")
+    record = {
+      "panel": panel.name,
+      "panel_id": panel.panel_id,
+      "idx": str(idx),
+      "year": int(year),
+      "digest": digest,
+      "replace": replace,
+      "written_at": _now(),
+      "data": data,
+    }
+    self.file.write(json.dumps(record, ensure_ascii=False, default=_to_json) + "\n")
+    # One flush per record, a crash loses at most the record being written
+    self.file.flush()
+
+  def checked(self, idx: str, year: int):
+    record = {
+      "panel": "checked",
+      "idx": str(idx),
+      "year": int(year),
+      "written_at": _now(),
+    }
+    self.file.write(json.dumps(record) + "\n")
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+
+def spool_files(paths: Iterable[str]) -> List[str]:
+  """ Expand spool directories and glob patterns into a sorted list of files """
+  files = []
+  for path in paths:
+    if os.path.isdir(path):
+      files.extend(glob.glob(os.path.join(path, "*.jsonl")))
+    else:
+      files.extend(glob.glob(path))
+  return sorted(set(files))
+
+
+def read_spool(path: str) -> Iterator[Dict[str, Any]]:
+  """ Yield the records of a spool file, skipping lines cut short by a crash """
+  with open(path, "r", encoding="utf-8") as f:
+    for number, line in enumerate(f, 1):
+      try:
+        yield json.loads(line)
+      except json.JSONDecodeError:
+        get_file_logger("db_logger", "db_operations.log").error(
+          f"Skipping malformed spool record {path}:{number}"
+        )
+
+
+def written_at(record: Dict[str, Any]) -> str:
+  """ Time a record was spooled """
+  return record["written_at"]
+
+
+def read_spools(paths: Iterable[str]) -> Iterator[Dict[str, Any]]:
+  """
+  Yield the records of the spool files in the order they were written
+
+  Every file is written by one crawler in time order, so the files are merged
+  by the write time of their records instead of being read one after another.
+  """
+  yield from heapq.merge(*(read_spool(path) for path in spool_files(paths)), key=written_at)
+
+
+def load_spools(
+  db, paths: Iterable[str], batch_size: int = 2000, archive: bool = True
+) -> Dict[str, Any]:
+  """
+  Bulk-ingest spool files into the database
+
+  Records are grouped into batches of programs and every batch is written with
+  CrawlDatabase.bulk_load in one transaction. When a panel of a program appears
+  more than once, the last written record wins, whichever file it is in. Panels
+  whose stored version was written at the same time or later than a record,
+  e.g. by a direct crawl or an earlier load of the same spool, are skipped.
+
+  The panel hash table and the year files of a partitioned database are created
+  here if needed, the crawlers do not write to the database. The panel hashes
+  are stamped with the write time of their records. When all batches are
+  written, the files are renamed to *.jsonl.loaded, so the next load of the
+  spool directory skips them. Only load the spools of crawlers that have
+  finished, a crawler still running keeps appending to the renamed file.
+
+  Parameters
+  ----------
+  db
+    The CrawlDatabase to load into
+
+  paths
+    Spool files, directories or glob patterns
+
+  batch_size
+    Number of panel records per transaction
+
+  archive
+    Rename the loaded files
+
+  Returns
+  -------
+  stats
+    Number of records read and skipped, rows written per table, the loaded
+    (program_id, year) pairs and the archived files
+  """
+  files = spool_files(paths)
+  counts, touched, total, skipped = {}, set(), 0, 0
+  # bulk_load creates the year files
+  db.ensure_panel_hashes()
+
+  def flush(batch: Dict[tuple, dict]):
+    nonlocal skipped
+    rankings, highschools, hashes, checks = [], [], [], []
+    stored = db.get_panel_updates({(idx, year) for panel, idx, year in batch if panel != "checked"})
+    for (panel, idx, year), record in batch.items():
+      if panel == "checked":
+        checks.append((idx, year, written_at(record)))
+        continue
+      time = written_at(record)
+      if stored.get((int(idx), int(year), record["panel_id"]), "") >= time:
+        skipped += 1
+        continue
+      if panel == "ranking":
+        rankings.append((record["data"], record["replace"]))
+      elif panel == "highschools":
+        highschools.append((idx, year, record["data"], record["replace"]))
+      else:
+        continue
+      if record["digest"] is not None:
+        hashes.append((idx, year, record["panel_id"], record["digest"], time))
+      touched.add((idx, year))
+    for table, count in db.bulk_load(rankings, highschools, hashes).items():
+      counts[table] = counts.get(table, 0) + count
+    # After the hashes of the batch, a check never moves CheckedAt back
+    db.mark_checked(checks)
+
+  batch = {}
+  for record in read_spools(files):
+    total += 1
+    batch[record["panel"], record["idx"], record["year"]] = record
+    if len(batch) >= batch_size:
+      flush(batch)
+      batch = {}
+  flush(batch)
+  archived = []
+  if archive:
+    for path in files:
+      os.replace(path, path + ".loaded")
+      archived.append(path + ".loaded")
+  return {
+    "records": total,
+    "skipped": skipped,
+    "rows": counts,
+    "touched": sorted(touched),
+    "archived": archived,
+  }
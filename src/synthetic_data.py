@@ -0,0 +1,251 @@
+""" Synthetic national-scale database generator for storage and query benchmarks """
+
+import time
+import random
+from itertools import accumulate
+import sqlite3 as sl
+from typing import Iterator, List, Tuple
+
+from database import CrawlDatabase
+
+CITIES = [
+  "ADANA", "ANKARA", "ANTALYA", "BURSA", "DENİZLİ", "DİYARBAKIR", "ERZURUM", "ESKİŞEHİR",
+  "GAZİANTEP", "HATAY", "İSTANBUL", "İZMİR", "KAYSERİ", "KOCAELİ", "KONYA", "MALATYA",
+  "MANİSA", "MERSİN", "SAKARYA", "SAMSUN", "TEKİRDAĞ", "TRABZON", "VAN", "ZONGULDAK"
+]
+DISTRICTS = [
+  "MERKEZ", "ÇANKAYA", "KEÇİÖREN", "KADIKÖY", "ÜSKÜDAR", "BORNOVA", "KARŞIYAKA", "NİLÜFER",
+  "OSMANGAZİ", "SELÇUKLU", "MERAM", "SEYHAN", "ÇUKUROVA", "ORTAHİSAR", "MURATPAŞA", "İZMİT"
+]
+HS_TYPES = [
+  "ANADOLU LİSESİ", "FEN LİSESİ", "KOLEJİ", "İMAM HATİP LİSESİ", "MESLEKİ VE TEKNİK ANADOLU LİSESİ"
+]
+FACULTIES = [
+  "Mühendislik Fakültesi", "Fen Fakültesi", "Tıp Fakültesi", "Hukuk Fakültesi",
+  "İktisadi ve İdari Bilimler Fakültesi", "Eğitim Fakültesi", "İletişim Fakültesi",
+  "Mimarlık Fakültesi", "Edebiyat Fakültesi", "Sağlık Bilimleri Fakültesi"
+]
+PROGRAMS = [
+  ("Bilgisayar Mühendisliği", "SAY"), ("Elektrik-Elektronik Mühendisliği", "SAY"),
+  ("Makine Mühendisliği", "SAY"), ("Tıp", "SAY"), ("Matematik", "SAY"), ("Fizik", "SAY"),
+  ("Hukuk", "EA"), ("İktisat", "EA"), ("İşletme", "EA"), ("Psikoloji", "EA"),
+  ("Türk Dili ve Edebiyatı", "SÖZ"), ("Tarih", "SÖZ"), ("İngilizce Öğretmenliği", "DİL"),
+  ("Mütercim ve Tercümanlık", "DİL")
+]
+SCHOLARSHIPS = ["Burslu", "50", "25", "Ücretli", "Devlet"]
+
+
+class SyntheticDataGenerator:
+  """
+  Fill an Atlas-Crawl database with realistic synthetic data
+
+  High school popularity is heavy tailed so that a few high schools place graduates
+  into many programs, like the real data. Everything is seeded, so the same
+  parameters always produce the same database.
+
+  Parameters
+  ----------
+  universities
+    Number of universities
+
+  programs
+    Number of programs across all universities
+
+  highschools
+    Number of high schools
+
+  years
+    Years to generate placement data for
+
+  placements_per_program
+    Mean number of high schools placing graduates into a program per year
+
+  seed
+    Random seed
+  """
+  def __init__(
+    self,
+    universities: int = 200,
+    programs: int = 10000,
+    highschools: int = 25000,
+    years: Tuple[int, ...] = (2019, 2020, 2021, 2022, 2023),
+    placements_per_program: int = 40,
+    seed: int = 0,
+  ):
+    self.universities = universities
+    self.programs = programs
+    self.highschools = highschools
+    self.years = tuple(years)
+    self.placements_per_program = placements_per_program
+    self.rng = random.Random(seed)
+    # Heavy tailed high school popularity, sampled with random.choices
+    self.hs_weights = list(accumulate(self.rng.paretovariate(1.2) for _ in range(highschools)))
+
+  def university_rows(self) -> List[tuple]:
+    return [
+      (
+        i + 1, f"SENTETİK {i + 1} ÜNİVERSİTESİ", "State" if i % 3 else "Private",
+        CITIES[i % len(CITIES)]
+      ) for i in range(self.universities)
+    ]
+
+  def faculty_rows(self) -> List[tuple]:
+    rows = []
+    for uni in range(1, self.universities + 1):
+      for name in self.rng.sample(FACULTIES, self.rng.randint(3, len(FACULTIES))):
+        rows.append((len(rows) + 1, uni, name))
+    return rows
+
+  def program_rows(self, faculties: int) -> List[tuple]:
+    rows = []
+    for i in range(self.programs):
+      name, prog_type = self.rng.choice(PROGRAMS)
+      rows.append(
+        (
+          100000000 + i, self.rng.randint(1, faculties), name, self.rng.choice(SCHOLARSHIPS),
+          prog_type
+        )
+      )
+    return rows
+
+  def highschool_rows(self) -> Iterator[tuple]:
+    for i in range(self.highschools):
+      city = CITIES[self.rng.randrange(len(CITIES))]
+      district = DISTRICTS[self.rng.randrange(len(DISTRICTS))]
+      yield (i + 1, f"SENTETİK {i + 1} {self.rng.choice(HS_TYPES)}", city, district)
+
+  def placement_rows(self, program_ids: List[int]) -> Iterator[Tuple[tuple, List[tuple]]]:
+    """ Yield the PlacementData row and the HighSchoolPlacement rows of every program-year """
+    hs_ids = range(1, self.highschools + 1)
+    for idx in program_ids:
+      quota = self.rng.randint(20, 150)
+      base_ranking = self.rng.randint(500, 450000)
+      for year in self.years:
+        n_hs = max(1, int(self.rng.gauss(self.placements_per_program, 10)))
+        schools = set(self.rng.choices(hs_ids, cum_weights=self.hs_weights, k=n_hs))
+        grads = []
+        for hs in schools:
+          new, old = self.rng.randint(0, 3), self.rng.randint(0, 2)
+          if new + old == 0:
+            new = 1
+          grads.append((hs, idx, year, new, old))
+        placed = sum(g[3] + g[4] for g in grads)
+        min_ranking = max(1, int(base_ranking * self.rng.uniform(0.8, 1.2)))
+        placement = (
+          idx, year, self.rng.uniform(200, 400), self.rng.uniform(400, 560), max(quota, placed),
+          placed, self.rng.randint(1, min_ranking), min_ranking
+        )
+        yield placement, grads
+
+  def populate(self, db: CrawlDatabase, batch_size: int = 100000) -> dict:
+    """
+    Insert the synthetic rows into an empty database created from schema.sql
+
+    Parameters
+    ----------
+    db
+      Database handle to fill
+
+    batch_size
+      Number of HighSchoolPlacement rows inserted per executemany call
+
+    Returns
+    -------
+    counts
+      Number of rows inserted per table
+    """
+    conn = db.conn
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    counts = {}
+    with conn:
+      universities = self.university_rows()
+      conn.executemany("INSERT INTO University VALUES (?, ?, ?, ?)", universities)
+      faculties = self.faculty_rows()
+      conn.executemany(
+        "INSERT INTO Faculty (FacultyID, UniversityID, FacultyName) VALUES (?, ?, ?)", faculties
+      )
+      programs = self.program_rows(len(faculties))
+      conn.executemany(
+        """
+        INSERT INTO
+          Program (ProgramID, FacultyID, ProgramName, ScholarshipType, ProgramType)
+        VALUES (?, ?, ?, ?, ?)
+        """, programs
+      )
+      conn.executemany(
+        "INSERT INTO HighSchool (HighSchoolID, HighSchoolName, City, District) VALUES (?, ?, ?, ?)",
+        self.highschool_rows()
+      )
+      counts.update(
+        University=len(universities),
+        Faculty=len(faculties),
+        Program=len(programs),
+        HighSchool=self.highschools,
+        PlacementData=0,
+        HighSchoolPlacement=0
+      )
+
+      placements, grads = [], []
+      for placement, rows in self.placement_rows([p[0] for p in programs]):
+        placements.append(placement)
+        grads.extend(rows)
+        if len(grads) >= batch_size:
+          self._flush(conn, placements, grads, counts)
+          placements, grads = [], []
+      self._flush(conn, placements, grads, counts)
+    return counts
+
+  @staticmethod
+  def _flush(conn: sl.Connection, placements: List[tuple], grads: List[tuple], counts: dict):
+    conn.executemany(
+      """
+      INSERT INTO
+        PlacementData (
+          ProgramID, Year, LowestScore, HighestScore, TotalQuota, TotalPlaced, MaximumRanking,
+          MinimumRanking
+        )
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      """, placements
+    )
+    conn.executemany("INSERT INTO HighSchoolPlacement VALUES (?, ?, ?, ?, ?)", grads)
+    counts["PlacementData"] += len(placements)
+    counts["HighSchoolPlacement"] += len(grads)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+
+  parser = ArgumentParser(description="Generate a synthetic Atlas-Crawl database")
+  parser.add_argument("path", help="Path of the database to create")
+  parser.add_argument("--universities", default=200, type=int, help="Number of universities")
+  parser.add_argument("--programs", default=10000, type=int, help="Number of programs")
+  parser.add_argument("--highschools", default=25000, type=int, help="Number of high schools")
+  parser.add_argument(
+    "--years", default="2019-2023", help="Inclusive year range to generate (Default 2019-2023)"
+  )
+  parser.add_argument(
+    "--placements",
+    default=40,
+    type=int,
+    help="Mean number of high schools per program and year (Default 40)"
+  )
+  parser.add_argument("--seed", default=0, type=int, help="Random seed")
+  args = parser.parse_args()
+
+  start_year, _, end_year = args.years.partition("-")
+  years = tuple(range(int(start_year), int(end_year or start_year) + 1))
+
+  with open("./schema.sql", "r", encoding="utf-8") as f:
+    schema = f.read()
+  db = CrawlDatabase.create_from_schema(schema=schema, path=args.path)
+
+  start = time.perf_counter()
+  generator = SyntheticDataGenerator(
+    args.universities, args.programs, args.highschools, years, args.placements, args.seed
+  )
+  counts = generator.populate(db)
+  db.score_highschools()
+  for table, count in counts.items():
+    print(f"+ {table}: {count} rows")
+  print(f"Generated in {time.perf_counter() - start:.1f} seconds")
@@ -0,0 +1,180 @@
+import json
+import time
+import random
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class StageStats:
+  """
+  Running count, total, minimum and maximum of the samples of a stage
+
+  The percentiles are taken from a uniform random sample of at most `size`
+  samples (reservoir sampling), so they are exact until a stage has more
+  samples than that and estimates afterwards, while memory stays bounded.
+  """
+  def __init__(self, size: int = 1024):
+    self.size = size
+    self.count = 0
+    self.total = 0.0
+    self.min = float("inf")
+    self.max = float("-inf")
+    self.reservoir: List[float] = []
+
+  def add(self, seconds: float):
+    self.count += 1
+    self.total += seconds
+    self.min = min(self.min, seconds)
+    self.max = max(self.max, seconds)
+    if len(self.reservoir) < self.size:
+      self.reservoir.append(seconds)
+    else:
+      # Every sample so far stays in the reservoir with the same probability
+      slot = random.randrange(self.count)
+      if slot < self.size:
+        self.reservoir[slot] = seconds
+
+
+class Telemetry:
+  """
+  Per-stage timing collector for the crawler
+
+  Every timed stage is aggregated in memory for the end-of-run summary and, if a
+  path is given, written as it happens: one JSON object per line for .jsonl
+  files. Files with the .prom extension are written in the Prometheus text
+  format instead, rewritten on flush() with the percentiles so far.
+
+  Parameters
+  ----------
+  path
+    Where to write the metrics. Nothing is written if not given
+
+  reservoir
+    Number of samples per stage kept for the percentiles, see StageStats
+  """
+  def __init__(self, path: Optional[str] = None, reservoir: int = 1024):
+    self.path = path
+    self.prometheus = path is not None and path.endswith(".prom")
+    self.reservoir = reservoir
+    self.stats: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], StageStats] = {}
+    self.lock = threading.Lock()
+    self.file = None
+    if path is not None and not self.prometheus:
+      self.file = open(path, "a", encoding="utf-8")
+
+  @contextmanager
+  def stage(self, name: str, **labels):
+    """ Time the enclosed block as one sample of the stage """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, time.perf_counter() - start, **labels)
+
+  def record(self, name: str, seconds: float, **labels):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with self.lock:
+      if key not in self.stats:
+        self.stats[key] = StageStats(self.reservoir)
+      self.stats[key].add(seconds)
+      if self.file is not None:
+        line = {"ts": time.time(), "stage": name, "seconds": seconds, **labels}
+        self.file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+  def summary(self) -> List[dict]:
+    """ Count, total and percentiles of every stage, slowest total first """
+    rows = []
+    with self.lock:
+      items = [
+        (key, stats.count, stats.total, stats.min, stats.max, sorted(stats.reservoir))
+        for key, stats in self.stats.items()
+      ]
+    for (name, labels), count, total, minimum, maximum, values in items:
+      row = {"stage": name, **dict(labels), "count": count, "total": total}
+      for q in QUANTILES:
+        row[f"p{int(q * 100)}"] = values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+      row["min"] = minimum
+      row["max"] = maximum
+      rows.append(row)
+    return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+  def format_summary(self) -> str:
+    lines = [
+      f"{'stage':<40} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}"
+    ]
+    for row in self.summary():
+      labels = ",".join(f"{k}={v}" for k, v in row.items() if k not in STAT_KEYS)
+      name = row["stage"] + (f"[{labels}]" if labels else "")
+      lines.append(
+        f"{name:<40} {row['count']:>7} {row['total']:>9.2f} {row['p50'] * 1000:>9.1f} "
+        f"{row['p90'] * 1000:>9.1f} {row['p99'] * 1000:>9.1f}"
+      )
+    return "\n".join(lines)
+
+  def prometheus_text(self) -> str:
+    lines = [
+      "# HELP atlas_crawl_stage_seconds Time spent in each crawl stage",
+      "# TYPE atlas_crawl_stage_seconds summary",
+    ]
+    for row in self.summary():
+      labels = [f'stage="{row["stage"]}"']
+      labels += [f'{k}="{v}"' for k, v in row.items() if k not in STAT_KEYS]
+      for q in QUANTILES:
+        quantile = ",".join(labels + [f'quantile="{q}"'])
+        lines.append(f"atlas_crawl_stage_seconds{{{quantile}}} {row[f'p{int(q * 100)}']}")
+      lines.append(f"atlas_crawl_stage_seconds_sum{{{','.join(labels)}}} {row['total']}")
+      lines.append(f"atlas_crawl_stage_seconds_count{{{','.join(labels)}}} {row['count']}")
+    return "\n".join(lines) + "\n"
+
+  def flush(self):
+    if self.file is not None:
+      self.file.flush()
+    elif self.prometheus:
+      with open(self.path, "w", encoding="utf-8") as f:
+        f.write(self.prometheus_text())
+
+  def close(self):
+    self.flush()
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+STAT_KEYS = {"stage", "count", "total", "min", "max"} | {f"p{int(q * 100)}" for q in QUANTILES}
+
+# Process wide collector, replaced by configure() when metrics are written to a file
+_telemetry = Telemetry()
+
+
+def configure(path: Optional[str] = None) -> Telemetry:
+  """ Replace the process wide collector, e.g. to write the metrics to a file """
+  global _telemetry
+  _telemetry.close()
+  _telemetry = Telemetry(path)
+  return _telemetry
+
+
+def get_telemetry() -> Telemetry:
+  return _telemetry
+
+
+def stage(name: str, **labels):
+  """ Time the enclosed block with the process wide collector """
+  return _telemetry.stage(name, **labels)
+
+
+def timed(name: str) -> Callable:
+  """ Decorator that times every call of the function as the given stage """
+  def decorator(func: Callable) -> Callable:
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      with _telemetry.stage(name):
+        return func(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
@@ -0,0 +1,34 @@
+""" Tests of the crawl benchmark harness, run with python -m pytest """
+
+import os
+from argparse import Namespace
+
+import bench_crawl
+from telemetry import Telemetry
+
+
+def test_main_loop_reports_telemetry_percentiles(tmp_path, monkeypatch):
+  runs = []
+
+  def run(command, cwd, **kwargs):
+    runs.append((command, cwd))
+    # What the crawler writes with --metrics
+    telemetry = Telemetry(command[command.index("--metrics") + 1])
+    for seconds in [0.1, 0.2, 0.3]:
+      telemetry.record("fetch", seconds)
+      telemetry.record("write_panel", seconds / 10, panel="ranking")
+    telemetry.record("navigation", 5.0, panel="ranking")
+    telemetry.close()
+  monkeypatch.setattr(bench_crawl.subprocess, "run", run)
+
+  args = Namespace(year=2023, timeout_patience=5, lean=False)
+  report = bench_crawl.bench_main_loop(
+    args, ["101", "102"], str(tmp_path / "main_loop.db"), "http://127.0.0.1:1"
+  )
+  [(command, cwd)] = runs
+  # The crawler logs to ../logs of a scratch directory, not of src/
+  assert os.path.dirname(cwd) == str(tmp_path)
+  assert command[1] == os.path.join(os.path.dirname(bench_crawl.__file__), "crawler.py")
+  assert (report["programs"], report["crawled"]) == (2, 0)
+  assert (report["fetch_p50"], report["fetch_p99"]) == (0.2, 0.3)
+  assert (report["write_p50"], report["write_p99"]) == (0.02, 0.03)
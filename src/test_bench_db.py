@@ -0,0 +1,45 @@
+""" Tests of the synthetic database and the benchmark baseline, run with python -m pytest """
+
+from bench_db import compare
+from database import CrawlDatabase
+from synthetic_data import SyntheticDataGenerator
+
+
+def test_tiny_synthetic_database(db_path):
+  db = CrawlDatabase(db_path)
+  generator = SyntheticDataGenerator(
+    universities=3, programs=20, highschools=50, years=(2022, 2023), placements_per_program=5
+  )
+  counts = generator.populate(db, batch_size=16)
+  stored = {
+    table: db.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in counts
+  }
+  assert stored == counts
+  assert (counts["University"], counts["Program"], counts["HighSchool"]) == (3, 20, 50)
+  # One placement row per program and year, with at least one high school each
+  assert counts["PlacementData"] == 40
+  assert counts["HighSchoolPlacement"] >= 40
+  assert db.conn.execute("PRAGMA foreign_key_check").fetchall() == []
+  placed = db.conn.execute(
+    """
+    SELECT COUNT(*) FROM PlacementData pd
+    WHERE pd.TotalPlaced != (
+      SELECT SUM(hsp.NumberOfNewGrads + hsp.NumberOfOldGrads) FROM HighSchoolPlacement hsp
+      WHERE hsp.ProgramID = pd.ProgramID AND hsp.Year = pd.Year
+    )
+    """
+  ).fetchone()[0]
+  assert placed == 0
+
+
+def test_same_seed_same_rows():
+  rows = [SyntheticDataGenerator(programs=5, highschools=20).program_rows(10) for _ in range(2)]
+  assert rows[0] == rows[1]
+
+
+def test_compare_flags_regression():
+  baseline = {"fast": {"p50": 0.10}, "slow": {"p50": 0.10}, "removed": {"p50": 0.10}}
+  results = {"fast": {"p50": 0.12}, "slow": {"p50": 0.13}, "added": {"p50": 1.0}}
+  regressions = compare(results, baseline, tolerance=0.25)
+  assert len(regressions) == 1
+  assert regressions[0].startswith("slow: p50 130.0 ms vs baseline 100.0 ms")
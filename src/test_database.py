@@ -0,0 +1,152 @@
+""" Tests of CrawlDatabase, run with python -m pytest """
+
+import os
+import shutil
+import sqlite3 as sl
+
+import pandas as pd
+import pytest
+
+import database
+from database import CrawlDatabase
+
+
+def test_snapshot_files_share_an_id(partitioned_path, tmp_path):
+  files = CrawlDatabase(partitioned_path).snapshot(str(tmp_path / "snapshot.db"))
+  assert files == [str(tmp_path / f"snapshot.{year}.db") for year in (2022, 2023)] + [
+    str(tmp_path / "snapshot.db")
+  ]
+  ids = {sl.connect(path).execute("PRAGMA user_version").fetchone()[0] for path in files}
+  assert len(ids) == 1 and 0 not in ids
+  db = CrawlDatabase(str(tmp_path / "snapshot.db"), read_only=True)
+  assert sorted(db.partitions) == [2022, 2023]
+
+
+def test_mixed_snapshot_is_not_opened(partitioned_path, tmp_path, monkeypatch):
+  db = CrawlDatabase(partitioned_path)
+  db.snapshot(str(tmp_path / "old.db"))
+  db.snapshot(str(tmp_path / "new.db"))
+  # The year files of the new snapshot are in place, the main file is not yet
+  for year in (2022, 2023):
+    shutil.copy(tmp_path / f"new.{year}.db", tmp_path / f"old.{year}.db")
+  monkeypatch.setattr(database.time, "sleep", lambda seconds: None)
+  with pytest.raises(sl.DatabaseError):
+    CrawlDatabase(str(tmp_path / "old.db"), read_only=True)
+
+  def publish_main(seconds: float):
+    os.replace(tmp_path / "new.db", tmp_path / "old.db")
+  monkeypatch.setattr(database.time, "sleep", publish_main)
+  snapshot = CrawlDatabase(str(tmp_path / "old.db"), read_only=True)
+  assert snapshot.snapshot_matches()
+
+
+def test_frozen_year(partitioned_path):
+  db = CrawlDatabase(partitioned_path)
+  db.write_placement(101, 80, 80, 400.5, 500.0, 10000, 100, 2022)
+  db.freeze_partition(2022)
+  assert db.partitions == {2022: True, 2023: False}
+  with pytest.raises(RuntimeError, match="Year 2022 is frozen"):
+    db.write_placement(102, 80, 80, 400.5, 500.0, 10000, 100, 2022)
+  assert db.write_placement(102, 80, 80, 400.5, 500.0, 10000, 100, 2023)
+
+  # Reopened, the year file is attached read-only and still read through the views
+  db = CrawlDatabase(partitioned_path)
+  assert db.partitions[2022]
+  with pytest.raises(sl.OperationalError, match="readonly"):
+    db.conn.execute("DELETE FROM y2022.PlacementData")
+  rows = db.conn.execute("SELECT ProgramID, Year FROM PlacementData ORDER BY Year").fetchall()
+  assert rows == [(101, 2022), (102, 2023)]
+
+
+def write_program(db: CrawlDatabase, idx: int, prog_type: str, min_ranking: int, hs: str):
+  db.write_university("Test University", "State", "Ankara")
+  db.write_faculty("Test University", "Engineering")
+  db.write_program(idx, f"Program {idx}", prog_type, None, "Test University", "Engineering")
+  db.write_placement(idx, 80, 80, 400.5, 500.0, min_ranking, 100, 2023)
+  schools = pd.DataFrame(
+    [{"hs": hs, "hs_city": "Ankara", "hs_district": "Çankaya", "new_grad": 3, "old_grad": 1}]
+  )
+  db.write_highschools(schools)
+  db.write_highschool_placements(schools, idx, 2023)
+
+
+def scores(db: CrawlDatabase) -> dict:
+  return dict(db.conn.execute("SELECT HighSchoolName, Score FROM HighSchool").fetchall())
+
+
+def test_incremental_scores_match_full_rescore(db_path):
+  db = CrawlDatabase(db_path)
+  write_program(db, 1, "SAY", 1000, "A")
+  write_program(db, 2, "SAY", 5000, "B")
+  write_program(db, 3, "EA", 2000, "C")
+  assert db.score_highschools() == 3
+  assert scores(db) == {"A": 100.0, "B": 0.0, "C": 100.0}
+
+  # A better program shifts the quality of the other SAY programs of the year
+  write_program(db, 4, "SAY", 500, "D")
+  assert db.score_highschools([(4, 2023)]) == 3
+  incremental = scores(db)
+  db.score_highschools()
+  assert incremental == scores(db)
+  assert incremental["A"] == pytest.approx(50.0)
+
+
+def dimension_writes(db: CrawlDatabase) -> int:
+  tables = ("University", "Faculty", "Program", "HighSchool (")
+  return sum(
+    record["kind"] == "write" and any(f"INSERT INTO {table}" in record["query"] for table in tables)
+    for record in db.profiler.records
+  )
+
+
+def test_dimension_cache_spans_years(db_path):
+  db = CrawlDatabase(db_path)
+  write_program(db, 101, "SAY", 1000, "A")
+  assert dimension_writes(db) == 4
+  # The other years of the program reuse the rows written for the first one
+  for year in (2021, 2022):
+    db.write_university("Test University", "State", "Ankara")
+    db.write_faculty("Test University", "Engineering")
+    db.write_program(101, "Program 101", "SAY", None, "Test University", "Engineering")
+    db.write_placement(101, 80, 80, 400.5, 500.0, 1000, 100, year)
+  assert dimension_writes(db) == 4
+  assert len(db.get_chart_data({"year": [2023]})) == 1
+  rows = db.conn.execute(
+    """
+    SELECT pd.Year FROM PlacementData pd
+    JOIN Program p ON p.ProgramID = pd.ProgramID
+    JOIN Faculty f ON f.FacultyID = p.FacultyID
+    JOIN University u ON u.UniversityID = f.UniversityID
+    ORDER BY 1
+    """
+  ).fetchall()
+  assert rows == [(2021, ), (2022, ), (2023, )]
+
+
+def test_rollback_clears_dimension_cache(db_path):
+  db = CrawlDatabase(db_path)
+  with pytest.raises(RuntimeError):
+    with db.transaction():
+      assert db.write_university("Test University", "State", "Ankara")
+      assert db.write_faculty("Test University", "Engineering")
+      raise RuntimeError("write failed")
+  assert all(len(rows) == 0 for rows in db.dimension_cache.values())
+  assert db.conn.execute("SELECT COUNT(*) FROM University").fetchone() == (0, )
+
+  # Written again, the rolled back rows are not mistaken for stored ones
+  write_program(db, 101, "SAY", 1000, "A")
+  assert len(db.get_chart_data()) == 1
+  assert db.conn.execute("PRAGMA foreign_key_check").fetchall() == []
+
+
+def test_slow_query_is_logged_with_its_plan(db_path, tmp_path, monkeypatch, caplog):
+  monkeypatch.setattr("log_utils.LOG_DIR", str(tmp_path / "logs"))
+  db = CrawlDatabase(db_path, profiler=database.QueryProfiler(slow_threshold=0))
+  with caplog.at_level("WARNING", logger="slow_query"):
+    db.get_chart_data({"year": [2023]})
+  [record] = [record for record in db.profiler.records if record["kind"] == "read"]
+  assert record["slow"] and record["rows"] == 0
+  assert "hsp" in record["plan"]
+  [message] = [r.getMessage() for r in caplog.records if r.name == "slow_query"]
+  assert message.startswith("read query took")
+  assert message.endswith("Plan:\n" + record["plan"])
@@ -0,0 +1,47 @@
+""" Tests of the streaming export, run with python -m pytest """
+
+import pandas as pd
+import pytest
+
+from database import CHART_COLUMNS, CrawlDatabase
+from export import export_chart_data, typed_chunk
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+@pytest.fixture
+def db(db_path) -> CrawlDatabase:
+  db = CrawlDatabase(db_path)
+  db.write_university("Test University", "State", "Ankara")
+  db.write_faculty("Test University", "Engineering")
+  schools = pd.DataFrame(
+    [{"hs": "A", "hs_city": "Ankara", "hs_district": "Çankaya", "new_grad": 3, "old_grad": 1}]
+  )
+  db.write_highschools(schools)
+  # The first program was not filled, its numeric columns are NULL
+  for idx, placed, min_ranking, max_ranking in [(101, None, None, None), (102, 80, 10000, 100)]:
+    db.write_program(idx, f"Program {idx}", "SAY", None, "Test University", "Engineering")
+    db.write_placement(idx, 80, placed, None, None, min_ranking, max_ranking, 2023)
+    db.write_highschool_placements(schools, idx, 2023)
+  return db
+
+
+def test_chunk_types_match_full_frame(db, tmp_path):
+  first = next(db.iter_chart_data(chunk_size=1))
+  assert first[["total_placed", "min_ranking", "max_ranking", "score"]].isna().all().all()
+  full = typed_chunk(db.get_chart_data())
+  assert len(full) == 2
+
+  csv_path = str(tmp_path / "export.csv")
+  assert export_chart_data(db, csv_path, chunk_size=1) == 2
+  with open(csv_path, encoding="utf-8") as f:
+    assert f.read() == full.to_csv(index=False)
+
+  parquet_path = str(tmp_path / "export.parquet")
+  assert export_chart_data(db, parquet_path, chunk_size=1) == 2
+  schema = pq.read_schema(parquet_path)
+  expected = pa.Schema.from_pandas(full, preserve_index=False)
+  assert schema.names == list(CHART_COLUMNS)
+  assert schema.types == expected.types
+  pd.testing.assert_frame_equal(pq.read_table(parquet_path).to_pandas(), full)
@@ -0,0 +1,153 @@
+""" Tests of the panel registry, the parsers and fetch_panels, run with python -m pytest """
+
+import urllib.error
+import urllib.request
+
+import lxml.html
+import pytest
+from selenium.common.exceptions import (
+  NoSuchElementException, NoSuchWindowException, WebDriverException
+)
+
+import crawler
+from crawler import fetch_panels
+from mock_server import CITIES, DISTRICTS, FixtureGenerator, MockAtlasServer
+from panels import PANELS
+from retry import CircuitBreaker, LatencyTracker, RetryPolicy
+
+
+class FakeElement:
+  def __init__(self, element):
+    self.element = element
+
+  @property
+  def text(self) -> str:
+    return self.element.text_content()
+
+  def get_attribute(self, name: str) -> str:
+    assert name == "outerHTML"
+    return lxml.html.tostring(self.element, encoding="unicode")
+
+
+class FakeSwitchTo:
+  def __init__(self, browser: "FakeBrowser"):
+    self.browser = browser
+
+  def new_window(self, kind: str):
+    self.browser.opened += 1
+    handle = f"tab{self.browser.opened}"
+    self.browser.tabs[handle] = None
+    self.browser.current = handle
+
+  def window(self, handle: str):
+    if handle in self.browser.crashing:
+      self.browser.crashing.remove(handle)
+      raise WebDriverException("tab crashed")
+    if handle not in self.browser.tabs:
+      raise NoSuchWindowException(handle)
+    self.browser.current = handle
+
+
+class FakeBrowser:
+  """ Webdriver stand-in that loads the pages with urllib and finds elements with lxml """
+  def __init__(self, crashing=()):
+    self.tabs = {"main": None}
+    self.current = "main"
+    self.opened = 0
+    self.crashing = set(crashing)
+    self.switch_to = FakeSwitchTo(self)
+
+  @property
+  def current_window_handle(self) -> str:
+    if self.current not in self.tabs:
+      raise NoSuchWindowException(self.current)
+    return self.current
+
+  def get(self, url: str):
+    self.tabs[self.current] = url
+
+  def execute_script(self, script: str, url: str):
+    self.tabs[self.current] = url
+
+  def close(self):
+    del self.tabs[self.current]
+
+  def find_element(self, by: str, xpath: str) -> FakeElement:
+    try:
+      with urllib.request.urlopen(self.tabs[self.current]) as response:
+        html = response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+      html = e.read().decode("utf-8")
+    found = lxml.html.document_fromstring(html).xpath(xpath)
+    if len(found) == 0:
+      raise NoSuchElementException(xpath)
+    return FakeElement(found[0])
+
+
+@pytest.fixture
+def server():
+  server = MockAtlasServer(fixtures=FixtureGenerator(highschools=5)).start()
+  crawler.set_base_url(server.url)
+  yield server
+  server.stop()
+
+
+def policy() -> RetryPolicy:
+  return RetryPolicy(
+    max_attempts=2,
+    base_delay=0,
+    latency=LatencyTracker(initial=0.5),
+    breaker=CircuitBreaker(sleep=lambda seconds: None),
+  )
+
+
+def test_registry_writes_program_rows_first():
+  assert list(PANELS) == ["ranking", "highschools"]
+  assert PANELS["ranking"].panel_id == "1000_1"
+  assert "Program" in PANELS["ranking"].tables
+  assert PANELS["highschools"].tables == ("HighSchool", "HighSchoolPlacement")
+
+
+def test_fetch_and_parse_mock_panels(server):
+  browser = FakeBrowser()
+  pages = fetch_panels(browser, "101", 2023, policy=policy())
+  assert list(pages) == ["ranking", "highschools"]
+  # The panel tabs are closed again
+  assert list(browser.tabs) == ["main"]
+
+  expected = server.fixtures.program("101", 2023)
+  html, texts = pages["ranking"]
+  ranking = PANELS["ranking"].parse(html, texts, 2023)
+  assert int(ranking["dept_id"]) == 101
+  assert ranking["uni_name"] == expected["uni_name"]
+  assert ranking["uni_city"] == expected["uni_city"]
+  assert ranking["uni_type"] == ("State" if expected["uni_type"] == "Devlet" else "Private")
+  assert ranking["dept_name"] == expected["dept_name"]
+  assert ranking["dept_type"] == expected["dept_type"]
+  assert int(ranking["total_quota"]) == expected["total_quota"]
+  assert int(ranking["min_ranking"]) == expected["min_ranking"]
+  assert float(ranking["min_points"]) == pytest.approx(expected["min_points"], abs=1e-5)
+  assert ranking["year"] == 2023
+
+  html, texts = pages["highschools"]
+  schools = PANELS["highschools"].parse(html, texts, 2023)
+  assert len(schools) == 5
+  assert list(schools.columns) == ["hs", "hs_city", "hs_district", "new_grad", "old_grad"]
+  assert schools["hs"].str.match(r"ATLAS \d+ ANADOLU LİSESİ$").all()
+  assert schools["hs_city"].isin(CITIES).all()
+  assert schools["hs_district"].isin(DISTRICTS).all()
+
+
+def test_crashed_tab_is_loaded_in_main_window(server):
+  browser = FakeBrowser(crashing={"tab1"})
+  pages = fetch_panels(browser, "101", 2023, policy=policy())
+  assert list(pages) == ["ranking", "highschools"]
+  assert list(browser.tabs) == ["main"]
+  assert browser.tabs["main"].endswith("p=1060")
+
+
+def test_panel_that_does_not_load_fails_program(server):
+  server.error_rate = 1.0
+  browser = FakeBrowser()
+  assert fetch_panels(browser, "101", 2023, policy=policy()) == False
+  assert list(browser.tabs) == ["main"]
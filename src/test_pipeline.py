@@ -0,0 +1,64 @@
+""" Tests of the pipelined crawl, run with python -m pytest """
+
+import time
+import threading
+
+from pipeline import CrawlPipeline
+
+
+def prepare(idx: str, year: int, pages: dict) -> dict:
+  # Nothing to parse, the workers return empty results
+  return {}
+
+
+def make_fetch(fetched: list, lock: threading.Lock, failing=()):
+  def fetch(browser, idx: str, year: int):
+    with lock:
+      fetched.append((idx, year))
+    time.sleep(0.01)
+    return False if idx in failing else {}
+  return fetch
+
+
+def test_yields_in_fetch_order():
+  fetched = []
+  tasks = [(str(i), 2023) for i in range(20)]
+  drawn_by = set()
+
+  def scheduled():
+    for task in tasks:
+      drawn_by.add(threading.current_thread())
+      yield task
+
+  fetch = make_fetch(fetched, threading.Lock(), failing={"3"})
+  with CrawlPipeline(["browser"], fetch, prepare, workers=1, queue_size=2) as pipeline:
+    results = list(pipeline.run(scheduled()))
+  assert [(idx, year) for idx, year, _ in results] == tasks
+  assert [parsed for idx, _, parsed in results if idx == "3"] == [False]
+  assert all(parsed == {} for idx, _, parsed in results if idx != "3")
+  # The tasks are drawn by the consumer, never by a fetcher thread
+  assert drawn_by == {threading.current_thread()}
+
+
+def test_every_task_is_fetched_once_by_several_browsers():
+  fetched = []
+  tasks = [(str(i), 2023) for i in range(30)]
+  fetch = make_fetch(fetched, threading.Lock())
+  with CrawlPipeline(["a", "b", "c"], fetch, prepare, workers=1) as pipeline:
+    results = list(pipeline.run(tasks))
+  assert sorted((idx, year) for idx, year, _ in results) == sorted(tasks)
+  assert sorted(fetched) == sorted(tasks)
+
+
+def test_slow_consumer_throttles_fetching():
+  fetched = []
+  tasks = [(str(i), 2023) for i in range(50)]
+  fetch = make_fetch(fetched, threading.Lock())
+  with CrawlPipeline(["browser"], fetch, prepare, workers=1, queue_size=2) as pipeline:
+    results = pipeline.run(tasks)
+    next(results)
+    time.sleep(0.5)
+    # One yielded, two parsing, two queued and one blocked on the full queue
+    assert len(fetched) <= 6
+    results.close()
+  assert len(fetched) < len(tasks)
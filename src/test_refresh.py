@@ -0,0 +1,107 @@
+""" Tests of the --refresh content hash path, run with python -m pytest """
+
+import pandas as pd
+import pytest
+
+from crawler import write_panel
+from database import CrawlDatabase
+from panels import PANELS, changed_panels, content_hash
+
+
+def ranking(total_quota: int = 80) -> dict:
+  return {
+    "uni_name": "Test University", "uni_type": "State", "uni_city": "Ankara",
+    "fac_name": "Engineering", "dept_id": "101", "dept_name": "Computer Engineering",
+    "dept_type": "SAY", "scholarship": None,
+    "total_quota": total_quota, "total_placed": 80, "min_points": 400.5, "max_points": 500.0,
+    "min_ranking": 10000, "max_ranking": 100, "year": 2023,
+  }
+
+
+def highschools(*names: str) -> pd.DataFrame:
+  return pd.DataFrame(
+    [
+      {"hs": hs, "hs_city": "Ankara", "hs_district": "Çankaya", "new_grad": 3, "old_grad": 1}
+      for hs in names
+    ],
+    columns=["hs", "hs_city", "hs_district", "new_grad", "old_grad"],
+  )
+
+
+def placements(db: CrawlDatabase) -> list:
+  return db.conn.execute(
+    """
+    SELECT h.HighSchoolName FROM HighSchoolPlacement hsp
+    JOIN HighSchool h ON h.HighSchoolID = hsp.HighSchoolID
+    WHERE hsp.ProgramID = 101 AND hsp.Year = 2023
+    ORDER BY 1
+    """
+  ).fetchall()
+
+
+@pytest.fixture
+def db(db_path) -> CrawlDatabase:
+  db = CrawlDatabase(db_path)
+  db.ensure_panel_hashes()
+  return db
+
+
+def test_unchanged_panel_is_skipped(db):
+  pages = {"ranking": ("<table>v1</table>", {"city": "(ANKARA)"})}
+  digest = content_hash(*pages["ranking"])
+  assert write_panel(db, PANELS["ranking"], ranking(), "101", 2023, digest)
+  assert db.get_panel_hashes("101", 2023) == {"1000_1": digest}
+  assert changed_panels(pages, db.get_panel_hashes("101", 2023)) == {}
+
+  pages["ranking"] = ("<table>v2</table>", {"city": "(ANKARA)"})
+  jobs = changed_panels(pages, db.get_panel_hashes("101", 2023))
+  assert list(jobs) == ["ranking"]
+  assert jobs["ranking"][2] == content_hash(*pages["ranking"])
+
+
+def test_changed_panel_replaces_rows(db):
+  assert write_panel(db, PANELS["ranking"], ranking(80), "101", 2023, "old")
+  assert write_panel(db, PANELS["highschools"], highschools("A", "B"), "101", 2023, "old")
+  # Without replace the stored rows are kept
+  assert write_panel(db, PANELS["ranking"], ranking(90), "101", 2023)
+  assert db.conn.execute("SELECT TotalQuota FROM PlacementData").fetchall() == [(80, )]
+
+  assert write_panel(db, PANELS["ranking"], ranking(90), "101", 2023, "new", replace=True)
+  assert write_panel(
+    db, PANELS["highschools"], highschools("B", "C"), "101", 2023, "new", replace=True
+  )
+  assert db.conn.execute("SELECT TotalQuota FROM PlacementData").fetchall() == [(90, )]
+  assert placements(db) == [("B", ), ("C", )]
+  assert db.get_panel_hashes("101", 2023) == {"1000_1": "new", "1060": "new"}
+
+
+def test_emptied_highschool_table_clears_placements(db, monkeypatch):
+  assert write_panel(db, PANELS["ranking"], ranking(), "101", 2023, "old")
+  assert write_panel(db, PANELS["highschools"], highschools("A"), "101", 2023, "old")
+  deleted = []
+  delete = db.delete_highschool_placements
+
+  def spy(program_id, year):
+    deleted.append((program_id, year))
+    return delete(program_id, year)
+  monkeypatch.setattr(db, "delete_highschool_placements", spy)
+
+  assert write_panel(db, PANELS["highschools"], highschools(), "101", 2023, "empty", replace=True)
+  assert deleted == [("101", 2023)]
+  assert placements(db) == []
+  assert db.get_panel_hashes("101", 2023)["1060"] == "empty"
+
+
+def test_unique_error_fails_replace_only(db):
+  query = "INSERT INTO University (UniversityName, UniversityType, UniversityCity) VALUES (?, ?, ?)"
+  row = ("Test University", "State", "Ankara")
+  assert db.thread_safe_write(query, row)
+  # The row is already there
+  assert db.thread_safe_write(query, row)
+  assert not db.thread_safe_write(query, row, replace=True)
+  with pytest.raises(RuntimeError):
+    with db.transaction():
+      db.thread_safe_write("UPDATE University SET UniversityCity = 'İzmir'")
+      if not db.thread_safe_write(query, row, replace=True):
+        raise RuntimeError("replace failed")
+  assert db.conn.execute("SELECT UniversityCity FROM University").fetchall() == [("Ankara", )]
@@ -0,0 +1,109 @@
+""" Tests of the shared result store, run with python -m pytest """
+
+import gc
+import threading
+import time
+
+import pandas as pd
+
+from result_store import ResultStore
+
+
+def test_collected_handle_under_lock():
+  """ A handle collected while the store's lock is held must not deadlock """
+  store = ResultStore()
+  handle = store.get("key", lambda: pd.DataFrame({"a": [1, 2, 3]}))
+  # A reference cycle, so only the garbage collector frees the handle
+  handle.cycle = handle
+  del handle
+
+  def collect():
+    with store.lock:
+      gc.collect()
+
+  thread = threading.Thread(target=collect, daemon=True)
+  thread.start()
+  thread.join(5)
+  assert not thread.is_alive()
+
+  handle = store.get("key", lambda: pd.DataFrame())
+  assert store.entries["key"]["refs"] == 1
+  handle.release()
+  handle.release()
+  store.release("missing")
+  assert store.entries["key"]["refs"] == 0
+
+
+def test_evicts_released_frames_only():
+  frame = pd.DataFrame({"a": range(1000)})
+  store = ResultStore(max_bytes=int(frame.memory_usage(deep=True).sum() * 1.5))
+  first = store.get("first", lambda: frame.copy())
+  second = store.get("second", lambda: frame.copy())
+  assert set(store.entries) == {"first", "second"}
+  first.release()
+  third = store.get("third", lambda: frame.copy())
+  assert set(store.entries) == {"second", "third"}
+  assert store.stats()["evictions"] == 1
+  second.release()
+  third.release()
+
+
+def test_concurrent_misses_load_once():
+  calls = []
+  started = threading.Event()
+
+  def load():
+    calls.append(1)
+    started.set()
+    time.sleep(0.2)
+    return pd.DataFrame({"a": [1, 2, 3]})
+
+  store = ResultStore()
+  handles = []
+  threads = [
+    threading.Thread(target=lambda: handles.append(store.get("key", load))) for _ in range(5)
+  ]
+  threads[0].start()
+  started.wait(5)
+  for thread in threads[1:]:
+    thread.start()
+  for thread in threads:
+    thread.join(5)
+  assert len(calls) == 1
+  assert len(handles) == 5
+  assert all(handle.frame is handles[0].frame for handle in handles)
+  assert store.entries["key"]["refs"] == 5
+  assert store.stats()["misses"] == 1
+  assert store.loading == {}
+
+
+def test_failed_load_is_shared():
+  started, release = threading.Event(), threading.Event()
+
+  def fail():
+    started.set()
+    release.wait(5)
+    raise RuntimeError("query failed")
+
+  store = ResultStore()
+  errors = []
+
+  def get():
+    try:
+      store.get("key", fail)
+    except RuntimeError as e:
+      errors.append(str(e))
+
+  loader = threading.Thread(target=get)
+  loader.start()
+  started.wait(5)
+  waiter = threading.Thread(target=get)
+  waiter.start()
+  time.sleep(0.1)
+  release.set()
+  loader.join(5)
+  waiter.join(5)
+  assert errors == ["query failed", "query failed"]
+  assert store.loading == {}
+  # The next session runs the query again
+  assert store.get("key", lambda: pd.DataFrame({"a": [1]})).frame["a"].tolist() == [1]
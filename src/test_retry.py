@@ -0,0 +1,134 @@
+""" Tests of the page load retry policy, run with python -m pytest """
+
+import time
+import threading
+
+import pytest
+
+from retry import CircuitBreaker, LatencyTracker, RetryPolicy
+
+
+def open_breaker(breaker: CircuitBreaker):
+  for _ in range(breaker.window):
+    breaker.record(False)
+
+
+def test_breaker_opens_at_threshold_over_window():
+  sleeps = []
+  breaker = CircuitBreaker(window=4, threshold=0.5, cooldown=10, sleep=sleeps.append)
+  for success in (True, False, False):
+    breaker.record(success)
+  # Not enough page loads in the window yet
+  assert not breaker.is_open
+  assert breaker.wait() == 0.0
+  breaker.record(True)
+  assert breaker.error_rate == 0.5
+  assert not breaker.is_open
+  breaker.record(False)
+  assert breaker.is_open
+  assert breaker.wait() == 10
+  assert sleeps == [10]
+  assert (breaker.is_open, breaker.trips) == (False, 1)
+
+
+def test_breaker_stays_closed_below_threshold():
+  breaker = CircuitBreaker(window=4, threshold=0.5, sleep=lambda seconds: None)
+  for success in (True, True, True, False, True, True, True, False):
+    breaker.record(success)
+  assert breaker.error_rate == 0.25
+  assert not breaker.is_open
+
+
+def test_cooldown_doubles_on_reopen_up_to_max():
+  sleeps = []
+  breaker = CircuitBreaker(window=2, cooldown=10, max_cooldown=25, sleep=sleeps.append)
+  for _ in range(4):
+    open_breaker(breaker)
+    breaker.wait()
+  assert sleeps == [10, 20, 25, 25]
+  assert (breaker.trips, breaker.cooldown) == (4, 25)
+
+
+def test_shared_breaker_trips_once_for_concurrent_failures():
+  sleeps = []
+
+  def sleep(seconds: float):
+    sleeps.append(seconds)
+    # Long enough for the other threads to reach the open breaker
+    time.sleep(0.2)
+
+  breaker = CircuitBreaker(window=3, threshold=0.5, cooldown=0.2, sleep=sleep)
+  barrier = threading.Barrier(3)
+  waited = []
+
+  def fetcher():
+    breaker.record(False)
+    barrier.wait()
+    waited.append(breaker.wait())
+
+  threads = [threading.Thread(target=fetcher) for _ in range(3)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert breaker.trips == 1
+  assert sleeps == [0.2]
+  assert breaker.cooldown == 0.4
+  assert len(waited) == 3 and all(seconds > 0 for seconds in waited)
+  assert not breaker.is_open
+
+
+def test_success_streak_halves_cooldown():
+  breaker = CircuitBreaker(window=4, cooldown=10, sleep=lambda seconds: None)
+  for _ in range(2):
+    open_breaker(breaker)
+    breaker.wait()
+  assert breaker.cooldown == 40
+  for _ in range(4):
+    breaker.record(True)
+  assert breaker.cooldown == 20
+  # One failure resets the streak
+  for success in (True, True, True, False, True, True, True):
+    breaker.record(success)
+  assert breaker.cooldown == 20
+  breaker.record(True)
+  assert breaker.cooldown == 10
+  # The cooldown never drops below the initial one
+  for _ in range(8):
+    breaker.record(True)
+  assert breaker.cooldown == 10
+
+
+def test_timeout_follows_latency_percentile():
+  tracker = LatencyTracker(
+    initial=5, minimum=0.1, maximum=30, percentile=95, factor=2, window=100, min_samples=20
+  )
+  for _ in range(19):
+    tracker.record(1.0)
+  assert tracker.timeout == 5
+  tracker.record(1.0)
+  assert tracker.timeout == 2.0
+  for i in range(1, 101):
+    tracker.record(i / 10)
+  assert tracker.quantile(95) == pytest.approx(9.5)
+  assert tracker.timeout == pytest.approx(19.0)
+  # Only the last `window` samples count, and the timeout is clamped
+  for _ in range(100):
+    tracker.record(0.02)
+  assert tracker.timeout == 0.1
+  for _ in range(100):
+    tracker.record(60)
+  assert tracker.timeout == 30
+
+
+def test_policy_backoff_and_records():
+  breaker = CircuitBreaker(window=2, sleep=lambda seconds: None)
+  policy = RetryPolicy(
+    base_delay=0.5, max_delay=3, jitter=0, latency=LatencyTracker(min_samples=1), breaker=breaker
+  )
+  assert [policy.backoff(attempt) for attempt in range(1, 6)] == [0.5, 1, 2, 3, 3]
+  policy.record_success(2.0)
+  assert policy.timeout == 4.0
+  policy.record_failure()
+  policy.record_failure()
+  assert breaker.is_open
@@ -0,0 +1,65 @@
+""" Tests of the crawl order of the scheduler, run with python -m pytest """
+
+import pytest
+
+from database import CrawlDatabase
+from scheduler import Scheduler
+
+
+def program(dept_id: str, year: int = 2023) -> dict:
+  return {
+    "uni_name": "Test University", "uni_type": "State", "uni_city": "Ankara",
+    "fac_name": "Engineering", "dept_id": dept_id, "dept_name": f"Program {dept_id}",
+    "dept_type": "SAY", "scholarship": None,
+    "total_quota": 80, "total_placed": 80, "min_points": 400.5, "max_points": 500.0,
+    "min_ranking": 10000, "max_ranking": 100, "year": year,
+  }
+
+
+def crawled(db: CrawlDatabase, dept_id: str, checked_at: str, year: int = 2023):
+  """ Store a program with its panels last checked at the given time """
+  record = program(dept_id, year)
+  for write in [db.write_university, db.write_faculty, db.write_program, db.write_placement]:
+    assert write(**record)
+  assert db.write_panel_hash(dept_id, year, "ranking", "digest")
+  db.conn.execute(
+    "UPDATE PanelHash SET UpdatedAt = ?, CheckedAt = ? WHERE ProgramID = ?",
+    (checked_at, checked_at, int(dept_id))
+  )
+  db.conn.commit()
+
+
+@pytest.fixture
+def db(db_path, tmp_path) -> CrawlDatabase:
+  db = CrawlDatabase(db_path)
+  crawled(db, "101", "2026-01-02 00:00:00")
+  crawled(db, "102", "2026-01-01 00:00:00")
+  (tmp_path / "dead_letters_2023.txt").write_text("104\n")
+  return db
+
+
+def test_priorities(db, tmp_path):
+  scheduler = Scheduler(
+    db, [2023], include_existing=True, dead_letters=str(tmp_path / "dead_letters_{year}.txt")
+  )
+  assert scheduler.add(["101", "102", "103", "104", "103"]) == 4
+  assert scheduler.plan() == {"never_crawled": 1, "stale": 2, "failed": 1}
+  # Never crawled first, then the longest unchecked, the failed ones last
+  assert list(scheduler) == [("103", 2023), ("102", 2023), ("101", 2023), ("104", 2023)]
+
+
+def test_existing_dropped(db, tmp_path):
+  scheduler = Scheduler(db, [2023], dead_letters=str(tmp_path / "dead_letters_{year}.txt"))
+  scheduler.add(["101", "102", "103", "104"])
+  assert scheduler.plan() == {"never_crawled": 1, "stale": 0, "failed": 1}
+  assert list(scheduler) == [("103", 2023), ("104", 2023)]
+
+
+def test_years_back_to_back(db, tmp_path):
+  scheduler = Scheduler(
+    db, [2023, 2022], dead_letters=str(tmp_path / "missing_{year}.txt"), page_size=1
+  )
+  scheduler.add(["106", "105"])
+  scheduler.plan()
+  assert len(scheduler) == 4
+  assert list(scheduler) == [("106", 2022), ("106", 2023), ("105", 2022), ("105", 2023)]
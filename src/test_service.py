@@ -0,0 +1,116 @@
+""" Tests of the JSON query service, run with python -m pytest """
+
+import json
+import os
+import threading
+from http.client import HTTPConnection
+
+import pandas as pd
+import pytest
+
+from database import CrawlDatabase
+from service import QueryService, ServiceHandler
+
+
+@pytest.fixture
+def service(tmp_path):
+  with open(os.path.join(os.path.dirname(__file__), "schema.sql"), "r") as f:
+    CrawlDatabase.create_from_schema(schema=f.read(), path=str(tmp_path / "crawl.db"))
+  service = QueryService(("127.0.0.1", 0), str(tmp_path / "crawl.db"), connections=1)
+  thread = threading.Thread(target=service.serve_forever, daemon=True)
+  thread.start()
+  yield service
+  service.shutdown()
+  service.server_close()
+
+
+def request(service, method: str, path: str, body: bytes = None):
+  conn = HTTPConnection(*service.server_address, timeout=5)
+  conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+  response = conn.getresponse()
+  payload = json.loads(response.read())
+  conn.close()
+  return response.status, payload
+
+
+@pytest.mark.parametrize(
+  "body",
+  [
+    b"[1]", b'"chart"', b'{"year": null}', b'{"year": [[2023]]}', b'{"year": "x"}',
+    b'{"format": []}', b'{"format": "csv"}', b'{"uni_name": {"a": 1}}',
+    b'{"uni_name": ["a", null]}', b"{"
+  ],
+)
+def test_malformed_body(service, body):
+  status, payload = request(service, "POST", "/chart", body)
+  assert status == 400
+  assert "error" in payload
+
+
+def test_post_matches_get(service):
+  posted = request(service, "POST", "/chart", b'{"year": 2023}')
+  assert posted == request(service, "GET", "/chart?year=2023")
+
+
+def test_unexpected_error(service, monkeypatch):
+  def fail():
+    raise RuntimeError("stats failed")
+  monkeypatch.setattr(service.store, "stats", fail)
+  status, payload = request(service, "GET", "/stats")
+  assert status == 500
+  assert payload["error"] == "RuntimeError: stats failed"
+  # The server keeps answering
+  assert request(service, "GET", "/options/uni") == (200, [])
+
+
+def test_unfiltered_chart_is_streamed_from_the_cursor(service, tmp_path, monkeypatch):
+  db = CrawlDatabase(str(tmp_path / "crawl.db"))
+  db.write_university("Test University", "State", "Ankara")
+  db.write_faculty("Test University", "Engineering")
+  schools = pd.DataFrame(
+    [
+      {"hs": hs, "hs_city": "Ankara", "hs_district": "Çankaya", "new_grad": 3, "old_grad": 1}
+      for hs in ("A", "B", "C")
+    ]
+  )
+  db.write_highschools(schools)
+  for idx, year in [(101, 2022), (101, 2023)]:
+    db.write_program(idx, "Computer Engineering", "SAY", None, "Test University", "Engineering")
+    db.write_placement(idx, 80, 80, 400.5, 500.0, 10000, 100, year)
+    db.write_highschool_placements(schools, idx, year)
+
+  filtered = request(service, "GET", "/chart?year=2022")[1] + request(
+    service, "GET", "/chart?year=2023"
+  )[1]
+
+  def materialize(self, filters=None):
+    raise AssertionError("the unfiltered chart data must not be built in memory")
+  monkeypatch.setattr(CrawlDatabase, "get_chart_data", materialize)
+  monkeypatch.setattr(ServiceHandler, "chunk_rows", 2)
+  before = service.store.stats()
+  status, rows = request(service, "GET", "/chart")
+  assert status == 200
+  key = lambda row: (row["year"], row["hs_name"])
+  assert sorted(rows, key=key) == sorted(filtered, key=key)
+  assert service.store.stats() == before
+
+  conn = HTTPConnection(*service.server_address, timeout=5)
+  conn.request("GET", "/chart?format=ndjson")
+  lines = conn.getresponse().read().decode("utf-8").splitlines()
+  conn.close()
+  assert sorted((json.loads(line) for line in lines), key=key) == sorted(filtered, key=key)
+
+
+def test_cache_is_cleared_when_the_database_changes(service, tmp_path):
+  assert request(service, "GET", "/options/uni") == (200, [])
+  assert request(service, "GET", "/options/uni") == (200, [])
+  assert service.store.stats()["misses"] == 1
+
+  db = CrawlDatabase(str(tmp_path / "crawl.db"))
+  db.write_university("Test University", "State", "Ankara")
+  db.write_faculty("Test University", "Engineering")
+  db.write_program(101, "Computer Engineering", "SAY", None, "Test University", "Engineering")
+  db.write_placement(101, 80, 80, 400.5, 500.0, 10000, 100, 2023)
+  status, rows = request(service, "GET", "/options/uni")
+  assert status == 200 and len(rows) == 1
+  assert service.store.stats()["misses"] == 2
@@ -0,0 +1,147 @@
+""" Tests of the crawl spools and their bulk load, run with python -m pytest """
+
+import os
+
+import pytest
+
+import spool
+from database import CrawlDatabase
+from panels import PANELS
+from scheduler import Scheduler
+from spool import SpoolWriter, load_spools
+
+
+def ranking(dept_name: str = "Computer Engineering", year: int = 2023) -> dict:
+  return {
+    "uni_name": "Test University", "uni_type": "State", "uni_city": "Ankara",
+    "fac_name": "Engineering", "dept_id": "101", "dept_name": dept_name, "dept_type": "SAY",
+    "scholarship": None,
+    "total_quota": 80, "total_placed": 80, "min_points": 400.5, "max_points": 500.0,
+    "min_ranking": 10000, "max_ranking": 100, "year": year,
+  }
+
+
+def highschools(new_grad: int = 3) -> list:
+  return [
+    {"hs": "Test High School", "hs_city": "Ankara", "hs_district": "Çankaya", "new_grad": new_grad,
+     "old_grad": 1}
+  ]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  """ Spool write times that the test sets explicitly """
+  now = ["2026-01-01 00:00:00.000"]
+  monkeypatch.setattr(spool, "_now", lambda: now[0])
+  return now
+
+
+def spool_program(directory: str, name: str, replace: bool = False, **kwargs):
+  writer = SpoolWriter(directory, name)
+  writer.append(PANELS["ranking"], ranking(**kwargs), "101", 2023, "digest", replace=replace)
+  writer.append(PANELS["highschools"], highschools(), "101", 2023, "digest", replace=replace)
+  writer.checked("101", 2023)
+  writer.close()
+
+
+def test_round_trip(db_path, tmp_path):
+  spool_program(str(tmp_path / "spool"), "worker")
+  db = CrawlDatabase(db_path)
+  stats = load_spools(db, [str(tmp_path / "spool")])
+  assert (stats["records"], stats["skipped"], stats["touched"]) == (3, 0, [("101", 2023)])
+  assert stats["rows"]["PlacementData"] == 1
+  assert stats["rows"]["HighSchoolPlacement"] == 1
+  assert stats["archived"] == [str(tmp_path / "spool" / "worker.jsonl.loaded")]
+  chart = db.get_chart_data()
+  assert len(chart) == 1
+
+  # The archived spool is not loaded again
+  stats = load_spools(db, [str(tmp_path / "spool")])
+  assert (stats["records"], stats["rows"], stats["archived"]) == (0, {}, [])
+
+
+def test_reload_is_idempotent(db_path, tmp_path):
+  spool_program(str(tmp_path / "spool"), "worker", replace=True)
+  db = CrawlDatabase(db_path)
+  load_spools(db, [str(tmp_path / "spool")], archive=False)
+  query = "SELECT PanelID, UpdatedAt, CheckedAt FROM PanelHash ORDER BY 1"
+  hashes = db.conn.execute(query).fetchall()
+  stats = load_spools(db, [str(tmp_path / "spool")])
+  assert stats["skipped"] == 2
+  assert stats["touched"] == []
+  assert db.conn.execute(query).fetchall() == hashes
+
+
+def test_latest_record_wins_across_files(db_path, tmp_path, clock):
+  # The worker whose file sorts first wrote the newer record
+  clock[0] = "2026-01-02 00:00:00.000"
+  spool_program(str(tmp_path / "spool"), "a", replace=True, dept_name="New Name")
+  clock[0] = "2026-01-01 00:00:00.000"
+  spool_program(str(tmp_path / "spool"), "b", replace=True, dept_name="Old Name")
+  db = CrawlDatabase(db_path)
+  load_spools(db, [str(tmp_path / "spool")], batch_size=1)
+  assert db.conn.execute("SELECT ProgramName FROM Program").fetchall() == [("New Name", )]
+  assert db.conn.execute("SELECT DISTINCT UpdatedAt, CheckedAt FROM PanelHash").fetchall() == [
+    ("2026-01-02 00:00:00.000", "2026-01-02 00:00:00.000")
+  ]
+
+
+def test_skips_records_older_than_stored(db_path, tmp_path, clock):
+  clock[0] = "2026-01-02 00:00:00.000"
+  spool_program(str(tmp_path / "new"), "worker", replace=True, dept_name="New Name")
+  clock[0] = "2026-01-01 00:00:00.000"
+  spool_program(str(tmp_path / "old"), "worker", replace=True, dept_name="Old Name")
+  db = CrawlDatabase(db_path)
+  load_spools(db, [str(tmp_path / "new")])
+  stats = load_spools(db, [str(tmp_path / "old")])
+  assert stats["skipped"] == 2
+  assert db.conn.execute("SELECT ProgramName FROM Program").fetchall() == [("New Name", )]
+  # The older check does not move CheckedAt back
+  checked = db.conn.execute("SELECT DISTINCT CheckedAt FROM PanelHash").fetchall()
+  assert checked == [("2026-01-02 00:00:00.000", )]
+  assert os.path.exists(str(tmp_path / "old" / "worker.jsonl.loaded"))
+
+
+def spool_year(directory: str, year: int):
+  writer = SpoolWriter(directory, "worker")
+  writer.append(PANELS["ranking"], ranking(year=year), "101", year, "digest")
+  writer.checked("101", year)
+  writer.close()
+
+
+def test_load_creates_missing_year_file(partitioned_path, tmp_path):
+  # The crawlers do not create the year file of 2024
+  spool_year(str(tmp_path / "spool"), 2024)
+  db = CrawlDatabase(partitioned_path)
+  stats = load_spools(db, [str(tmp_path / "spool")])
+  assert stats["touched"] == [("101", 2024)]
+  assert os.path.exists(db.partition_path(2024))
+  assert db.get_panel_hashes("101", 2024) == {"1000_1": "digest"}
+
+
+def test_load_creates_missing_panel_hashes(db_path, tmp_path):
+  # A database created before the PanelHash table, which the crawlers do not add
+  spool_year(str(tmp_path / "spool"), 2023)
+  db = CrawlDatabase(db_path)
+  db.conn.execute("DROP TABLE PanelHash")
+  load_spools(db, [str(tmp_path / "spool")])
+  assert db.get_panel_hashes("101", 2023) == {"1000_1": "digest"}
+
+
+def test_spool_crawl_of_database_without_panel_hashes(db_path, tmp_path):
+  # A spool mode crawler schedules against the database without adding PanelHash
+  db = CrawlDatabase(db_path)
+  db.conn.execute("DROP TABLE PanelHash")
+  record = ranking(year=2023) | {"dept_id": "102"}
+  for write in [db.write_university, db.write_faculty, db.write_program, db.write_placement]:
+    assert write(**record)
+  scheduler = Scheduler(
+    db, [2023], include_existing=True, dead_letters=str(tmp_path / "missing_{year}.txt")
+  )
+  scheduler.add(["101", "102"])
+  assert scheduler.plan() == {"never_crawled": 1, "stale": 1, "failed": 0}
+  assert list(scheduler) == [("101", 2023), ("102", 2023)]
+
+  spool_year(str(tmp_path / "spool"), 2023)
+  load_spools(db, [str(tmp_path / "spool")])
+  assert db.get_panel_hashes("101", 2023) == {"1000_1": "digest"}
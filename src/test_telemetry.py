@@ -0,0 +1,30 @@
+""" Tests of the crawl telemetry, run with python -m pytest """
+
+import pytest
+
+from telemetry import Telemetry
+
+
+def test_summary_is_exact_for_few_samples():
+  telemetry = Telemetry()
+  for ms in range(1, 101):
+    telemetry.record("navigation", ms / 1000, panel="ranking")
+  [row] = telemetry.summary()
+  assert (row["stage"], row["panel"], row["count"]) == ("navigation", "ranking", 100)
+  assert row["total"] == pytest.approx(5.05)
+  assert (row["min"], row["p50"], row["p99"], row["max"]) == (0.001, 0.051, 0.099, 0.1)
+
+
+def test_memory_is_bounded():
+  telemetry = Telemetry(reservoir=100)
+  for i in range(20000):
+    telemetry.record("parse", (i % 1000) / 1000)
+  [stats] = telemetry.stats.values()
+  assert len(stats.reservoir) == 100
+  [row] = telemetry.summary()
+  assert row["count"] == 20000
+  assert row["total"] == pytest.approx(20 * 499.5)
+  assert (row["min"], row["max"]) == (0.0, 0.999)
+  # An estimate from the reservoir of a uniform distribution
+  assert 0.3 < row["p50"] < 0.7
+  assert "p50" in telemetry.format_summary().splitlines()[0]
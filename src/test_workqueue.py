@@ -0,0 +1,177 @@
+""" Tests of the leased work queue, run with python -m pytest """
+
+import json
+import sqlite3 as sl
+import threading
+import time
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from pipeline import CrawlPipeline
+from retry import RetryPolicy
+from workqueue import LeasedTasks, QueueHandler, RemoteWorkQueue, WorkQueue
+
+
+class FlakyQueue:
+  """ Queue whose calls fail a number of times before they reach the real queue """
+  def __init__(self, queue: WorkQueue, failures: int):
+    self.queue = queue
+    self.failures = failures
+    self.calls = 0
+
+  def __getattr__(self, name: str):
+    method = getattr(self.queue, name)
+
+    def call(*args):
+      self.calls += 1
+      if self.failures > 0:
+        self.failures -= 1
+        raise sl.OperationalError("database is locked")
+      return method(*args)
+    return call
+
+
+def prepare(idx: str, year: int, pages: dict) -> dict:
+  return {}
+
+
+def test_expired_lease_is_reissued(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"))
+  assert queue.add([("1", 2023), ("2", 2023)]) == 2
+  assert queue.add([("1", 2023)]) == 0
+  assert queue.lease("crashed", n=10, ttl=0.05) == [("1", 2023), ("2", 2023)]
+  assert queue.lease("other", n=10) == []
+  time.sleep(0.1)
+  assert queue.progress()["expired"] == 2
+  assert queue.lease("other", n=1) == [("1", 2023)]
+  # The crashed worker cannot complete a task it lost
+  assert queue.complete("crashed", [("1", 2023)]) == 0
+  assert queue.complete("other", [("1", 2023)]) == 1
+  progress = queue.progress()
+  assert (progress["done"], progress["leased"], progress["expired"]) == (1, 1, 1)
+
+
+def test_failed_task_is_retried_then_failed(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"), max_attempts=2)
+  queue.add([("1", 2023)])
+  for _ in range(2):
+    assert queue.lease("worker") == [("1", 2023)]
+    queue.fail("worker", [("1", 2023)])
+  assert queue.lease("worker") == []
+  assert queue.progress()["failed"] == 1
+
+
+def test_task_whose_lease_keeps_expiring_is_failed(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"), max_attempts=2)
+  queue.add([("1", 2023)])
+  # The worker crashes on the task every time and never renews its lease
+  for _ in range(2):
+    assert queue.lease("crashing", n=1, ttl=0.05) == [("1", 2023)]
+    time.sleep(0.1)
+  queue.add([("2", 2023)])
+  assert queue.lease("worker", n=10) == [("2", 2023)]
+  progress = queue.progress()
+  assert (progress["failed"], progress["leased"], progress["expired"]) == (1, 1, 0)
+  attempts = queue.conn.execute("SELECT Attempts FROM Task WHERE ProgramID = '1'").fetchone()
+  assert attempts == (2, )
+
+
+def test_leases_retry_queue_errors(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"))
+  queue.add([("1", 2023), ("2", 2023)])
+  flaky = FlakyQueue(queue, failures=2)
+  leases = LeasedTasks(flaky, "worker", batch=1, retry=RetryPolicy(max_attempts=3, base_delay=0))
+  tasks = iter(leases)
+  assert next(tasks) == ("1", 2023)
+  leases.done(("1", 2023))
+  # complete and fail are dropped after the last attempt, the lease expires instead
+  assert next(tasks) == ("2", 2023)
+  flaky.failures = 3
+  leases.done(("2", 2023))
+  progress = queue.progress()
+  assert (progress["done"], progress["leased"]) == (1, 1)
+
+
+def test_leases_raise_when_queue_is_gone(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"))
+  queue.add([("1", 2023)])
+  leases = LeasedTasks(
+    FlakyQueue(queue, failures=3), "worker", retry=RetryPolicy(max_attempts=3, base_delay=0)
+  )
+  with pytest.raises(sl.OperationalError):
+    next(iter(leases))
+
+
+def test_pipeline_over_leases_finishes(tmp_path):
+  queue = WorkQueue(str(tmp_path / "queue.db"))
+  tasks = [("1", 2023), ("2", 2023), ("3", 2023)]
+  queue.add(tasks)
+  leases = LeasedTasks(queue, "worker", batch=2, poll=0.05)
+  results = []
+
+  def crawl():
+    with CrawlPipeline(["browser"], lambda browser, idx, year: {}, prepare, workers=1) as pipeline:
+      for idx, year, _ in pipeline.run(leases):
+        results.append((idx, year))
+        leases.done((idx, year))
+
+  thread = threading.Thread(target=crawl, daemon=True)
+  thread.start()
+  thread.join(timeout=10)
+  # The worker does not wait for its own leases that are still in the pipeline
+  assert not thread.is_alive()
+  assert sorted(results) == tasks
+  assert queue.progress()["done"] == 3
+
+
+@pytest.fixture
+def coordinator(tmp_path):
+  server = ThreadingHTTPServer(("127.0.0.1", 0), QueueHandler)
+  server.queue = WorkQueue(str(tmp_path / "queue.db"))
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def post(server, path: str, body: bytes):
+  conn = HTTPConnection(*server.server_address, timeout=5)
+  conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+  response = conn.getresponse()
+  payload = json.loads(response.read())
+  conn.close()
+  return response.status, payload
+
+
+def test_remote_queue(coordinator):
+  queue = RemoteWorkQueue("http://%s:%d" % coordinator.server_address)
+  assert queue.add([("1", 2023), ("2", 2022)]) == 2
+  assert queue.lease("worker", years=[2023]) == [("1", 2023)]
+  assert queue.complete("worker", [("1", 2023)]) == 1
+  assert queue.progress()["done"] == 1
+
+
+@pytest.mark.parametrize(
+  "path, body",
+  [("/add", b"[1]"), ("/add", b'{"tasks": [["1"]]}'), ("/add", b'{"tasks": [["1", null]]}'),
+   ("/lease", b'{"owner": "w", "n": "x"}'), ("/lease", b'{"n": 1}'), ("/progress", b'{"x": 1}'),
+   ("/lease", b"{")],
+)
+def test_malformed_request(coordinator, path, body):
+  status, payload = post(coordinator, path, body)
+  assert status == 400
+  assert "error" in payload
+  # A rejected request leaves no transaction open
+  assert post(coordinator, "/add", b'{"tasks": [["1", 2023]]}') == (200, 1)
+
+
+def test_queue_error(coordinator, monkeypatch):
+  def locked(*args, **kwargs):
+    raise sl.OperationalError("database is locked")
+  monkeypatch.setattr(coordinator.queue, "lease", locked)
+  status, payload = post(coordinator, "/lease", b'{"owner": "w"}')
+  assert (status, payload) == (500, {"error": "OperationalError: database is locked"})
+  assert post(coordinator, "/unknown", b"{}")[0] == 404
@@ -0,0 +1,448 @@
+""" Leased work queue that coordinates crawler instances across processes and hosts """
+
+import inspect
+import json
+import time
+import sqlite3 as sl
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from log_utils import get_file_logger
+from retry import RetryPolicy
+
+Task = Tuple[str, int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Task (
+    ProgramID TEXT NOT NULL,
+    Year INTEGER NOT NULL,
+    State TEXT NOT NULL DEFAULT 'pending' CHECK(State IN ('pending', 'leased', 'done', 'failed')),
+    Owner TEXT,
+    LeaseExpiry REAL,
+    Attempts INTEGER NOT NULL DEFAULT 0,
+    UpdatedAt REAL,
+    PRIMARY KEY (ProgramID, Year)
+);
+CREATE INDEX IF NOT EXISTS TaskState ON Task (State, LeaseExpiry);
+"""
+
+
+class WorkQueue:
+  """
+  SQLite backed queue of (program_id, year) crawl tasks
+
+  Workers lease batches of tasks for a limited time and renew the leases with
+  heartbeats while they work. Leases that are not renewed expire, e.g. when a
+  worker crashes, and the tasks are handed out to the next worker that asks.
+
+  Parameters
+  ----------
+  path
+    Path to the queue database. Created if it does not exist
+
+  max_attempts
+    Number of leases after which a failing task is marked as failed. A task whose
+    lease expired max_attempts times, e.g. because it crashes its worker, is
+    marked as failed instead of being leased again
+  """
+  def __init__(self, path: str, max_attempts: int = 3):
+    self.path = path
+    self.max_attempts = max_attempts
+    self.lock = threading.Lock()
+    self.conn = sl.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode = WAL")
+    self.conn.executescript(SCHEMA)
+
+  def add(self, tasks: Iterable[Task]) -> int:
+    """ Enqueue tasks. Tasks already in the queue are left untouched """
+    with self.lock:
+      before = self.conn.total_changes
+      self.conn.execute("BEGIN IMMEDIATE")
+      try:
+        self.conn.executemany(
+          "INSERT OR IGNORE INTO Task (ProgramID, Year, UpdatedAt) VALUES (?, ?, ?)",
+          ((str(idx), int(year), time.time()) for idx, year in tasks)
+        )
+        self.conn.execute("COMMIT")
+      except Exception:
+        self.conn.execute("ROLLBACK")
+        raise
+      return self.conn.total_changes - before
+
+  def lease(
+    self, owner: str, n: int = 20, ttl: float = 300, years: Optional[List[int]] = None
+  ) -> List[Task]:
+    """
+    Lease up to n pending or expired tasks, optionally limited to some years.
+    Expired tasks that used up their attempts are marked as failed first
+    """
+    now = time.time()
+    year_filter = ""
+    args = [now]
+    if years:
+      year_filter = f"AND Year IN ({', '.join(['?'] * len(years))})"
+      args.extend(years)
+    with self.lock:
+      self.conn.execute("BEGIN IMMEDIATE")
+      try:
+        self.conn.execute(
+          """
+          UPDATE
+            Task
+          SET
+            State = 'failed', Owner = NULL, LeaseExpiry = NULL, UpdatedAt = ?
+          WHERE
+            State = 'leased' AND LeaseExpiry < ? AND Attempts >= ?
+          """, (now, now, self.max_attempts)
+        )
+        tasks = self.conn.execute(
+          f"""
+          SELECT
+            ProgramID, Year
+          FROM
+            Task
+          WHERE
+            (State = 'pending' OR (State = 'leased' AND LeaseExpiry < ?))
+            {year_filter}
+          ORDER BY
+            Attempts, rowid
+          LIMIT ?
+          """, args + [n]
+        ).fetchall()
+        self.conn.executemany(
+          """
+          UPDATE
+            Task
+          SET
+            State = 'leased', Owner = ?, LeaseExpiry = ?, Attempts = Attempts + 1, UpdatedAt = ?
+          WHERE
+            ProgramID = ? AND Year = ?
+          """, [(owner, now + ttl, now, idx, year) for idx, year in tasks]
+        )
+        self.conn.execute("COMMIT")
+      except sl.Error:
+        self.conn.execute("ROLLBACK")
+        raise
+    return [(idx, year) for idx, year in tasks]
+
+  def heartbeat(self, owner: str, ttl: float = 300) -> int:
+    """ Renew every lease held by the owner. Returns the number of renewed tasks """
+    with self.lock:
+      cursor = self.conn.execute(
+        "UPDATE Task SET LeaseExpiry = ? WHERE State = 'leased' AND Owner = ?",
+        (time.time() + ttl, owner)
+      )
+      return cursor.rowcount
+
+  def complete(self, owner: str, tasks: Iterable[Task]) -> int:
+    with self.lock:
+      cursor = self.conn.executemany(
+        """
+        UPDATE Task SET State = 'done', UpdatedAt = ?
+        WHERE ProgramID = ? AND Year = ? AND Owner = ? AND State = 'leased'
+        """, [(time.time(), str(idx), int(year), owner) for idx, year in tasks]
+      )
+      return cursor.rowcount
+
+  def fail(self, owner: str, tasks: Iterable[Task]) -> int:
+    """ Put failed tasks back in the queue, or mark them failed after max_attempts """
+    with self.lock:
+      cursor = self.conn.executemany(
+        """
+        UPDATE Task
+        SET
+          State = CASE WHEN Attempts >= ? THEN 'failed' ELSE 'pending' END,
+          Owner = NULL,
+          LeaseExpiry = NULL,
+          UpdatedAt = ?
+        WHERE ProgramID = ? AND Year = ? AND Owner = ? AND State = 'leased'
+        """, [(self.max_attempts, time.time(), str(idx), int(year), owner) for idx, year in tasks]
+      )
+      return cursor.rowcount
+
+  def progress(self) -> Dict[str, Union[int, float, List[str]]]:
+    """ Global progress of the crawl across all workers """
+    now = time.time()
+    with self.lock:
+      counts = dict(self.conn.execute("SELECT State, COUNT(*) FROM Task GROUP BY State").fetchall())
+      expired = self.conn.execute(
+        "SELECT COUNT(*) FROM Task WHERE State = 'leased' AND LeaseExpiry < ?", (now, )
+      ).fetchone()[0]
+      workers = self.conn.execute(
+        "SELECT DISTINCT Owner FROM Task WHERE State = 'leased' AND LeaseExpiry >= ?", (now, )
+      ).fetchall()
+    total = sum(counts.values())
+    report = {state: counts.get(state, 0) for state in ["pending", "leased", "done", "failed"]}
+    report.update(
+      total=total,
+      expired=expired,
+      workers=sorted(w[0] for w in workers),
+      percent_done=100 * report["done"] / total if total else 100.0,
+    )
+    return report
+
+
+class RemoteWorkQueue:
+  """
+  Client for a WorkQueue served over HTTP with `python workqueue.py serve`
+
+  Has the same interface as WorkQueue, so crawlers on other hosts can share a
+  single coordinator.
+
+  Parameters
+  ----------
+  url
+    Base URL of the coordinator, e.g. http://10.0.0.5:8800
+  """
+  def __init__(self, url: str, timeout: float = 30):
+    self.url = url.rstrip("/")
+    self.timeout = timeout
+
+  def _call(self, method: str, payload: Optional[dict] = None):
+    data = json.dumps(payload or {}).encode("utf-8")
+    request = urllib.request.Request(
+      f"{self.url}/{method}", data=data, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=self.timeout) as response:
+      return json.loads(response.read().decode("utf-8"))
+
+  def add(self, tasks: Iterable[Task]) -> int:
+    return self._call("add", {"tasks": [list(t) for t in tasks]})
+
+  def lease(
+    self, owner: str, n: int = 20, ttl: float = 300, years: Optional[List[int]] = None
+  ) -> List[Task]:
+    tasks = self._call("lease", {"owner": owner, "n": n, "ttl": ttl, "years": years})
+    return [(idx, year) for idx, year in tasks]
+
+  def heartbeat(self, owner: str, ttl: float = 300) -> int:
+    return self._call("heartbeat", {"owner": owner, "ttl": ttl})
+
+  def complete(self, owner: str, tasks: Iterable[Task]) -> int:
+    return self._call("complete", {"owner": owner, "tasks": [list(t) for t in tasks]})
+
+  def fail(self, owner: str, tasks: Iterable[Task]) -> int:
+    return self._call("fail", {"owner": owner, "tasks": [list(t) for t in tasks]})
+
+  def progress(self) -> dict:
+    return self._call("progress")
+
+
+def open_queue(location: str) -> Union[WorkQueue, RemoteWorkQueue]:
+  """ Open a queue from a database path or a coordinator URL """
+  if location.startswith(("http://", "https://")):
+    return RemoteWorkQueue(location)
+  return WorkQueue(location)
+
+
+class QueueHandler(BaseHTTPRequestHandler):
+  """ JSON over HTTP frontend of a WorkQueue """
+  methods = ("add", "lease", "heartbeat", "complete", "fail", "progress")
+
+  def do_POST(self):
+    queue = self.server.queue
+    method = self.path.strip("/")
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+      payload = parse_payload(json.loads(self.rfile.read(length) or b"{}"))
+      if method not in self.methods:
+        return self.respond(404, {"error": f"Unknown method {method}"})
+      # Unknown or missing arguments are the client's fault as well
+      inspect.signature(getattr(queue, method)).bind(**payload)
+    except (TypeError, ValueError) as e:
+      # json.JSONDecodeError is a ValueError as well
+      return self.respond(400, {"error": f"Invalid request: {e}"})
+    try:
+      result = getattr(queue, method)(**payload)
+    except Exception as e:
+      # E.g. a locked queue database, the workers retry on server errors
+      get_file_logger("workqueue", "work_queue.log").exception(f"Queue call {method} failed")
+      return self.respond(500, {"error": f"{type(e).__name__}: {e}"})
+    self.respond(200, result)
+
+  def respond(self, status: int, result):
+    data = json.dumps(result).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def parse_payload(payload: Any) -> dict:
+  """ Arguments of a queue method from the JSON object of a request, with their types checked """
+  if not isinstance(payload, dict):
+    raise ValueError(f"expected an object, got {type(payload).__name__}")
+  if "tasks" in payload:
+    payload["tasks"] = [(str(idx), int(year)) for idx, year in payload["tasks"]]
+  for key, cast in (("n", int), ("ttl", float)):
+    if key in payload:
+      payload[key] = cast(payload[key])
+  if payload.get("years") is not None:
+    payload["years"] = [int(year) for year in payload["years"]]
+  return payload
+
+
+class LeasedTasks:
+  """
+  Iterate over the tasks of a queue, leasing them in batches
+
+  A background thread renews the leases while the tasks are being crawled. When
+  no task is left to lease but other workers still hold leases, it keeps polling
+  so that expired leases of crashed workers get picked up.
+
+  Parameters
+  ----------
+  queue
+    The queue to lease from
+
+  owner
+    Unique name of this worker, e.g. <hostname>-<pid>
+
+  batch
+    Number of tasks leased at once
+
+  ttl
+    Lease duration in seconds
+
+  years
+    Only lease tasks of these years
+
+  poll
+    Seconds to wait between polls while other workers hold the remaining tasks
+
+  retry
+    Backoff of the calls to the queue, e.g. while the coordinator restarts or
+    the queue database is locked. Tasks that cannot be completed or failed are
+    dropped, their lease expires and the queue hands them out again
+  """
+  def __init__(
+    self,
+    queue: Union[WorkQueue, RemoteWorkQueue],
+    owner: str,
+    batch: int = 20,
+    ttl: float = 300,
+    years: Optional[List[int]] = None,
+    poll: float = 10,
+    retry: Optional[RetryPolicy] = None,
+  ):
+    self.queue = queue
+    self.owner = owner
+    self.batch = batch
+    self.ttl = ttl
+    self.years = years
+    self.poll = poll
+    if retry is None:
+      retry = RetryPolicy(max_attempts=6, base_delay=2, max_delay=60)
+    self.retry = retry
+    self.stopped = threading.Event()
+    self.heartbeats = threading.Thread(target=self._heartbeat, daemon=True)
+
+  def _heartbeat(self):
+    while not self.stopped.wait(self.ttl / 3):
+      try:
+        self.queue.heartbeat(self.owner, self.ttl)
+      except Exception:
+        # A missed heartbeat only shortens the lease, the next one may succeed
+        pass
+
+  def _call(self, method: str, *args, required: bool = True) -> Any:
+    """
+    Call a queue method, retrying with backoff when it fails
+
+    After the last attempt the error is raised, or logged and None returned if
+    the call is not required.
+    """
+    for attempt in range(1, self.retry.max_attempts + 1):
+      try:
+        return getattr(self.queue, method)(*args)
+      except urllib.error.HTTPError as e:
+        # The coordinator rejected the request, asking again does not help
+        if e.code < 500:
+          raise
+        error = e
+      except Exception as e:
+        error = e
+      if attempt < self.retry.max_attempts:
+        time.sleep(self.retry.backoff(attempt))
+    logger = get_file_logger("workqueue", "work_queue.log")
+    logger.error(f"Queue call {method} failed {self.retry.max_attempts} times: {error!r}")
+    if required:
+      raise error
+    return None
+
+  def __iter__(self) -> Iterator[Task]:
+    self.heartbeats.start()
+    try:
+      while True:
+        tasks = self._call("lease", self.owner, self.batch, self.ttl, self.years)
+        if len(tasks) == 0:
+          # Our own leases are still in flight, e.g. in the crawl pipeline, and
+          # only finish after this returns, so only other workers are waited for
+          workers = self._call("progress")["workers"]
+          if all(worker == self.owner for worker in workers):
+            return
+          time.sleep(self.poll)
+          continue
+        yield from tasks
+    finally:
+      self.stopped.set()
+
+  def done(self, task: Task):
+    self._call("complete", self.owner, [task], required=False)
+
+  def failed(self, task: Task):
+    self._call("fail", self.owner, [task], required=False)
+
+  def progress(self) -> Optional[dict]:
+    """ Global progress of the queue, None if the queue cannot be reached """
+    return self._call("progress", required=False)
+
+
+if __name__ == "__main__":
+  from argparse import ArgumentParser
+  from scheduler import stream_ids
+
+  parser = ArgumentParser(description="Work queue for distributed crawling")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  add_parser = subparsers.add_parser("add", help="Enqueue program IDs for a year")
+  add_parser.add_argument("queue", help="Queue database path or coordinator URL")
+  add_parser.add_argument("year", type=int, help="Year to crawl")
+  add_parser.add_argument("program_ids", help="Program ID file or glob pattern")
+
+  status_parser = subparsers.add_parser("status", help="Show the global progress")
+  status_parser.add_argument("queue", help="Queue database path or coordinator URL")
+
+  serve_parser = subparsers.add_parser("serve", help="Serve a queue database over HTTP")
+  serve_parser.add_argument("queue", help="Queue database path")
+  serve_parser.add_argument("--host", default="0.0.0.0", help="Interface to listen on")
+  serve_parser.add_argument("-p", "--port", default=8800, type=int, help="Port to listen on")
+  args = parser.parse_args()
+
+  if args.command == "add":
+    queue = open_queue(args.queue)
+    tasks = ((idx, args.year) for idx in stream_ids([args.program_ids]))
+    print(f"Added {queue.add(tasks)} tasks")
+  elif args.command == "status":
+    progress = open_queue(args.queue).progress()
+    print(
+      f"{progress['done']}/{progress['total']} done ({progress['percent_done']:.1f}%), "
+      f"{progress['pending']} pending, {progress['leased']} leased "
+      f"({progress['expired']} expired), {progress['failed']} failed"
+    )
+    print(f"Active workers: {', '.join(progress['workers']) or '-'}")
+  elif args.command == "serve":
+    server = ThreadingHTTPServer((args.host, args.port), QueueHandler)
+    server.queue = WorkQueue(args.queue)
+    print(f"Serving work queue {args.queue} on {args.host}:{args.port}")
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      server.server_close()